@@ -0,0 +1,4 @@
+# ---------------------------------------------------------------------------
+# データセットの生成。各スクリプトは dataset/ の中で実行する (world.json などをカレントディレクトリから読む)。
+# artifacts は evaluate_model からも dataset.artifacts として読み込む
+# ---------------------------------------------------------------------------
@@ -1,41 +1,27 @@
 import json
 from collections import defaultdict
-import re
+from pathlib import Path
 
-def analyze_patterns_with_padding(stories_path, world_path, output_path):
+from artifacts import iter_records
+from story_parser import StoryParser
+
+def classify_patterns(stories, parser: StoryParser):
     """
     パターン文字列の場所の区切り文字'/'が常に2つになるよう、
-    空の場所を補って出力する最終版。
+    空の場所を補って分類した結果を返す (ファイルは読み書きしない)。
     """
-    try:
-        with open(stories_path, 'r', encoding='utf-8') as f:
-            stories = json.load(f)
-        with open(world_path, 'r', encoding='utf-8') as f:
-            world_data = json.load(f)
-    except FileNotFoundError as e:
-        print(f"エラー: 入力ファイルが見つかりません。 ({e})")
-        return
-
-    WORLD_AGENTS = set(world_data.get("agents", []))
-    WORLD_OBJECTS = set(world_data.get("objects", []))
-    WORLD_CONTAINERS = set(world_data.get("containers", []))
-
-    a3_o3_c3_stories = [s for s in stories if s.get("setting") == "A3_O3_C3"]
+    n_in_setting = 0  # ストーリーは1件ずつ読んで捨てる (全件をリストにしない)
 
     categorized_patterns = defaultdict(lambda: defaultdict(int))
     category_counts = defaultdict(int)
     skipped_stories_report = defaultdict(list)
 
-    for story in a3_o3_c3_stories:
-        item_location, all_items = {}, set()
-        for stmt in story["initial_state"]:
-            match = re.match(r"(.+?)\s+(?:was|were)\s+in\s+the\s+(.+?)\.", stmt)
-            if not match: continue
-            items_raw, loc_name = match.group(1), match.group(2).strip()
-            individual_items = [item.strip() for item in items_raw.replace("The ", "").split(" and ")]
-            for item_name in individual_items:
-                item_location[item_name] = loc_name
-                all_items.add(item_name)
+    for story in stories:
+        if story.get("setting") != "A3_O3_C3": continue
+        n_in_setting += 1
+        state = parser.story_initial_state(story)
+        item_location = {name: place for kind in ("agent", "container", "object") for name, place in state[kind].items()}
+        all_items = set(item_location)
 
         cache = {}
         def resolve_loc(item):
@@ -48,14 +34,13 @@ def analyze_patterns_with_padding(stories_path, world_path, output_path):
         final_contents = defaultdict(lambda: {"A": 0, "C": 0, "O": 0})
         found_agents, found_objects, found_containers = 0, 0, 0
         for item in all_items:
-            if item not in item_location: continue
             room = resolve_loc(item)
             if room is None: continue
-            if item in WORLD_AGENTS:
+            if item in state["agent"]:
                 final_contents[room]["A"] += 1; found_agents += 1
-            elif item in WORLD_CONTAINERS:
+            elif item in state["container"]:
                 final_contents[room]["C"] += 1; found_containers += 1
-            elif item in WORLD_OBJECTS:
+            elif item in state["object"]:
                 final_contents[room]["O"] += 1; found_objects += 1
 
         if not (found_agents == 3 and found_objects == 3 and found_containers == 3):
@@ -92,7 +77,7 @@ def analyze_patterns_with_padding(stories_path, world_path, output_path):
             skipped_stories_report["分類不能"].append(story['instance_index'])
 
     total_processed = sum(category_counts.values())
-    total_skipped = len(a3_o3_c3_stories) - total_processed
+    total_skipped = n_in_setting - total_processed
     final_report = {
         reason: {"count": len(indices), "instance_indices": sorted(indices)}
         for reason, indices in skipped_stories_report.items()
@@ -100,7 +85,7 @@ def analyze_patterns_with_padding(stories_path, world_path, output_path):
 
     results = {
         "analysis_summary": {
-            "total_stories_in_setting": len(a3_o3_c3_stories),
+            "total_stories_in_setting": n_in_setting,
             "processed_and_categorized": total_processed,
             "skipped_stories": total_skipped
         },
@@ -112,7 +97,23 @@ def analyze_patterns_with_padding(stories_path, world_path, output_path):
         },
         "skipped_stories_report": final_report
     }
+    return results
+
+
+def analyze_patterns_with_padding(stories_path, world_path, output_path):
+    try:
+        with open(world_path, 'r', encoding='utf-8') as f:
+            world_data = json.load(f)
+        if not Path(stories_path).exists(): raise FileNotFoundError(stories_path)
+    except FileNotFoundError as e:
+        print(f"エラー: 入力ファイルが見つかりません。 ({e})")
+        return
+
+    # stories は JSON 配列でも JSONL (.jsonl / .jsonl.gz など) でもよい
+    save_patterns(classify_patterns(iter_records(stories_path), StoryParser.from_world(world_data)), output_path)
+
 
+def save_patterns(results, output_path):
     with open(output_path, 'w', encoding='utf-8') as f:
         json.dump(results, f, indent=4, ensure_ascii=False)
     
@@ -120,4 +121,5 @@ def analyze_patterns_with_padding(stories_path, world_path, output_path):
 
 
 # --- プログラムの実行 ---
-analyze_patterns_with_padding('stories.json', 'world.json', 'pattern.json')
\ No newline at end of file
+if __name__ == "__main__":
+    analyze_patterns_with_padding('stories.json', 'world.json', 'pattern.json')
\ No newline at end of file
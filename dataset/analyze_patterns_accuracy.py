@@ -1,6 +1,9 @@
 import json
 from collections import defaultdict
-import re
+from pathlib import Path
+
+from artifacts import iter_records
+from story_parser import StoryParser
 
 def calculate_detailed_pattern_accuracy_v2(stories_path, world_path, eval_path, output_path):
     """
@@ -10,12 +13,10 @@ def calculate_detailed_pattern_accuracy_v2(stories_path, world_path, eval_path,
     print(f"Loading files...\n Stories: {stories_path}\n World: {world_path}\n Eval: {eval_path}")
     
     try:
-        with open(stories_path, 'r', encoding='utf-8') as f:
-            stories = json.load(f)
         with open(world_path, 'r', encoding='utf-8') as f:
             world_data = json.load(f)
-        with open(eval_path, 'r', encoding='utf-8') as f:
-            eval_results = json.load(f)
+        for path in (stories_path, eval_path):
+            if not Path(path).exists(): raise FileNotFoundError(path)
     except FileNotFoundError as e:
         print(f"エラー: ファイルが見つかりません。 {e}")
         return
@@ -23,30 +24,16 @@ def calculate_detailed_pattern_accuracy_v2(stories_path, world_path, eval_path,
     # --- 1. ストーリーごとのパターン(詳細・親)を特定する ---
     print("Analyzing story patterns...")
     
-    WORLD_AGENTS = set(world_data.get("agents", []))
-    WORLD_OBJECTS = set(world_data.get("objects", []))
-    WORLD_CONTAINERS = set(world_data.get("containers", []))
+    parser = StoryParser.from_world(world_data)
 
     # story_id -> {'specific': str, 'parent': str}
     story_info_map = {}
-    target_stories = [s for s in stories if s.get("setting") == "A3_O3_C3"]
-
-    for story in target_stories:
-        item_location = {}
-        all_items = set()
-
-        for stmt in story["initial_state"]:
-            match = re.match(r"(.+?)\s+(?:was|were)\s+in\s+the\s+(.+?)\.", stmt)
-            if not match: continue
-            
-            items_raw = match.group(1)
-            loc_name = match.group(2).strip()
-            
-            individual_items = [item.strip() for item in items_raw.replace("The ", "").split(" and ")]
-            
-            for item_name in individual_items:
-                item_location[item_name] = loc_name
-                all_items.add(item_name)
+    # ストーリーと評価結果は JSON 配列でも JSONL (.jsonl / .jsonl.gz など) でもよく、どちらも1件ずつ読む。残すのはストーリーごとのパターンだけ
+    for story in iter_records(stories_path):
+        if story.get("setting") != "A3_O3_C3": continue
+        state = parser.story_initial_state(story)
+        item_location = {name: place for kind in ("agent", "container", "object") for name, place in state[kind].items()}
+        all_items = set(item_location)
 
         cache = {}
         def resolve_loc(item):
@@ -59,16 +46,15 @@ def calculate_detailed_pattern_accuracy_v2(stories_path, world_path, eval_path,
         final_contents = defaultdict(lambda: {"A": 0, "C": 0, "O": 0})
         found_agents = 0
         for item in all_items:
-            if item not in item_location: continue
             room = resolve_loc(item)
             if room is None: continue
             
-            if item in WORLD_AGENTS:
+            if item in state["agent"]:
                 final_contents[room]["A"] += 1
                 found_agents += 1
-            elif item in WORLD_CONTAINERS:
+            elif item in state["container"]:
                 final_contents[room]["C"] += 1
-            elif item in WORLD_OBJECTS:
+            elif item in state["object"]:
                 final_contents[room]["O"] += 1
         
         # エージェント数が3でない場合は対象外（念のため）
@@ -114,8 +100,9 @@ def calculate_detailed_pattern_accuracy_v2(stories_path, world_path, eval_path,
     specific_stats = defaultdict(init_stats)
     parent_stats = defaultdict(init_stats)
 
-    for res in eval_results:
+    for res in iter_records(eval_path):
         idx = res.get("instance_index")
+        if res.get("error"): continue  # 問い合わせに失敗した設問は正答率に入れない
         
         if idx in story_info_map:
             info = story_info_map[idx]
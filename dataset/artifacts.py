@@ -0,0 +1,82 @@
+import bz2
+import gzip
+import io
+import json
+import lzma
+import textwrap
+from itertools import chain
+from pathlib import Path
+
+# ---------------------------------------------------------------------------
+# 各段の成果物 (stories, qa_sets, 評価結果など) を1件ずつ読み書きする。
+# 拡張子が .jsonl (.jsonl.gz などの圧縮も可) なら1行1件の JSONL、それ以外は従来どおりの JSON 配列。
+# 読み出しは1件ずつなので、名前付きパイプ (mkfifo) でつなげば次の段は前の段が終わる前に読み始められる
+# ---------------------------------------------------------------------------
+COMPRESSORS = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}
+READ_BLOCK_SIZE = 1 << 20  # JSON 配列を読むときに一度に読む文字数
+
+def open_text(path, mode="r"):
+    """拡張子 (.gz / .bz2 / .xz) に合わせて圧縮・展開しながらテキストとして開く"""
+    opener = COMPRESSORS.get(Path(path).suffix)
+    return opener(path, mode + "t", encoding="utf-8") if opener else open(path, mode, encoding="utf-8")
+
+def is_jsonl(path):
+    """書き出しを JSONL にするか。.jsonl と、その圧縮 (.jsonl.gz など) が JSONL"""
+    suffixes = Path(path).suffixes
+    if suffixes and suffixes[-1] in COMPRESSORS: suffixes = suffixes[:-1]
+    return bool(suffixes) and suffixes[-1] == ".jsonl"
+
+def iter_records(path):
+    """JSON 配列または JSONL からレコード (オブジェクト) を1件ずつ読む。形式は拡張子ではなく先頭の文字で見分ける。
+    メモリに置くのは読み込み中のブロックと読みかけのレコードだけ"""
+    with open_text(path) as f:
+        buffer = f.read(READ_BLOCK_SIZE).lstrip()
+        if buffer.startswith("["):
+            yield from _iter_array(f, buffer, 1)
+            return
+        # JSONL: ブロックの最後の行は途中で切れているので、続きを1行読み足してから行ごとに読む
+        for line in chain(io.StringIO(buffer + f.readline()), f):
+            if line.strip(): yield json.loads(line)
+
+def _iter_array(f, buffer, pos):
+    decoder = json.JSONDecoder()
+    while True:
+        while True:
+            while pos < len(buffer) and buffer[pos] in " \t\r\n,": pos += 1
+            if pos < len(buffer): break
+            buffer, pos = f.read(READ_BLOCK_SIZE), 0
+            if not buffer: return
+        if buffer[pos] == "]": return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # レコードがブロックの境目で切れている: 残りを先頭に寄せて次のブロックを足す
+            more = f.read(READ_BLOCK_SIZE)
+            if not more: raise
+            buffer, pos = buffer[pos:] + more, 0
+            continue
+        yield record
+        pos = end
+
+class RecordWriter:
+    """レコードを1件ずつ書き出す。JSONL なら1行1件、それ以外は json.dump(records, indent=indent) と同じ形の JSON 配列"""
+    def __init__(self, path, indent=2):
+        self.path, self.jsonl, self.indent, self.count = path, is_jsonl(path), indent, 0
+        self.f = open_text(path, "w")
+        if not self.jsonl: self.f.write("[")
+
+    def write(self, record):
+        if self.jsonl: self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else: self.f.write(("," if self.count else "") + "\n" + textwrap.indent(json.dumps(record, ensure_ascii=False, indent=self.indent), " " * self.indent))
+        self.count += 1
+
+    def close(self, complete=True):
+        """complete でなければ配列を閉じない (途中で止まった書き出しを、正しい JSON に見せない)"""
+        if complete and not self.jsonl: self.f.write("\n]" if self.count else "]")
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(complete=exc_type is None)
@@ -1,16 +1,34 @@
+import argparse
+import hashlib
 import json
 import random
-import re
-from copy import deepcopy
+import shutil
+from bisect import bisect_right
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import groupby
 from pathlib import Path
-from collections import defaultdict, Counter
+
+from artifacts import RecordWriter, iter_records, open_text
+from story_parser import MOVE, StoryParser
+
+try:
+    import numpy as np
+except ImportError:  # numpy がなければ2次の信念は辞書で計算する
+    np = None
 
 # ---------------------------------------------------------------------------
 # 1. 設定とグローバル変数
 # ---------------------------------------------------------------------------
 STORIES_IN_PATH = Path("stories.json")
 QA_OUT_PATH = Path("qa_sets.json")
+QA_ALL_OUT_PATH = Path("qa_all.jsonl")  # 全列挙モードの出力 (1行1問)。入出力のパスは .jsonl / .jsonl.gz などにすると JSONL で読み書きする
 WORLD_PATH = Path("world.json")
+DENSE_MIN_CELLS = 256  # エージェント x エージェント x オブジェクトがこれ以上なら、2次の信念を numpy の配列で計算する (小さい設定では辞書の方が速い)
+NESTED_ORDERS = (3, 4)  # *_belief3_QA, *_belief4_QA を作る入れ子の次数
+BASE_QA_CATEGORIES = ["memory_QA", "reality_QA", "true_belief1_QA", "false_belief1_QA", "true_belief2_QA", "false_belief2_QA"]
+QA_CATEGORIES = BASE_QA_CATEGORIES + [f"{kind}_belief{order}_QA" for order in NESTED_ORDERS for kind in ("true", "false")]
+CHUNK_SIZE = 500  # 並列モードで1回にワーカーへ渡すストーリー数
 
 # ---------------------------------------------------------------------------
 # 2. ユーティリティ関数
@@ -21,190 +39,422 @@ def is_plural(noun: str) -> bool:
 def verb_agree(noun: str, singular: str, plural: str) -> str:
     return plural if is_plural(noun) else singular
 
+def derive_seed(master_seed, *keys):
+    """マスターシードとキーからシードを導出する (ワーカー数や処理順序に依存しない)"""
+    digest = hashlib.sha256(":".join(str(k) for k in (master_seed,) + keys).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+def chunked(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
+
 # ---------------------------------------------------------------------------
 # 3. 状態管理クラス
 # ---------------------------------------------------------------------------
-class RealityState:
-    def __init__(self, agent_locs, obj_locs, cont_locs):
-        self.agent_locs, self.obj_locs, self.cont_locs = agent_locs, obj_locs, cont_locs
-    def apply(self, event: str):
-        toks = event.split()
-        if not toks: return
-        try:
-            if "moved" in toks:
-                obj_index = toks.index("the") + 1
-                self.obj_locs[toks[obj_index]] = toks[-1].rstrip(".")
-            elif "entered" in toks:
-                self.agent_locs[toks[0]] = toks[toks.index("entered") + 1].rstrip(".")
-        except (ValueError, IndexError): pass
-
-class BeliefState:
+class BeliefHistory:
+    """現実の状態と、信念の履歴 (初期の信念 + ステップごとの差分) を持つ。
+
+    状態はステップごとに複製せず、apply() で現在の位置を書き換え、変わった信念だけを (ステップ, 値) の列に追記する。
+    belief(ag, obj, step) は step 番目のイベントの直後の信念で、(ag, obj) の差分の列を二分探索して引く。
+    ステップごとの索引は持たないので、1回の参照は (ag, obj) の信念が変わった回数 k に対して O(log k) かかる。
+    """
     def __init__(self, agent_locs, obj_locs, cont_locs):
-        self.agent_locations, self.object_locations, self.container_locations = agent_locs, obj_locs, cont_locs
-        self.belief_states = {ag: {obj: None for obj in obj_locs} for ag in agent_locs}
+        self.agent_locations, self.object_locations, self.container_locations = dict(agent_locs), dict(obj_locs), cont_locs
+        # 最初に同じ部屋にあるオブジェクトだけ、置き場所を知っている
+        self.initial = {ag: {obj: (cont if cont_locs.get(cont) == loc else None) for obj, cont in obj_locs.items()} for ag, loc in agent_locs.items()}
+        self.change_steps, self.change_values = defaultdict(list), defaultdict(list)
+        self.step = 0
+
+    def apply(self, event: tuple):
+        self.step += 1
+        if event is None: return
+        action_type, agent, x, y = event
+        if action_type == MOVE:
+            self.object_locations[x] = y
+            mover_loc = self.agent_locations.get(agent)
+            if mover_loc:
+                for ag, loc in self.agent_locations.items():
+                    if loc == mover_loc:
+                        self.change_steps[(ag, x)].append(self.step); self.change_values[(ag, x)].append(y)
+        else:
+            self.agent_locations[agent] = y
+
+    def belief(self, ag, obj, step=None):
+        """step 番目のイベントの直後 (省略時は最新) に ag が obj の置き場所だと信じているコンテナ。知らなければ None"""
+        steps = self.change_steps.get((ag, obj))
+        if steps:
+            i = len(steps) if step is None else bisect_right(steps, step)
+            if i: return self.change_values[(ag, obj)][i - 1]
+        return self.initial.get(ag, {}).get(obj)
+
+    def dense(self, agents, objects):
+        """全ステップの信念を整数配列 [ステップ数+1, エージェント, オブジェクト] にする (未知は -1)。コンテナ名のリストも返す"""
+        a_idx, o_idx, c_idx = {ag: i for i, ag in enumerate(agents)}, {obj: j for j, obj in enumerate(objects)}, {}
+        beliefs = np.full((self.step + 1, len(agents), len(objects)), -1, dtype=np.int32)
+        for ag, row in self.initial.items():
+            for obj, cont in row.items():
+                if cont is not None and ag in a_idx and obj in o_idx: beliefs[:, a_idx[ag], o_idx[obj]] = c_idx.setdefault(cont, len(c_idx))
+        for (ag, obj), steps in self.change_steps.items():
+            if ag not in a_idx or obj not in o_idx: continue
+            for step, cont in zip(steps, self.change_values[(ag, obj)]): beliefs[step:, a_idx[ag], o_idx[obj]] = c_idx.setdefault(cont, len(c_idx))
+        return beliefs, list(c_idx)
+
+class NestedBeliefEngine:
+    """任意の次数の入れ子の信念を、ステップごとの目撃者のビット集合 (エージェント i が見ていればビット i) で計算する。
+
+    「a1 は、a2 は … ak が obj をどこにあると思っている、と思っているか」は、時刻 T から始めて、隣り合う2人 (a_i, a_{i+1}) が
+    最後に一緒に obj の配置を見たステップ (直前の時刻以前) へ順にさかのぼり、そのときの ak の信念を答えとする。
+    正解かどうかは、a2 以降の列を時刻 T から同じようにたどった実際の入れ子の信念と比べる。2次なら second_order_beliefs と同じ定義になる。
+
+    列の途中の状態は (最後のエージェント, 推測側の時刻, 実際側の時刻) だけで決まるので、そこから先の真・偽の列の数をメモ化して数え、
+    数に比例した確率で1本ずつたどって一様に1問選ぶ。計算量は状態数 (エージェント x 時刻の組) に比例し、agents^k では増えない。
+    """
+    def __init__(self, history: BeliefHistory, agent_locs, obj_locs, cont_locs, witnessed_moves, agents):
+        self.history, self.agents, self.bit = history, agents, {ag: 1 << i for i, ag in enumerate(agents)}
+        self.others = {ag: [other for other in agents if other != ag] for ag in agents}
+        # obj ごとの (ステップ, 目撃者) の列。ステップ 0 は最初に同じ部屋にいたエージェント
+        self.witnesses = defaultdict(list)
+        for obj, cont in obj_locs.items():
+            room = cont_locs.get(cont)
+            self.witnesses[obj].append((0, sum(self.bit[ag] for ag, loc in agent_locs.items() if loc == room)))
+        for step, moved_obj, agents_in_room in witnessed_moves:
+            self.witnesses[moved_obj].append((step, sum(self.bit[ag] for ag in agents_in_room if ag in self.bit)))
+        self.joint_memo, self.count_memo = {}, {}
+
+    def last_joint(self, a, b, obj, t):
+        """a と b が一緒に obj の配置を見た、t 以前の最後のステップ。なければ None"""
+        key = (a, b, obj, t)
+        if key not in self.joint_memo:
+            mask = self.bit[a] | self.bit[b]
+            self.joint_memo[key] = next((step for step, seen in reversed(self.witnesses.get(obj, [])) if step <= t and (seen & mask) == mask), None)
+        return self.joint_memo[key]
+
+    def _next_states(self, obj, last, guess_t, actual_t):
+        for ag in self.others[last]:
+            g, h = self.last_joint(last, ag, obj, guess_t), self.last_joint(last, ag, obj, actual_t)
+            if g is not None and h is not None: yield ag, g, h
+
+    def count(self, obj, last, guess_t, actual_t, remaining):
+        """状態から、あと remaining 人を並べてできる (正しい推測の列の数, 誤った推測の列の数)"""
+        key = (obj, last, guess_t, actual_t, remaining)
+        if key not in self.count_memo:
+            if remaining == 0:
+                guess, actual = self.history.belief(last, obj, guess_t), self.history.belief(last, obj, actual_t)
+                self.count_memo[key] = (0, 0) if guess is None or actual is None else ((1, 0) if guess == actual else (0, 1))
+            else:
+                counts = [self.count(obj, ag, g, h, remaining - 1) for ag, g, h in self._next_states(obj, last, guess_t, actual_t)]
+                self.count_memo[key] = (sum(c[0] for c in counts), sum(c[1] for c in counts))
+        return self.count_memo[key]
+
+    def _starts(self, objects):
+        """列の最初の2人 (a1, a2) を置いた状態。推測側は a1 と a2 が最後に一緒に見た時刻、実際側は現在の時刻から始める"""
+        for obj in objects:
+            for a1 in self.agents:
+                for a2 in self.others[a1]:
+                    g = self.last_joint(a1, a2, obj, self.history.step)
+                    if g is not None: yield obj, (a1, a2), g, self.history.step
+
+    def sample(self, objects, order, correct, rng=random):
+        """order 次の質問のうち、推測が正しい (correct) ものから一様に1つ選び (obj, エージェントの列, 推測) を返す。なければ None"""
+        side = 0 if correct else 1
+        starts = [(obj, chain, g, h, self.count(obj, chain[-1], g, h, order - 2)[side]) for obj, chain, g, h in self._starts(objects)]
+        total = sum(start[-1] for start in starts)
+        if not total: return None
+        r = rng.randrange(total)
+        for obj, chain, g, h, n in starts:
+            if r < n: break
+            r -= n
+        # 列の数に比例して次のエージェントを選び、葉まで下りる
+        while len(chain) < order:
+            for ag, g2, h2 in self._next_states(obj, chain[-1], g, h):
+                n = self.count(obj, ag, g2, h2, order - len(chain) - 1)[side]
+                if r < n: chain, g, h = chain + (ag,), g2, h2; break
+                r -= n
+        return obj, chain, self.history.belief(chain[-1], obj, g)
+
+    def iter_questions(self, objects, order):
+        """order 次の質問をすべて (obj, エージェントの列, 推測, 正しいか) として sample と同じ順に返す。答えのない枝は数を見て飛ばす"""
+        def walk(obj, chain, g, h):
+            if len(chain) == order:
+                guess, actual = self.history.belief(chain[-1], obj, g), self.history.belief(chain[-1], obj, h)
+                if guess is not None and actual is not None: yield obj, chain, guess, guess == actual
+                return
+            for ag, g2, h2 in self._next_states(obj, chain[-1], g, h):
+                if any(self.count(obj, ag, g2, h2, order - len(chain) - 1)): yield from walk(obj, chain + (ag,), g2, h2)
+        for obj, chain, g, h in self._starts(objects):
+            if any(self.count(obj, chain[-1], g, h, order - 2)): yield from walk(obj, chain, g, h)
 
 # ---------------------------------------------------------------------------
 # 4. パーサーとシミュレーター (★修正箇所)
 # ---------------------------------------------------------------------------
-def parse_initial_state(sentences: list, locations: set):
-    """初期状態の文章を解析して、各要素の位置辞書を作成する"""
-    agent_locs, cont_locs, obj_locs = {}, {}, {}
-    patterns = {
-        "agent": re.compile(r"^([\w-]+) was in the ([\w_-]+)\.$"),
-        "container_or_obj": re.compile(r"^The ([\w\sand-]+) (?:was|were) in the ([\w_-]+)\.$"),
-    }
-    
-    # Pass 1: まずコンテナを特定する
-    for s in sentences:
-        m = patterns["container_or_obj"].match(s)
-        if m and m[2] in locations:
-            # "The [X] was in the [LOCATION]." -> Xはコンテナ
-            cont_locs[m[1]] = m[2]
-
-    # Pass 2: エージェントとオブジェクトを特定
-    for s in sentences:
-        m_ag = patterns["agent"].match(s)
-        if m_ag:
-            agent_locs[m_ag[1]] = m_ag[2]
-            continue
-        
-        m_obj = patterns["container_or_obj"].match(s)
-        if m_obj and m_obj[2] in cont_locs:
-            # "The [Y] was in the [CONTAINER]." -> Yはオブジェクト
-            obj_names = [o.strip() for o in m_obj[1].split(" and ")]
-            for obj in obj_names:
-                obj_locs[obj] = m_obj[2]
-
-    return agent_locs, obj_locs, cont_locs
-
-def apply_event_for_belief(state: BeliefState, event: str):
-    new_state = deepcopy(state)
-    toks = event.split()
-    if not toks: return new_state
-    try:
-        if "moved" in toks:
-            agent, target_cont = toks[0], toks[-1].rstrip('.')
-            the_index, prep_index = toks.index("the"), toks.index("to")
-            obj_str = " ".join(toks[the_index + 1 : prep_index])
-            objects = [o.strip() for o in obj_str.split(" and ")]
-            for obj in objects: new_state.object_locations[obj] = target_cont
-            mover_loc = new_state.agent_locations.get(agent)
-            if mover_loc:
-                for ag, loc in new_state.agent_locations.items():
-                    if loc == mover_loc:
-                        for obj in objects: new_state.belief_states[ag][obj] = target_cont
-        elif "entered" in toks:
-            agent, new_loc = toks[0], toks[toks.index("entered") + 1].rstrip('.')
-            new_state.agent_locations[agent] = new_loc
-    except (ValueError, IndexError): pass
-    return new_state
+def load_story_world(story: dict, parser: StoryParser):
+    """初期状態の位置辞書と、(行動の種類, エージェント, 対象, 行き先) のイベント列を返す。
+    生成器が書いた story_record があればそのまま使い、なければ (古い stories.json) 共通パーサーで文章を解析する"""
+    record = story.get("story_record")
+    if record:
+        return dict(record["agents"]), dict(record["objects"]), dict(record["containers"]), [tuple(ev) for ev in record["events"]]
+    state = parser.parse_initial_state(story["initial_state"])
+    events = [parser.parse_event(log['event']) for log in story.get("simulation_log", [])]
+    return state["agent"], state["object"], state["container"], events
 
 # ---------------------------------------------------------------------------
 # 5. 課題生成のメインロジック
 # ---------------------------------------------------------------------------
-def build_qa_for_story(story: dict, locations: set):
-    event_sentences = [log['event'] for log in story.get("simulation_log", [])]
-    agent_locs, obj_locs, cont_locs = parse_initial_state(story["initial_state"], locations)
-
-    if not obj_locs or not agent_locs:
-        return None # 解析に失敗したストーリーはスキップ
-
-    initial_reality = RealityState(deepcopy(agent_locs), deepcopy(obj_locs), deepcopy(cont_locs))
-    final_reality = RealityState(deepcopy(agent_locs), deepcopy(obj_locs), deepcopy(cont_locs))
-    for ev in event_sentences:
-        final_reality.apply(ev)
-
-    initial_belief_state = BeliefState(agent_locs, obj_locs, cont_locs)
-    for agent, agent_loc in initial_belief_state.agent_locations.items():
-        for obj, obj_cont in initial_belief_state.object_locations.items():
-            if initial_belief_state.container_locations.get(obj_cont) == agent_loc:
-                initial_belief_state.belief_states[agent][obj] = obj_cont
-    snapshots = [initial_belief_state]
-    for ev in event_sentences:
-        snapshots.append(apply_event_for_belief(snapshots[-1], ev))
-        
-    final_belief_state = snapshots[-1]
-    agents, objects = sorted(agent_locs.keys()), sorted(obj_locs.keys())
-    memory_qa, reality_qa, true1_qa, false1_qa, true2_qa, false2_qa = [], [], [], [], [], []
-    
-    for obj in objects:
-        verb_was, verb_is = verb_agree(obj, "was", "were"), verb_agree(obj, "is", "are")
-        memory_qa.append((f'Where {verb_was} the {obj} at the beginning?', initial_reality.obj_locs.get(obj, "unknown")))
-        reality_qa.append((f'Where {verb_is} the {obj} now?', final_reality.obj_locs.get(obj, "unknown")))
-    for ag in agents:
-        for obj in objects:
-            believed, actual = final_belief_state.belief_states[ag].get(obj), final_reality.obj_locs.get(obj)
-            if believed is None: continue
-            q = f'Where does {ag} think the {obj} {verb_agree(obj, "is", "are")}?'
-            (true1_qa if believed == actual else false1_qa).append((q, believed))
+def second_order_beliefs(history: BeliefHistory, agent_locs, obj_locs, cont_locs, witnessed_moves, agents, objects):
+    """ag1 が最後に ag2 と一緒に obj の移動 (または最初の配置) を見たときの ag2 の信念を、ag1 の推測とする。
+    (obj, ag1, ag2, ag1 の推測, ag2 の最終的な信念と一致するか) を obj, ag1, ag2 の順に返す"""
     last_seen = defaultdict(lambda: defaultdict(lambda: defaultdict(lambda: -1)))
     room2agents0 = defaultdict(list)
-    for ag, loc in snapshots[0].agent_locations.items(): room2agents0[loc].append(ag)
+    for ag, loc in agent_locs.items(): room2agents0[loc].append(ag)
     for room, agents_in_room in room2agents0.items():
-        objs_in_room = {o for o, c in snapshots[0].object_locations.items() if snapshots[0].container_locations.get(c) == room}
+        objs_in_room = {o for o, c in obj_locs.items() if cont_locs.get(c) == room}
         for a1 in agents_in_room:
             for a2 in agents_in_room:
                 if a1 != a2:
                     for obj in objs_in_room: last_seen[a1][a2][obj] = 0
-    for step, ev in enumerate(event_sentences, 1):
-        if "moved" in ev:
-            try:
-                toks = ev.split()
-                moved_obj, new_cont = toks[toks.index("the") + 1], toks[-1].rstrip(".")
-                move_loc = snapshots[step].container_locations.get(new_cont)
-                if move_loc:
-                    agents_in_room = [ag for ag, loc in snapshots[step].agent_locations.items() if loc == move_loc]
-                    for a1 in agents_in_room:
-                        for a2 in agents_in_room:
-                            if a1 != a2: last_seen[a1][a2][moved_obj] = step
-            except (ValueError, IndexError): continue
+    for step, moved_obj, agents_in_room in witnessed_moves:
+        for a1 in agents_in_room:
+            for a2 in agents_in_room:
+                if a1 != a2: last_seen[a1][a2][moved_obj] = step
+    results = []
     for obj in objects:
-        actual = final_reality.obj_locs.get(obj)
         for ag1 in agents:
             for ag2 in agents:
                 if ag1 == ag2: continue
                 last_seen_step = last_seen[ag1][ag2].get(obj, -1)
                 if last_seen_step == -1: continue
-                ag1s_guess, ag2s_final_belief = snapshots[last_seen_step].belief_states[ag2].get(obj), final_belief_state.belief_states[ag2].get(obj)
+                ag1s_guess, ag2s_final_belief = history.belief(ag2, obj, last_seen_step), history.belief(ag2, obj)
                 if ag2s_final_belief is None or ag1s_guess is None: continue
-                q = f'Where does {ag1} think that {ag2} thinks the {obj} {verb_agree(obj, "is", "are")}?'
-                a = ag1s_guess
-                if ag1s_guess == ag2s_final_belief: true2_qa.append((q, a))
-                else: false2_qa.append((q, a))
-    def sample_one(qa_list):
-        if not qa_list: return []
-        q, a = random.choice(qa_list)
-        return [{"question": q, "answer": a}]
-    return {"instance_index": story.get("instance_index"), "setting": story.get("setting"), "full_story": story.get("full_story"), "memory_QA": sample_one(memory_qa), "reality_QA": sample_one(reality_qa), "true_belief1_QA": sample_one(true1_qa), "false_belief1_QA": sample_one(false1_qa), "true_belief2_QA": sample_one(true2_qa), "false_belief2_QA": sample_one(false2_qa)}
+                results.append((obj, ag1, ag2, ag1s_guess, ag1s_guess == ag2s_final_belief))
+    return results
+
+def second_order_beliefs_dense(history: BeliefHistory, agent_locs, obj_locs, cont_locs, witnessed_moves, agents, objects):
+    """second_order_beliefs と同じ結果を、last_seen [ag1, ag2, obj] と信念 [ステップ, ag, obj] の整数配列で計算する"""
+    A, O = len(agents), len(objects)
+    a_idx, o_idx = {ag: i for i, ag in enumerate(agents)}, {obj: j for j, obj in enumerate(objects)}
+    loc_idx = {}
+    agent_loc = np.array([loc_idx.setdefault(agent_locs[ag], len(loc_idx)) for ag in agents])
+    # 場所のないコンテナに入ったオブジェクトは -2 (どのエージェントとも同じ部屋にならない)
+    obj_room = np.array([loc_idx.setdefault(cont_locs[obj_locs[obj]], len(loc_idx)) if cont_locs.get(obj_locs[obj]) else -2 for obj in objects])
+    same_room = agent_loc[:, None] == agent_loc[None, :]
+    last_seen = np.where(same_room[:, :, None] & (agent_loc[:, None, None] == obj_room[None, None, :]), 0, -1)
+    for step, moved_obj, agents_in_room in witnessed_moves:
+        if moved_obj not in o_idx: continue
+        present = [a_idx[ag] for ag in agents_in_room if ag in a_idx]
+        last_seen[np.ix_(present, present, [o_idx[moved_obj]])] = step
+    beliefs, containers = history.dense(agents, objects)
+    # ag1 の推測 = last_seen の時点の ag2 の信念。ag2 の最終的な信念と比べる
+    guess = beliefs[np.maximum(last_seen, 0), np.arange(A)[None, :, None], np.arange(O)[None, None, :]]
+    final = beliefs[-1][None, :, :]
+    valid = (last_seen >= 0) & ~np.eye(A, dtype=bool)[:, :, None] & (guess >= 0) & (final >= 0)
+    # obj, ag1, ag2 の順 (second_order_beliefs と同じ順序) に並べる
+    o, a1, a2 = np.nonzero(valid.transpose(2, 0, 1))
+    g = guess[a1, a2, o]
+    is_true = g == final[0, a2, o]
+    return [(objects[j], agents[i], agents[k], containers[c], bool(t)) for j, i, k, c, t in zip(o.tolist(), a1.tolist(), a2.tolist(), g.tolist(), is_true.tolist())]
+
+def simulate_story(story: dict, parser: StoryParser):
+    """ストーリーのイベントを順に適用した履歴と、移動を見ていたエージェントの記録を作る。解析に失敗したら None"""
+    agent_locs, obj_locs, cont_locs, events = load_story_world(story, parser)
+
+    if not obj_locs or not agent_locs:
+        return None # 解析に失敗したストーリーはスキップ
+
+    # 状態はステップごとに複製せず、1つの履歴にイベントを順に適用する。移動を見ていたエージェントは適用直後の位置で決める
+    history, witnessed_moves = BeliefHistory(agent_locs, obj_locs, cont_locs), []
+    for step, ev in enumerate(events, 1):
+        history.apply(ev)
+        if ev and ev[0] == MOVE:
+            _, _, moved_obj, new_cont = ev
+            move_loc = cont_locs.get(new_cont)
+            if move_loc: witnessed_moves.append((step, moved_obj, [ag for ag, loc in history.agent_locations.items() if loc == move_loc]))
+    return history, witnessed_moves, agent_locs, obj_locs, cont_locs
+
+def iter_base_questions(world):
+    """記憶・現実・1次・2次の設問を (カテゴリ, 質問, 答え) として順に返す"""
+    history, witnessed_moves, agent_locs, obj_locs, cont_locs = world
+    final_obj_locs = history.object_locations
+    agents, objects = sorted(agent_locs.keys()), sorted(obj_locs.keys())
+    for obj in objects:
+        verb_was, verb_is = verb_agree(obj, "was", "were"), verb_agree(obj, "is", "are")
+        yield "memory_QA", f'Where {verb_was} the {obj} at the beginning?', obj_locs.get(obj, "unknown")
+        yield "reality_QA", f'Where {verb_is} the {obj} now?', final_obj_locs.get(obj, "unknown")
+    for ag in agents:
+        for obj in objects:
+            believed, actual = history.belief(ag, obj), final_obj_locs.get(obj)
+            if believed is None: continue
+            q = f'Where does {ag} think the {obj} {verb_agree(obj, "is", "are")}?'
+            yield ("true_belief1_QA" if believed == actual else "false_belief1_QA"), q, believed
+    second_order = second_order_beliefs_dense if np is not None and len(agents) ** 2 * len(objects) >= DENSE_MIN_CELLS else second_order_beliefs
+    for obj, ag1, ag2, ag1s_guess, is_true in second_order(history, agent_locs, obj_locs, cont_locs, witnessed_moves, agents, objects):
+        q = f'Where does {ag1} think that {ag2} thinks the {obj} {verb_agree(obj, "is", "are")}?'
+        yield ("true_belief2_QA" if is_true else "false_belief2_QA"), q, ag1s_guess
+
+def nested_question(obj, chain):
+    return f"Where does {chain[0]} think that " + " thinks that ".join(chain[1:]) + f" thinks the {obj} {verb_agree(obj, 'is', 'are')}?"
+
+def iter_story_questions(story: dict, parser: StoryParser):
+    """ストーリーの有効な設問をすべて (カテゴリ, 質問, 答え) として1つずつ返す (全列挙モード用)"""
+    world = simulate_story(story, parser)
+    if world is None: return
+    yield from iter_base_questions(world)
+    history, witnessed_moves, agent_locs, obj_locs, cont_locs = world
+    engine = NestedBeliefEngine(history, agent_locs, obj_locs, cont_locs, witnessed_moves, sorted(agent_locs.keys()))
+    for order in NESTED_ORDERS:
+        for obj, chain, guess, is_true in engine.iter_questions(sorted(obj_locs.keys()), order):
+            yield f"{'true' if is_true else 'false'}_belief{order}_QA", nested_question(obj, chain), guess
+
+def sample_one(qa_list, rng=random):
+    if not qa_list: return []
+    q, a = rng.choice(qa_list)
+    return [{"question": q, "answer": a}]
+
+def build_qa_for_story(story: dict, parser: StoryParser, rng=random):
+    world = simulate_story(story, parser)
+    if world is None: return None
+    qa_lists = defaultdict(list)
+    for category, q, a in iter_base_questions(world): qa_lists[category].append((q, a))
+    qa_set = {"instance_index": story.get("instance_index"), "setting": story.get("setting"), "full_story": story.get("full_story")}
+    qa_set.update((category, sample_one(qa_lists[category], rng)) for category in BASE_QA_CATEGORIES)
+    # 3次以上は全列挙せず、入れ子の信念エンジンで数えて1問ずつ選ぶ (既存のカテゴリの抽選が終わってから乱数を使う)
+    history, witnessed_moves, agent_locs, obj_locs, cont_locs = world
+    engine = NestedBeliefEngine(history, agent_locs, obj_locs, cont_locs, witnessed_moves, sorted(agent_locs.keys()))
+    for order in NESTED_ORDERS:
+        for kind in ("true", "false"):
+            picked = engine.sample(sorted(obj_locs.keys()), order, kind == "true", rng)
+            qa_set[f"{kind}_belief{order}_QA"] = [{"question": nested_question(obj, chain), "answer": guess} for obj, chain, guess in ([picked] if picked else [])]
+    return qa_set
+
+def question_id(key, question):
+    """ストーリーのキーと質問文から決まる設問 ID (何度作り直しても同じになる)"""
+    return f"{key}-{hashlib.sha1(question.encode('utf-8')).hexdigest()[:12]}"
+
+def sample_qa_sets(stories, question_records, master_seed):
+    """全列挙した設問のストリームから、カテゴリごとに1問ずつ選んだ QA セットを入力順に返す。
+    同じマスターシードなら build_qa_for_story と同じ問題を選ぶ (設問がないストーリーは None)"""
+    groups = groupby(question_records, key=lambda record: record["instance_index"])
+    current = next(groups, None)
+    for position, story in enumerate(stories):
+        key = story.get("instance_index", position)
+        if current is None or current[0] != key:
+            yield None
+            continue
+        qa_lists = defaultdict(list)
+        for record in current[1]: qa_lists[record["category"]].append((record["question"], record["answer"]))
+        current = next(groups, None)
+        rng = random.Random(derive_seed(master_seed, key))
+        qa_set = {"instance_index": story.get("instance_index"), "setting": story.get("setting"), "full_story": story.get("full_story")}
+        qa_set.update((category, sample_one(qa_lists[category], rng)) for category in QA_CATEGORIES)
+        yield qa_set
+
+def build_qa_chunk(job):
+    """ワーカー用: ストーリーのまとまりから QA を作る。乱数はストーリーごとに instance_index から導出するので、ワーカー数に依存しない"""
+    stories, parser, master_seed, start = job
+    return [build_qa_for_story(st, parser, random.Random(derive_seed(master_seed, st.get("instance_index", start + i)))) for i, st in enumerate(stories)]
+
+def write_question_chunk(job):
+    """ワーカー用: ストーリーのまとまりの全設問を1行1問の JSONL で path に書き、(path, ストーリー数, カテゴリごとの設問数) を返す"""
+    stories, parser, start, path = job
+    counts = Counter()
+    with path.open("w", encoding="utf-8") as f:
+        for i, st in enumerate(stories):
+            key = st.get("instance_index", start + i)
+            for category, question, answer in iter_story_questions(st, parser):
+                f.write(json.dumps({"instance_index": key, "category": category, "question_id": question_id(key, question), "question": question, "answer": answer}, ensure_ascii=False) + "\n")
+                counts[category] += 1
+    return path, len(stories), counts
+
+def ordered_map(executor, fn, jobs, window):
+    """executor.map と同じく入力順に結果を返すが、同時に投入するのは window 件までにする (入力を一度に読み込まない)"""
+    pending = deque()
+    for job in jobs:
+        pending.append(executor.submit(fn, job))
+        if len(pending) >= window: yield pending.popleft().result()
+    while pending: yield pending.popleft().result()
 
 # ---------------------------------------------------------------------------
 # 6. メイン実行部
 # ---------------------------------------------------------------------------
+def parse_args():
+    parser = argparse.ArgumentParser(description="stories.json から心の理論の課題 (QA) を作る")
+    parser.add_argument("--workers", type=int, default=1, help="ストーリーを分散するプロセス数 (1 なら単一プロセス)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="1回にワーカーへ渡すストーリー数")
+    parser.add_argument("--seed", type=int, default=None, help="マスターシード。各ストーリーの乱数は (マスターシード, instance_index) から導出する (省略時はランダムに決めて表示する)")
+    parser.add_argument("--stories", type=Path, default=STORIES_IN_PATH, help="入力のストーリー (JSON 配列または JSONL。.gz / .bz2 / .xz の圧縮も可)")
+    parser.add_argument("--qa-out", type=Path, default=QA_OUT_PATH, help="QA セットの出力 (.jsonl / .jsonl.gz なら1行1ストーリーの JSONL)")
+    parser.add_argument("--questions", type=Path, default=QA_ALL_OUT_PATH, help="全列挙モードの出力、--from-exhaustive の入力 (.gz などの圧縮も可)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--exhaustive", action="store_true", help="各カテゴリ1問ではなく、有効な設問をすべて --questions に書き出す")
+    mode.add_argument("--from-exhaustive", action="store_true", help="--questions からカテゴリごとに1問ずつ選んで --qa-out を作る (同じ --seed なら通常モードと同じ問題を選ぶ)")
+    return parser.parse_args()
+
+def write_qa_sets(qa_sets, path: Path = None):
+    """QA セットを入力順に受け取り、その場で1件ずつ書き出す (path が None なら数えるだけ)。(ストーリー数, 書き出した件数, カテゴリごとの件数) を返す"""
+    n_stories, n_qa_sets, qa_counts = 0, 0, Counter()
+    writer = RecordWriter(path) if path else None
+    for qa_set in qa_sets:
+        n_stories += 1
+        if not qa_set: continue # 解析に失敗したストーリー (None) は出力しない
+        if writer: writer.write(qa_set)
+        n_qa_sets += 1
+        for category in QA_CATEGORIES:
+            if qa_set.get(category): qa_counts[category] += 1
+    if writer: writer.close()
+    return n_stories, n_qa_sets, qa_counts
+
+def build_qa_sets(chunks, parser: StoryParser, master_seed, executor=None, chunk_size=CHUNK_SIZE, workers=1):
+    """(番号, ストーリーのまとまり) の列から QA セットを入力順に1つずつ返す。結果はチャンクごとに受け取り、読み終えたら捨てる"""
+    jobs = ((chunk, parser, master_seed, i * chunk_size) for i, chunk in chunks)
+    for chunk_result in (ordered_map(executor, build_qa_chunk, jobs, 2 * workers) if executor else map(build_qa_chunk, jobs)):
+        yield from chunk_result
+
+def print_qa_summary(n_stories, qa_counts):
+    print("\n--- 課題生成サマリー ---")
+    print(f"処理したストーリーの総数: {n_stories}件")
+    print("各課題タイプについて生成された設問数:")
+    for category, count in sorted(qa_counts.items()):
+        print(f"  - {category:<20}: {count}問")
+
 def main():
+    args = parse_args()
+    master_seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2**32)
+    print(f"Master seed: {master_seed} / workers: {args.workers} / chunk size: {args.chunk_size}")
     try:
-        stories = json.loads(STORIES_IN_PATH.read_text(encoding="utf-8"))
-        world_data = json.loads(WORLD_PATH.read_text(encoding="utf-8"))
-        locations = set(world_data.get("locations", []))
+        parser = StoryParser.load(WORLD_PATH)
+        for path in [args.stories] + ([args.questions] if args.from_exhaustive else []):
+            if not path.exists(): raise FileNotFoundError(path)
     except FileNotFoundError as e:
         print(f"エラー: 入力ファイルが見つかりません。 ({e})")
         return
-        
-    qa_sets, qa_counts = [], Counter()
-    qa_categories = ["memory_QA", "reality_QA", "true_belief1_QA", "false_belief1_QA", "true_belief2_QA", "false_belief2_QA"]
-    for st in stories:
-        qa_set = build_qa_for_story(st, locations)
-        if qa_set: # Noneでない場合のみ追加
-            qa_sets.append(qa_set)
-            for category in qa_categories:
-                if qa_set.get(category): qa_counts[category] += 1
-    
-    QA_OUT_PATH.write_text(json.dumps(qa_sets, ensure_ascii=False, indent=2), encoding="utf-8")
-    print(f"✅ {len(qa_sets)}件のストーリーから課題を生成し、{QA_OUT_PATH} に保存しました。")
-    print("\n--- 課題生成サマリー ---")
-    print(f"処理したストーリーの総数: {len(stories)}件")
-    print("各課題タイプについて生成された設問数:")
-    for category, count in sorted(qa_counts.items()):
-        print(f"  - {category:<20}: {count}問")
+    stories = iter_records(args.stories)
+
+    chunks = enumerate(chunked(stories, args.chunk_size))
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 and not args.from_exhaustive else None
+    if args.exhaustive:
+        # ワーカーはチャンクごとに一時ファイルへ書き、入力順に連結する (設問はメモリにためない)
+        jobs = ((chunk, parser, i * args.chunk_size, args.questions.with_name(f"{args.questions.name}.part{i}")) for i, chunk in chunks)
+        n_stories, qa_counts = 0, Counter()
+        with open_text(args.questions, "w") as out:
+            for part_path, n_chunk_stories, counts in (ordered_map(executor, write_question_chunk, jobs, 2 * args.workers) if executor else map(write_question_chunk, jobs)):
+                with part_path.open(encoding="utf-8") as part: shutil.copyfileobj(part, out)
+                part_path.unlink()
+                n_stories, qa_counts = n_stories + n_chunk_stories, qa_counts + counts
+        if executor: executor.shutdown()
+        print(f"✅ {n_stories}件のストーリーから {sum(qa_counts.values())}問を生成し、{args.questions} に保存しました。")
+    else:
+        if args.from_exhaustive:
+            qa_sets = sample_qa_sets(stories, iter_records(args.questions), master_seed)
+        else:
+            qa_sets = build_qa_sets(chunks, parser, master_seed, executor, args.chunk_size, args.workers)
+        n_stories, n_qa_sets, qa_counts = write_qa_sets(qa_sets, args.qa_out)
+        if executor: executor.shutdown()
+        print(f"✅ {n_qa_sets}件のストーリーから課題を生成し、{args.qa_out} に保存しました。")
+    print_qa_summary(n_stories, qa_counts)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
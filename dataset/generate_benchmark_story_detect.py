@@ -1,9 +1,22 @@
+import argparse
+import hashlib
+import heapq
 import json
 import random
 import re
+import time
 from collections import defaultdict, Counter
-from copy import deepcopy
-from itertools import permutations
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate, chain, groupby, product
+from math import comb
+
+from artifacts import RecordWriter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # --sampler batch でのみ必要
 
 # ---------------------------------------------------------------------------
 # 1. 設定とグローバル変数
@@ -11,6 +24,14 @@ from itertools import permutations
 WORLD_PATH = "world.json"
 STORIES_JSON_PATH = "stories.json"
 DISTRIBUTION_JSON_PATH = "distribution_analysis.json"
+STORY_SPACE_JSON_PATH = "story_space_counts.json"
+TELEMETRY_JSON_PATH = "generation_telemetry.json"
+PRUNE_HORIZON, PRUNE_MEMO_LIMIT = 4, 500000  # 枝刈りで厳密判定する残りステップ数の上限と、メモの最大件数
+PRUNE_SEARCH_BUDGET = 5000000  # 厳密判定で辿りうる行動列の数 (move の候補数 ** 残りステップ数) の上限。大きな設定では判定する残りステップを減らす
+# 構造 (エージェントの分割 x コンテナの分割) の数がこれを超える設定は列挙せずに一様に引き、
+# 場所数がこれを超える分割は相異なる並びの表を作らずにシャッフルする
+STRUCTURE_ENUM_LIMIT, PERMUTATION_TABLE_MAX_LOCATIONS = 200000, 6
+TIMING_SAMPLE_EVERY = 64  # 1件ずつの試行は、この回数に1回だけ段階ごとの所要時間を計る (計時そのものが試行を遅くしないように)
 try:
     with open(WORLD_PATH, "r") as f: world = json.load(f)
 except FileNotFoundError:
@@ -20,68 +41,170 @@ except FileNotFoundError:
 # ---------------------------------------------------------------------------
 # 2. 状態表現とシミュレーションのためのクラス
 # ---------------------------------------------------------------------------
+MOVE, EXIT_ENTER = "move", "exit_enter"
+
+@lru_cache(maxsize=None)
+def _exit_actions(n_agents, n_locations):
+    """exit/enter の行動の表。[エージェント][今いる場所] -> 他の場所へ移る行動のタプル (ステップごとに行動を作り直さない)"""
+    return tuple(tuple(tuple((EXIT_ENTER, ag, loc, new_loc) for new_loc in range(n_locations) if new_loc != loc) for loc in range(n_locations)) for ag in range(n_agents))
+
 class WorldState:
+    """整数インデックスで保持する状態。apply() はその場で更新し、revert() 用の取り消しトークンを返す
+
+    信念が現実と食い違う (エージェント, オブジェクト) の組は false_beliefs に常に保持し、行動のたびに影響を受ける組だけを更新する。
+    believers[obj][cont] は obj が cont にあると信じているエージェントの集合。
+    """
+    __slots__ = ("agents", "objects", "containers", "locations", "agent_loc", "obj_cont", "cont_loc", "conts_at", "agents_at", "belief", "believers", "false_beliefs", "exits")
+
     def __init__(self, agent_locs, obj_locs, cont_locs):
-        self.agent_locations = agent_locs
-        self.object_locations = obj_locs
-        self.container_locations = cont_locs
+        self.agents, self.objects, self.containers = list(agent_locs), list(obj_locs), list(cont_locs)
         self.locations = list(sorted(set(agent_locs.values()) | set(cont_locs.values())))
-        self.belief_states = {}
-        for agent in agent_locs.keys():
-            self.belief_states[agent] = {obj: None for obj in obj_locs.keys()}
-    
+        loc_index = {loc: i for i, loc in enumerate(self.locations)}
+        cont_index = {cont: i for i, cont in enumerate(self.containers)}
+        self.agent_loc = [loc_index[agent_locs[ag]] for ag in self.agents]
+        self.obj_cont = [cont_index[obj_locs[obj]] for obj in self.objects]
+        self.cont_loc = [loc_index[cont_locs[cont]] for cont in self.containers]
+        self.conts_at = [[c for c, l in enumerate(self.cont_loc) if l == loc] for loc in range(len(self.locations))]
+        self.agents_at = [{a for a, l in enumerate(self.agent_loc) if l == loc} for loc in range(len(self.locations))]
+        self.belief = [[None] * len(self.objects) for _ in self.agents]
+        self.believers = [[set() for _ in self.containers] for _ in self.objects]
+        self.false_beliefs = set()
+        self.exits = _exit_actions(len(self.agents), len(self.locations))
+
+    def observe_initial_objects(self):
+        """同じ部屋にあるオブジェクトについて、各エージェントの初期信念を設定する (初期信念はすべて正しい)"""
+        for ag, ag_loc in enumerate(self.agent_loc):
+            for obj, cont in enumerate(self.obj_cont):
+                if self.cont_loc[cont] == ag_loc:
+                    self.belief[ag][obj] = cont
+                    self.believers[obj][cont].add(ag)
+
     def get_possible_moves(self):
         possible_actions = []
-        agents, objects = list(self.agent_locations.keys()), list(self.object_locations.keys())
-        for ag in agents:
-            ag_loc = self.agent_locations.get(ag)
-            if ag_loc == "unknown": continue
-            for obj in objects:
-                believed_cont = self.belief_states[ag].get(obj)
-                actual_cont = self.object_locations.get(obj)
-                if believed_cont != actual_cont: continue
-                if self.container_locations.get(actual_cont) != ag_loc: continue
-                possible_targets = [c for c, l in self.container_locations.items() if l == ag_loc and c != actual_cont]
-                for target in possible_targets:
-                    possible_actions.append({'type': 'move', 'agent': ag, 'object': obj, 'target': target})
+        for ag, ag_loc in enumerate(self.agent_loc):
+            beliefs = self.belief[ag]
+            for obj, actual_cont in enumerate(self.obj_cont):
+                if beliefs[obj] != actual_cont or self.cont_loc[actual_cont] != ag_loc: continue
+                for target in self.conts_at[ag_loc]:
+                    if target != actual_cont: possible_actions.append((MOVE, ag, obj, target))
         return possible_actions
 
+    def has_possible_move(self):
+        for ag, ag_loc in enumerate(self.agent_loc):
+            if len(self.conts_at[ag_loc]) < 2: continue
+            beliefs = self.belief[ag]
+            for obj, actual_cont in enumerate(self.obj_cont):
+                if beliefs[obj] == actual_cont and self.cont_loc[actual_cont] == ag_loc: return True
+        return False
+
     def get_possible_exits(self):
-        possible_actions = []
-        agents, locations = list(self.agent_locations.keys()), self.locations
-        for ag in agents:
-            current_loc = self.agent_locations.get(ag)
-            other_locs = [loc for loc in locations if loc != current_loc]
-            for new_loc in other_locs:
-                possible_actions.append({'type': 'exit_enter', 'agent': ag, 'from': current_loc, 'to': new_loc})
-        return possible_actions
+        # 順序は (エージェント, 移り先の場所) の順で、乱数の消費を変えないように並べ替えない
+        return list(chain.from_iterable(map(tuple.__getitem__, self.exits, self.agent_loc)))
+
+    def apply(self, action):
+        """行動をその場で適用し、revert() に渡す取り消しトークンを返す
+
+        トークンの最後の要素は誤信念インデックスの変化 [((agent, obj), 誤信念になったか), ...]。
+        exit/enter は信念もオブジェクトも変えないので、変化は常に空になる。
+        """
+        if action[0] == MOVE:
+            _, agent, obj, target_cont = action
+            prev_cont, believers, fb = self.obj_cont[obj], self.believers[obj], self.false_beliefs
+            self.obj_cont[obj] = target_cont
+            witnesses = []
+            for a in self.agents_at[self.agent_loc[agent]]:
+                old = self.belief[a][obj]
+                witnesses.append((a, old))
+                if old is not None: believers[old].discard(a)
+                believers[target_cont].add(a)
+                self.belief[a][obj] = target_cont
+            # target_cont を信じていた者は正しくなり、prev_cont を信じたままの (見ていない) 者は誤信念になる
+            changes = [((a, obj), False) for a in believers[target_cont] if (a, obj) in fb]
+            changes += [((a, obj), True) for a in believers[prev_cont]]
+            for pair, became_false in changes:
+                if became_false: fb.add(pair)
+                else: fb.discard(pair)
+            return (action, prev_cont, witnesses, changes)
+        _, agent, from_loc, to_loc = action
+        self.agent_loc[agent] = to_loc
+        self.agents_at[from_loc].discard(agent); self.agents_at[to_loc].add(agent)
+        return (action, from_loc, None, ())
+
+    def revert(self, token):
+        action, prev, witnesses, changes = token
+        if action[0] == MOVE:
+            obj, target_cont = action[2], action[3]
+            self.obj_cont[obj] = prev
+            for pair, became_false in changes:
+                if became_false: self.false_beliefs.discard(pair)
+                else: self.false_beliefs.add(pair)
+            believers = self.believers[obj]
+            for a, prev_belief in witnesses:
+                self.belief[a][obj] = prev_belief
+                believers[target_cont].discard(a)
+                if prev_belief is not None: believers[prev_belief].add(a)
+        else:
+            agent, to_loc = action[1], action[3]
+            self.agent_loc[agent] = prev
+            self.agents_at[to_loc].discard(agent); self.agents_at[prev].add(agent)
+
+    def has_false_belief(self):
+        return bool(self.false_beliefs)
+
+    def canonical_key(self):
+        """場所の付け替えとエージェントの並べ替えに対して不変な状態キー。全列挙のメモ化に使う"""
+        relabel = {}
+        for loc in self.cont_loc + self.agent_loc: relabel.setdefault(loc, len(relabel))
+        agents = tuple(sorted((relabel[loc], tuple(-1 if b is None else b for b in beliefs)) for loc, beliefs in zip(self.agent_loc, self.belief)))
+        return (len(self.locations), agents, tuple(relabel[l] for l in self.cont_loc), tuple(self.obj_cont))
+
+    def named_action(self, action):
+        """行動の番号を名前に置き換える。例: (move, 0, 2, 1) -> ("move", "Emma", "apple", "basket")"""
+        if action[0] == MOVE: return (MOVE, self.agents[action[1]], self.objects[action[2]], self.containers[action[3]])
+        return (EXIT_ENTER, self.agents[action[1]], self.locations[action[2]], self.locations[action[3]])
+
+    def describe_action(self, action):
+        if action[0] == MOVE:
+            _, agent, obj, target_cont = action
+            return f"{self.agents[agent]} moved the {self.objects[obj]} to the {self.containers[target_cont]}."
+        _, agent, from_loc, to_loc = action
+        return f"{self.agents[agent]} exited {self.locations[from_loc]} and entered {self.locations[to_loc]}."
 
 # ---------------------------------------------------------------------------
 # 3. 誤信念検知とイベント適用ロジック
 # ---------------------------------------------------------------------------
 def detect_false_belief(state: WorldState):
     fb_list = []
-    for agent, beliefs in state.belief_states.items():
-        for obj, believed_cont in beliefs.items():
-            actual_cont = state.object_locations.get(obj)
-            if believed_cont is not None and believed_cont != actual_cont:
-                fb_list.append({"agent": agent, "object": obj, "believed_in": believed_cont, "actually_in": actual_cont})
+    for agent, obj in sorted(state.false_beliefs):
+        fb_list.append({"agent": state.agents[agent], "object": state.objects[obj], "believed_in": state.containers[state.belief[agent][obj]], "actually_in": state.containers[state.obj_cont[obj]]})
     return fb_list
 
-def apply_action_and_update_beliefs(state: WorldState, action: dict):
-    new_state = deepcopy(state)
-    agent = action['agent']
-    if action['type'] == 'move':
-        obj, target_cont = action['object'], action['target']
-        new_state.object_locations[obj] = target_cont
-        mover_loc = new_state.agent_locations[agent]
-        for a, loc in new_state.agent_locations.items():
-            if loc == mover_loc:
-                new_state.belief_states[a][obj] = target_cont
-    elif action['type'] == 'exit_enter':
-        new_loc = action['to']
-        new_state.agent_locations[agent] = new_loc
-    return new_state
+class BeliefPersistenceRecorder:
+    """誤信念インデックスの変化から持続区間を記録する。結果は analyze_belief_persistence(simulation_log) と同じ"""
+
+    def __init__(self, state: WorldState):
+        self.state, self.active, self.completed, self.order = state, {}, [], 0
+
+    def record(self, step, changes):
+        resolved = []
+        for pair, became_false in sorted(changes):
+            if became_false:
+                agent, obj = pair
+                self.active[pair] = (self.order, {"agent": self.state.agents[agent], "object": self.state.objects[obj], "start_step": step, "end_step": None})
+                self.order += 1
+            else:
+                resolved.append(self.active.pop(pair))
+        for _, fb_info in sorted(resolved, key=lambda item: item[0]):
+            fb_info['end_step'] = step
+            self.completed.append(fb_info)
+
+    def result(self):
+        completed_fbs = list(self.completed)
+        for _, fb_info in self.active.values():
+            completed_fbs.append(dict(fb_info, end_step="unresolved"))
+        for fb in completed_fbs:
+            fb['duration_steps'] = (fb['end_step'] - fb['start_step']) if isinstance(fb['end_step'], int) else "N/A"
+        return completed_fbs
 
 def analyze_belief_persistence(simulation_log):
     active_fbs, completed_fbs = {}, []
@@ -106,148 +229,1137 @@ def analyze_belief_persistence(simulation_log):
         fb['duration_steps'] = (fb['end_step'] - fb['start_step']) if isinstance(fb['end_step'], int) else "N/A"
     return completed_fbs
 
+@lru_cache(maxsize=None)
+def _unique_permutations(partition):
+    """重複を含む並びの相異なる順列を辞書順に直接作る (全順列を作ってから重複を除くと、場所数が増えると爆発する)"""
+    items = sorted(partition)
+    perms = [tuple(items)]
+    while True:
+        # 次の辞書順の順列: 右から見て最初に増やせる位置 i を、右側でそれより大きい最小の値と入れ替え、右側を反転する
+        i = len(items) - 2
+        while i >= 0 and items[i] >= items[i + 1]: i -= 1
+        if i < 0: return perms
+        j = len(items) - 1
+        while items[j] <= items[i]: j -= 1
+        items[i], items[j] = items[j], items[i]
+        items[i + 1:] = items[:i:-1]
+        perms.append(tuple(items))
+
 def get_unique_permutations(partition):
-    return sorted(list(set(permutations(partition))))
+    # 同じ構造は何度も引かれるので、順列の列挙結果をキャッシュする
+    return _unique_permutations(tuple(partition))
 
-# ---------------------------------------------------------------------------
-# 4. ストーリーとイベントの生成 (★修正箇所)
-# ---------------------------------------------------------------------------
-def create_story_with_fb_detection(structure, k_agents, k_objects, k_containers, k_locations=3, target_action_plan=None):
-    if len(world["agents"]) < k_agents or len(world["objects"]) < k_objects or \
-       len(world["containers"]) < k_containers or len(world["locations"]) < k_locations:
-        return None
-    agents, objects = random.sample(world["agents"], k_agents), random.sample(world["objects"], k_objects)
-    containers, locations = random.sample(world["containers"], k_containers), random.sample(world["locations"], k_locations)
-    agent_locs, obj_locs, cont_locs = {}, {}, {}
-    la_partition, lc_partition = structure["la_partition"], structure["lc_partition"]
-    la_perm = random.choice(get_unique_permutations(la_partition))
-    lc_perm = random.choice(get_unique_permutations(lc_partition))
-    la_iter, lc_iter = iter(agents), iter(containers)
-    for i, count in enumerate(la_perm):
-        for _ in range(count): agent_locs[next(la_iter)] = locations[i]
-    for i, count in enumerate(lc_perm):
-        for _ in range(count): cont_locs[next(lc_iter)] = locations[i]
-    for obj in objects:
-        obj_locs[obj] = random.choice(containers)
+def random_arrangement(partition, rng=random):
+    """分割の相異なる並びから一様に1つ選ぶ。多重集合のシャッフルは相異なる並びについて一様なので、場所が多いときは表を作らない"""
+    if len(partition) <= PERMUTATION_TABLE_MAX_LOCATIONS: return rng.choice(get_unique_permutations(partition))
+    arrangement = list(partition)
+    rng.shuffle(arrangement)
+    return tuple(arrangement)
 
-    initial_state_obj = WorldState(agent_locs, obj_locs, cont_locs)
-    
-    # ▼▼▼ 修正箇所: 初期状態の文章生成と信念設定のロジック ▼▼▼
+def describe_initial_state(agent_locs, obj_locs, cont_locs, locations):
     initial_sentences = []
     # 1. エージェントとコンテナの位置を記述
-    for agent, loc in initial_state_obj.agent_locations.items():
+    for agent, loc in agent_locs.items():
         initial_sentences.append(f"{agent} was in the {loc}.")
-    for container, loc in initial_state_obj.container_locations.items():
+    for container, loc in cont_locs.items():
         initial_sentences.append(f"The {container} was in the {loc}.")
 
-    # 2. オブジェクトの位置を静的に記述し、同時に初期信念を設定
+    # 2. オブジェクトの位置を静的に記述
     obj_by_cont = defaultdict(list)
-    for obj, cont in initial_state_obj.object_locations.items(): 
+    for obj, cont in obj_locs.items(): 
         obj_by_cont[cont].append(obj)
-        # このオブジェクトと同じ部屋にいるエージェントの信念を更新
-        container_loc = initial_state_obj.container_locations.get(cont)
-        for agent, agent_loc in initial_state_obj.agent_locations.items():
-            if agent_loc == container_loc:
-                initial_state_obj.belief_states[agent][obj] = cont
-                
     for cont, objs in obj_by_cont.items():
         obj_str = " and ".join(sorted(objs))
         verb = "were" if len(objs) > 1 or any(s.endswith('s') for s in objs) else "was"
         initial_sentences.append(f"The {obj_str} {verb} in the {cont}.")
     
     # 3. 空の部屋について言及
-    occupied_locations = set(initial_state_obj.agent_locations.values()) | set(initial_state_obj.container_locations.values())
+    occupied_locations = set(agent_locs.values()) | set(cont_locs.values())
     empty_locations = set(locations) - occupied_locations
     for loc in sorted(list(empty_locations)):
         initial_sentences.append(f"No one was in the {loc}.")
+    return initial_sentences
+
+def layout_pattern(agent_locs, obj_locs, cont_locs, k_locations):
+    """初期配置を analyze_patterns.py と同じ (エージェント分布のカテゴリ, 部屋ごとのパターン) にする。例: ("AA/A/", "A/ACO/ACCOO")"""
+    counts = defaultdict(lambda: {"A": 0, "C": 0, "O": 0})
+    for loc in agent_locs.values(): counts[loc]["A"] += 1
+    for loc in cont_locs.values(): counts[loc]["C"] += 1
+    for cont in obj_locs.values(): counts[cont_locs[cont]]["O"] += 1
+    parts = ["A" * c["A"] + "C" * c["C"] + "O" * c["O"] for c in counts.values()]
+    parts += [""] * (k_locations - len(parts))
+    return agent_category([c["A"] for c in counts.values()], k_locations), "/".join(sorted(parts))
+
+def agent_category(agent_counts, k_locations):
+    agent_dist = sorted((n for n in agent_counts if n > 0), reverse=True)
+    return "/".join(["A" * n for n in agent_dist] + [""] * (k_locations - len(agent_dist)))
+
+def pattern_rooms(pattern):
+    """部屋のパターン ("A/ACO/ACCOO") を部屋ごとの (エージェント, コンテナ, オブジェクト) の数のリストにする。読めなければ None"""
+    matches = [ROOM_PATTERN.fullmatch(part) for part in pattern.split("/")]
+    if not all(matches): return None
+    return [tuple(len(group) for group in match.groups()) for match in matches]
 
-    current_state = initial_state_obj
+# ---------------------------------------------------------------------------
+# 4. ストーリーとイベントの生成 (★修正箇所)
+# ---------------------------------------------------------------------------
+def layout_initial_state(agents, objects, containers, locations, la_perm, lc_perm, obj_containers):
+    """部屋ごとの人数・コンテナ数の並びとオブジェクトの置き場所から、位置の辞書を作る"""
+    agent_locs, obj_locs, cont_locs = {}, {}, {}
+    la_iter, lc_iter = iter(agents), iter(containers)
+    for i, count in enumerate(la_perm):
+        for _ in range(count): agent_locs[next(la_iter)] = locations[i]
+    for i, count in enumerate(lc_perm):
+        for _ in range(count): cont_locs[next(lc_iter)] = locations[i]
+    for obj, cont in zip(objects, obj_containers):
+        obj_locs[obj] = cont
+    return agent_locs, obj_locs, cont_locs
+
+def apply_and_log(state: WorldState, action, step, recorder=None):
+    """行動を適用し、simulation_log の1ステップ分の記録を返す。recorder があれば誤信念の持続区間も更新する"""
+    event_sentence = state.describe_action(action)
+    token = state.apply(action)
+    if recorder: recorder.record(step, token[-1])
+    return {"step": step, "action_type": action[0], "event": event_sentence, "false_beliefs_found": detect_false_belief(state)}
+
+def finish_story(agent_locs, obj_locs, cont_locs, locations, simulation_log, recorder, actions):
+    """シミュレーションを終えた試行の記録。誤信念の判定に要らない文章化と初期配置のパターンは describe_story で後から足す"""
+    has_false_belief_occurred = any(log['false_beliefs_found'] for log in simulation_log)
+    return {"simulation_log": simulation_log, "has_false_belief": has_false_belief_occurred, "action_sequence": [log['action_type'] for log in simulation_log], "story_record": story_record(agent_locs, obj_locs, cont_locs, locations, actions), "false_belief_persistence": recorder.result()}
+
+def describe_story(story_data):
+    """採用を検討するストーリーに、初期状態の文章・全文と初期配置の (カテゴリ, パターン) を story_record から足す"""
+    record = story_data["story_record"]
+    agent_locs, obj_locs, cont_locs, locations = record["agents"], record["objects"], record["containers"], record["locations"]
+    story_data["initial_state_sentences"] = describe_initial_state(agent_locs, obj_locs, cont_locs, locations)
+    story_data["full_story"] = story_data["initial_state_sentences"] + [log['event'] for log in story_data["simulation_log"]]
+    story_data["category"], story_data["pattern"] = layout_pattern(agent_locs, obj_locs, cont_locs, len(locations))
+    return story_data
+
+def story_record(agent_locs, obj_locs, cont_locs, locations, actions):
+    """full_story と同じ内容の機械可読な記録。create_test.py は文章を解析せずにこれを読む
+
+    events は [move, エージェント, オブジェクト, 移動先のコンテナ] か [exit_enter, エージェント, 出た場所, 入った場所]。
+    """
+    return {"agents": dict(agent_locs), "objects": dict(obj_locs), "containers": dict(cont_locs), "locations": list(locations), "events": [list(action) for action in actions]}
+
+def story_shape(agent_locs, obj_locs, cont_locs, locations, actions):
+    """エージェント・オブジェクト・コンテナ・場所の名前を付け替えても変わらない、ストーリーの標準形。
+
+    イベントに出てくる対象には登場順に番号を付け、番号の付いたオブジェクトのコンテナ、番号の付いたコンテナと
+    エージェントの場所にも順に番号を付ける。残りの対象は区別できないので、どこに何個あるかだけを残す。
+    信念の推移は初期状態と行動列で決まるので、これが同じストーリーは信念の推移も同じになる。
+    """
+    labels = {"A": {}, "O": {}, "C": {}, "L": {}}
+    def label(kind, name): return labels[kind].setdefault(name, len(labels[kind]))
+    events = []
+    for action_type, agent, x, y in actions:
+        events.append((action_type, label("A", agent)) + ((label("O", x), label("C", y)) if action_type == MOVE else (label("L", x), label("L", y))))
+    for obj in list(labels["O"]): label("C", obj_locs[obj])
+    for cont in list(labels["C"]): label("L", cont_locs[cont])
+    for agent in list(labels["A"]): label("L", agent_locs[agent])
+    # 番号の付いていない対象は、場所ごとの (エージェント数, コンテナごとのオブジェクト数) とコンテナごとのオブジェクト数で表す
+    free_objects = Counter(cont for obj, cont in obj_locs.items() if obj not in labels["O"])
+    free_agents = Counter(loc for agent, loc in agent_locs.items() if agent not in labels["A"])
+    free_conts = defaultdict(list)
+    for cont, loc in cont_locs.items():
+        if cont not in labels["C"]: free_conts[loc].append(free_objects[cont])
+    rest = {loc: (free_agents[loc], tuple(sorted(free_conts[loc]))) for loc in locations}
+    return (tuple(events),
+            tuple(labels["L"][agent_locs[a]] for a in labels["A"]), tuple(labels["C"][obj_locs[o]] for o in labels["O"]), tuple(labels["L"][cont_locs[c]] for c in labels["C"]),
+            tuple(rest[loc] for loc in labels["L"]), tuple(free_objects[c] for c in labels["C"]), tuple(sorted(rest[loc] for loc in locations if loc not in labels["L"])))
+
+def shape_hash(shape):
+    return hashlib.sha256(repr(shape).encode("utf-8")).hexdigest()[:16]
+
+def record_shape(record):
+    """story_record からストーリーの形のハッシュを求める。形は重複の判定と出力にしか使わないので、採用したストーリーについてだけ求める"""
+    return shape_hash(story_shape(record["agents"], record["objects"], record["containers"], record["locations"], record["events"]))
+
+def structure_key(la_partition, lc_partition):
+    """構造を集計のキーにする。例: la=[1, 2, 0], lc=[0, 3, 0] -> A1-2-0|C0-3-0"""
+    return "A" + "-".join(map(str, la_partition)) + "|C" + "-".join(map(str, lc_partition))
+
+class GenerationTelemetry:
+    """試行ごとの結果 (採用か棄却理由か) と、段階ごとの所要時間を集計する。
+
+    試行は (イベント順序, 構造) ごとに数え、棄却理由は (理由, ステップ) ごとに数える (ステップに依らない理由は None)。
+    所要時間はイベント順序ごとに setup / lookahead / simulation / persistence の4段階に分ける。
+    1件ずつの試行は TIMING_SAMPLE_EVERY 回に1回だけ計り、report では計った回数の割合で全体に引き伸ばす。
+    """
+    STAGES = ("setup", "lookahead", "simulation", "persistence")
+
+    def __init__(self):
+        self.attempts, self.accepted, self.rejections = Counter(), Counter(), Counter()
+        self.seconds, self.begins, self.timed_begins = defaultdict(Counter), Counter(), Counter()
+        self.key, self.clock, self.timed = (None, None), time.perf_counter(), True
+
+    def begin(self, sequence, structure, attempts=1):
+        """試行 (バッチなら attempts 件) を始め、計る回なら段階の計時をリセットする"""
+        self.key = (sequence, structure)
+        if attempts: self.attempts[self.key] += attempts
+        self.begins[sequence] += 1
+        # バッチや準備 (attempts != 1) は1回が重いので毎回計る
+        self.timed = attempts != 1 or self.begins[sequence] % TIMING_SAMPLE_EVERY == 1
+        if self.timed:
+            self.timed_begins[sequence] += 1
+            self.clock = time.perf_counter()
+
+    def lap(self, stage):
+        if not self.timed: return
+        now = time.perf_counter()
+        self.seconds[self.key[0]][stage] += now - self.clock
+        self.clock = now
+
+    def reject(self, reason, step=None, count=1, key=None):
+        self.rejections[(key or self.key) + (reason, step)] += count
+
+    def accept(self, key=None):
+        self.accepted[key or self.key] += 1
+
+    def merge(self, other):
+        self.attempts.update(other.attempts); self.accepted.update(other.accepted); self.rejections.update(other.rejections)
+        self.begins.update(other.begins); self.timed_begins.update(other.timed_begins)
+        for sequence, seconds in other.seconds.items(): self.seconds[sequence].update(seconds)
+
+    def report(self):
+        """イベント順序 -> {試行数, 採用数, 1件あたりの試行数, 棄却理由, 所要時間, 構造別の内訳} の辞書"""
+        # 棄却は (イベント順序, 構造) ごとにまとめておく (構造が数万ある設定でも、内訳ごとに全件を走査しない)
+        rejections_by_key = defaultdict(list)
+        for (sequence, structure, reason, step), count in self.rejections.items(): rejections_by_key[(sequence, structure)].append((reason, step, count))
+
+        def summarize(keys):
+            attempts, accepted = sum(self.attempts[k] for k in keys), sum(self.accepted[k] for k in keys)
+            rejections = defaultdict(lambda: {"total": 0, "by_step": {}})
+            for reason, step, count in sorted((r for k in keys for r in rejections_by_key[k]), key=lambda r: (r[0], r[1] or 0)):
+                rejections[reason]["total"] += count
+                if step is not None: rejections[reason]["by_step"][str(step)] = rejections[reason]["by_step"].get(str(step), 0) + count
+            return {"attempts": attempts, "accepted": accepted, "attempts_per_accepted": round(attempts / accepted, 2) if accepted else None, "rejections": dict(rejections)}
+        report = {}
+        for sequence in sorted({k[0] for k in self.attempts}):
+            keys = {k for k in self.attempts if k[0] == sequence}
+            entry = summarize(keys)
+            scale = self.begins[sequence] / self.timed_begins[sequence] if self.timed_begins[sequence] else 0
+            entry["seconds"] = {stage: round(self.seconds[sequence][stage] * scale, 3) for stage in self.STAGES}
+            entry["by_structure"] = {k[1]: summarize({k}) for k in sorted(keys)}
+            report[sequence] = entry
+        return report
+
+class NullTelemetry(GenerationTelemetry):
+    """何も記録しない telemetry。telemetry を渡さずに呼ばれたとき、呼び出しのたびに集計用の Counter を作らないように使う"""
+    def __init__(self): pass
+    def begin(self, sequence, structure, attempts=1): pass
+    def lap(self, stage): pass
+    def reject(self, reason, step=None, count=1, key=None): pass
+    def accept(self, key=None): pass
+
+NO_TELEMETRY = NullTelemetry()
+
+def create_story_with_fb_detection(structure, k_agents, k_objects, k_containers, k_locations=3, target_action_plan=None, tracker=None, layout_filter=None, telemetry=None):
+    """ストーリーを1件シミュレーションする。失敗したら None を返し、理由を telemetry に記録する"""
+    telemetry = telemetry or NO_TELEMETRY
     action_plan = target_action_plan
-    simulation_log, has_false_belief_occurred = [], False
-    
+    telemetry.begin(" -> ".join(action_plan), structure_key(structure["la_partition"], structure["lc_partition"]))
+    if len(world["agents"]) < k_agents or len(world["objects"]) < k_objects or \
+       len(world["containers"]) < k_containers or len(world["locations"]) < k_locations:
+        return telemetry.reject("world_too_small")
+    agents, objects = random.sample(world["agents"], k_agents), random.sample(world["objects"], k_objects)
+    containers, locations = random.sample(world["containers"], k_containers), random.sample(world["locations"], k_locations)
+    la_partition, lc_partition = structure["la_partition"], structure["lc_partition"]
+    la_perm, lc_perm = random_arrangement(la_partition), random_arrangement(lc_partition)
+    obj_containers = [random.choice(containers) for _ in objects]
+    agent_locs, obj_locs, cont_locs = layout_initial_state(agents, objects, containers, locations, la_perm, lc_perm, obj_containers)
+    # 割り当て数の残っていない層の初期配置は、シミュレーションする前に捨てる
+    if layout_filter and not layout_filter(*layout_pattern(agent_locs, obj_locs, cont_locs, k_locations)):
+        telemetry.lap("setup")
+        return telemetry.reject("quota_full_layout")
+
+    current_state = WorldState(agent_locs, obj_locs, cont_locs)
+    # 同じ部屋にあるオブジェクトについて初期信念を設定 (文章化はシミュレーション成功後に行う)
+    current_state.observe_initial_objects()
+    simulation_log, actions, recorder = [], [], BeliefPersistenceRecorder(current_state)
+    telemetry.lap("setup")
+
     for i, action_type in enumerate(action_plan):
-        possible_actions = current_state.get_possible_moves() if action_type == 'move' else current_state.get_possible_exits()
-        if not possible_actions: return None
+        possible_actions = current_state.get_possible_moves() if action_type == MOVE else current_state.get_possible_exits()
+        if not possible_actions:
+            telemetry.lap("simulation")
+            return telemetry.reject("no_possible_actions", i + 1)
         random.shuffle(possible_actions)
+        telemetry.lap("simulation")
         best_action = None
+        # 先読み: 残りの計画に move がある場合、適用後に move 可能な状態が残る行動だけを選ぶ (コピーせず apply/revert で確認)
+        needs_move = MOVE in action_plan[i+1:]
         for action in possible_actions:
             is_safe_choice = True
-            future_plan = action_plan[i+1:]
-            if future_plan:
-                tentative_next_state = apply_action_and_update_beliefs(current_state, action)
-                if 'move' in future_plan and not tentative_next_state.get_possible_moves():
-                    is_safe_choice = False
+            if needs_move:
+                token = current_state.apply(action)
+                is_safe_choice = current_state.has_possible_move()
+                current_state.revert(token)
             if is_safe_choice:
                 best_action = action
                 break
-        if not best_action: return None
+        telemetry.lap("lookahead")
+        if not best_action: return telemetry.reject("no_safe_action", i + 1)
+        actions.append(current_state.named_action(best_action))
+        simulation_log.append(apply_and_log(current_state, best_action, i + 1, recorder))
+        telemetry.lap("simulation")
+        if tracker and i + 1 < len(action_plan) and not tracker.check(current_state, i + 1):
+            telemetry.lap("persistence")
+            return telemetry.reject("pruned", i + 1)
+        telemetry.lap("persistence")
+
+    if len(simulation_log) != len(action_plan): return telemetry.reject("wrong_log_length")
+    story_data = finish_story(agent_locs, obj_locs, cont_locs, locations, simulation_log, recorder, actions)
+    telemetry.lap("simulation")
+    return story_data
+
+# ---------------------------------------------------------------------------
+# 5. 全列挙エンジン (棄却なしの一様サンプリング)
+# ---------------------------------------------------------------------------
+class CompletionCounter:
+    """行動計画の途中の状態から、最後に誤信念が残る行動列の数を数える。部分木の数は canonical_key() でメモ化する"""
+
+    def __init__(self, action_plan):
+        self.action_plan, self.memo, self.feasible = list(action_plan), {}, {}
+
+    def candidate_actions(self, state: WorldState, step):
+        """step 番目に取りうる行動のうち、先読み条件を満たすもの (create_story_with_fb_detection と同じ規則)"""
+        possible_actions = state.get_possible_moves() if self.action_plan[step] == MOVE else state.get_possible_exits()
+        if MOVE not in self.action_plan[step+1:]: return possible_actions
+        safe_actions = []
+        for action in possible_actions:
+            token = state.apply(action)
+            if state.has_possible_move(): safe_actions.append(action)
+            state.revert(token)
+        return safe_actions
+
+    def count_completions(self, state: WorldState, step):
+        """state から残りの計画を実行して、最後に誤信念が残る行動列の数"""
+        if MOVE not in self.action_plan[step:]:
+            # exit/enter は信念もオブジェクトも変えないので、誤信念の有無は現在の状態で決まる
+            n_exits = len(state.agent_loc) * (len(state.locations) - 1)
+            return n_exits ** (len(self.action_plan) - step) if state.has_false_belief() else 0
+        key = (step, state.canonical_key())
+        if key in self.memo: return self.memo[key]
+        total = 0
+        for action in self.candidate_actions(state, step):
+            token = state.apply(action)
+            total += self.count_completions(state, step + 1)
+            state.revert(token)
+        self.memo[key] = total
+        return total
+
+    def can_complete(self, state: WorldState, step):
+        """最後に誤信念が残る行動列が1つでもあるか。count_completions と違い、見つかった時点で探索をやめる"""
+        if MOVE not in self.action_plan[step:]: return state.has_false_belief()
+        key = (step, state.canonical_key())
+        if key in self.memo: return self.memo[key] > 0
+        if key in self.feasible: return self.feasible[key]
+        found = False
+        for action in self.candidate_actions(state, step):
+            token = state.apply(action)
+            found = self.can_complete(state, step + 1)
+            state.revert(token)
+            if found: break
+        self.feasible[key] = found
+        return found
+
+class StoryEnumerator(CompletionCounter):
+    """1つの設定と行動計画について、誤信念が最後まで残るストーリーを全列挙して数え、一様にサンプリングする。
+
+    ストーリーは (部屋ごとの人数・コンテナ数の並び, オブジェクトの置き場所, 各ステップの行動) の組として数える。
+    名前の割り当ては一様かつ独立なので数には含めない。strata には、作れるストーリーの (カテゴリ, パターン) を集める。
+    """
 
-        next_state = apply_action_and_update_beliefs(current_state, best_action)
-        fbs_found = detect_false_belief(next_state)
-        if fbs_found: has_false_belief_occurred = True
-        event_sentence = f"{best_action['agent']} moved the {best_action['object']} to the {best_action['target']}." if best_action['type'] == 'move' else f"{best_action['agent']} exited {best_action['from']} and entered {best_action['to']}."
-        simulation_log.append({"step": i + 1, "action_type": best_action['type'], "event": event_sentence, "false_beliefs_found": fbs_found})
-        current_state = next_state
+    def __init__(self, valid_structures, k_objects, action_plan):
+        super().__init__(action_plan)
+        # 異なる構造の順列が同じ並びになることがあるので、並び (la_perm, lc_perm) の単位で重複なく数える
+        layouts = sorted({(la_perm, lc_perm) for structure in valid_structures
+                          for la_perm in get_unique_permutations(structure["la_partition"])
+                          for lc_perm in get_unique_permutations(structure["lc_partition"])})
+        self.initial_configs, self.counts_by_layout, self.strata = [], Counter(), set()
+        for la_perm, lc_perm in layouts:
+            k_agents, k_containers = sum(la_perm), sum(lc_perm)
+            abstract_agents, abstract_containers = [f"a{i}" for i in range(k_agents)], [f"c{i}" for i in range(k_containers)]
+            abstract_objects, abstract_locations = [f"o{i}" for i in range(k_objects)], [f"L{i:02d}" for i in range(len(la_perm))]
+            for placement in product(range(k_containers), repeat=k_objects):
+                locs = layout_initial_state(abstract_agents, abstract_objects, abstract_containers, abstract_locations, la_perm, lc_perm, [abstract_containers[c] for c in placement])
+                stratum = layout_pattern(*locs, len(la_perm))
+                state = WorldState(*locs)
+                state.observe_initial_objects()
+                count = self.count_completions(state, 0)
+                if count:
+                    self.initial_configs.append((la_perm, lc_perm, placement, count))
+                    self.counts_by_layout[(la_perm, lc_perm)] += count
+                    self.strata.add(stratum)
+        self.cum_weights = list(accumulate(config[-1] for config in self.initial_configs))
+        self.total = self.cum_weights[-1] if self.cum_weights else 0
 
-    if len(simulation_log) != 4: return None
-    event_sentences = [log['event'] for log in simulation_log]
-    full_story = initial_sentences + event_sentences
-    return {"initial_state_sentences": initial_sentences, "simulation_log": simulation_log, "has_false_belief": has_false_belief_occurred, "action_sequence": [log['action_type'] for log in simulation_log], "full_story": full_story}
+    def report(self):
+        layouts = [{"la_perm": list(la), "lc_perm": list(lc), "num_stories": n} for (la, lc), n in self.counts_by_layout.most_common()]
+        return {"num_stories": self.total, "num_initial_states": len(self.initial_configs), "by_layout": layouts}
+
+    def sample(self, rng=random):
+        """有効なストーリー全体から一様に1件選び、create_story_with_fb_detection と同じ形式で返す"""
+        if not self.total: return None
+        la_perm, lc_perm, placement, _ = rng.choices(self.initial_configs, cum_weights=self.cum_weights)[0]
+        agents, objects = rng.sample(world["agents"], sum(la_perm)), rng.sample(world["objects"], len(placement))
+        containers, locations = rng.sample(world["containers"], sum(lc_perm)), rng.sample(world["locations"], len(la_perm))
+        agent_locs, obj_locs, cont_locs = layout_initial_state(agents, objects, containers, locations, la_perm, lc_perm, [containers[c] for c in placement])
+        state = WorldState(agent_locs, obj_locs, cont_locs)
+        state.observe_initial_objects()
+        simulation_log, chosen, recorder = [], [], BeliefPersistenceRecorder(state)
+        for step in range(len(self.action_plan)):
+            actions, weights = [], []
+            for action in self.candidate_actions(state, step):
+                token = state.apply(action)
+                count = self.count_completions(state, step + 1)
+                state.revert(token)
+                if count: actions.append(action); weights.append(count)
+            action = rng.choices(actions, weights=weights)[0]
+            chosen.append(state.named_action(action))
+            simulation_log.append(apply_and_log(state, action, step + 1, recorder))
+        return finish_story(agent_locs, obj_locs, cont_locs, locations, simulation_log, recorder, chosen)
+
+def feasible_strata(valid_structures, k_objects, counter):
+    """counter の行動計画で、最後に誤信念が残るストーリーを作れる (カテゴリ, パターン) の集合 (StoryEnumerator.strata と同じもの)。
+    数えずに can_complete で判定する。部屋の並べ替えやオブジェクト・同じ部屋のコンテナの入れ替えで同じになる初期配置は1つだけ試す"""
+    strata = set()
+    room_sets = {tuple(sorted(zip(la_perm, lc_perm))) for structure in valid_structures
+                 for la_perm in get_unique_permutations(structure["la_partition"])
+                 for lc_perm in get_unique_permutations(structure["lc_partition"])}
+    for rooms in sorted(room_sets):
+        la_perm, lc_perm = [a for a, _ in rooms], [c for _, c in rooms]
+        agents, containers = [f"a{i}" for i in range(sum(la_perm))], [f"c{i}" for i in range(sum(lc_perm))]
+        objects, locations = [f"o{i}" for i in range(k_objects)], [f"L{i:02d}" for i in range(len(rooms))]
+        offsets = list(accumulate([0] + lc_perm[:-1]))
+        for room_objects in get_partitions(k_objects, len(rooms)):
+            if any(o and not c for o, c in zip(room_objects, lc_perm)): continue
+            stratum = (agent_category(la_perm, len(rooms)), "/".join(sorted("A" * a + "C" * c + "O" * o for (a, c), o in zip(rooms, room_objects))))
+            if stratum in strata: continue
+            # 部屋ごとに、オブジェクトの数をコンテナに分ける方法 (多い順に並べたもの) だけを試す
+            splits = [sorted({tuple(sorted(split, reverse=True)) for split in get_partitions(o, c)}) for o, c in zip(room_objects, lc_perm)]
+            for split in product(*splits):
+                placement = [containers[offset + j] for offset, counts in zip(offsets, split) for j, n in enumerate(counts) for _ in range(n)]
+                state = WorldState(*layout_initial_state(agents, objects, containers, locations, la_perm, lc_perm, placement))
+                state.observe_initial_objects()
+                if counter.can_complete(state, 0):
+                    strata.add(stratum)
+                    break
+    return strata
+
+class PersistenceTracker:
+    """シミュレーション中に、残りの計画で誤信念を最後まで残せる見込みがあるかを判定し、ない試行を打ち切る。
+
+    残りステップが horizon 以下なら CompletionCounter.can_complete で厳密に判定し、それより長い場合は打ち切らない。
+    メモは試行をまたいで共有されるので、同じ設定・計画の試行が続くほど判定は速くなる。
+    """
+
+    def __init__(self, action_plan, horizon=PRUNE_HORIZON):
+        self.counter, self.horizon = CompletionCounter(action_plan), horizon
+        self.pruned_by_step = Counter()
+
+    def check(self, state: WorldState, step):
+        """step 番目の行動の直前の状態で、まだ成功しうるなら True。打ち切る場合はステップ別に記録する"""
+        if len(self.counter.action_plan) - step > self.horizon: return True
+        if len(self.counter.feasible) > PRUNE_MEMO_LIMIT: self.counter.feasible.clear()
+        if self.counter.can_complete(state, step): return True
+        self.pruned_by_step[step] += 1
+        return False
+
+def prune_horizon(k_agents, k_objects, k_containers):
+    """設定の大きさに合わせた PersistenceTracker の horizon。A20_O20_C6 のような設定で4ステップ先まで厳密判定すると、打ち切りより判定の方が高くつく"""
+    horizon = PRUNE_HORIZON
+    while horizon > 0 and (k_agents * k_objects * k_containers) ** horizon > PRUNE_SEARCH_BUDGET: horizon -= 1
+    return horizon
 
 # ---------------------------------------------------------------------------
-# 5. メイン実行部
+# 6. NumPy によるバッチシミュレーション
 # ---------------------------------------------------------------------------
-def main():
-    def get_partitions(n, k):
-        if k == 0: return [[]] if n == 0 else [];
-        if k == 1: return [[n]]
-        res = []
-        for i in range(n + 1):
-            for sub in get_partitions(n - i, k - 1): res.append([i] + sub)
-        return res
-    def generate_valid_initial_states(k_agents, k_containers, k_locations=3):
-        valid_structures, la_partitions, lc_partitions = [], get_partitions(k_agents, k_locations), get_partitions(k_containers, k_locations)
-        for la in la_partitions:
-            for lc in lc_partitions:
-                if any(c > 1 for c in lc) and any(lc[i] > 1 and la[i] > 0 for i in range(k_locations)):
-                    valid_structures.append({"la_partition": la, "lc_partition": lc})
-        return valid_structures
-    target_sequences = [['move', 'exit_enter', 'move', 'exit_enter'], ['move', 'exit_enter', 'exit_enter', 'move'], ['exit_enter', 'move', 'move', 'exit_enter'], ['exit_enter', 'move', 'exit_enter', 'move'], ['exit_enter', 'exit_enter', 'move', 'move']]
-    final_stories, per_setting_distribution, instance_counter = [], defaultdict(Counter), 1
-    settings_to_generate = [{"label": "A3_O3_C3", "k_a": 3, "k_o": 3, "k_c": 3}, {"label": "A4_O3_C3", "k_a": 4, "k_o": 3, "k_c": 3}, {"label": "A5_O3_C3", "k_a": 5, "k_o": 3, "k_c": 3}, {"label": "A3_O4_C3", "k_a": 3, "k_o": 4, "k_c": 3}, {"label": "A3_O5_C3", "k_a": 3, "k_o": 5, "k_c": 3}, {"label": "A3_O3_C4", "k_a": 3, "k_o": 3, "k_c": 4}, {"label": "A3_O3_C5", "k_a": 3, "k_o": 3, "k_c": 5}]
-    for setting in settings_to_generate:
-        setting_label, k_a, k_o, k_c = setting["label"], setting["k_a"], setting["k_o"], setting["k_c"]
-        print(f"\n--- Processing setting: {setting_label} ---")
-        valid_structures = generate_valid_initial_states(k_a, k_c)
-        if not valid_structures: continue
-        story_pool = []
-        stories_per_sequence = 10000 // len(target_sequences)
-        for seq in target_sequences:
+REJECTION_REASONS = {1: "no_possible_actions", 2: "no_safe_action", 3: "no_false_belief", 4: "false_belief_resolved"}
+
+class BatchSimulator:
+    """B 件のストーリーを整数配列でまとめてシミュレーションし、最後まで誤信念が残ったものだけを返す。
+
+    配列は agent_loc[B,A], obj_cont[B,O], cont_loc[B,C], belief[B,A,O] (未観測は -1)。場所の番号は la_perm/lc_perm の並び順。
+    各ステップでは、先読み条件を満たす行動から一様に1つ選ぶ (create_story_with_fb_detection と同じ分布)。
+    生き残ったストーリーは WorldState で再生して、simulation_log と false_belief_persistence を同じ形式で作る。
+    構造を列挙しない大きな設定 (StructureSpace.structures が None) では、分割と並びを配列のまま一様に引く。
+    """
+
+    def __init__(self, space, k_objects, action_plan):
+        if np is None: raise ImportError("バッチシミュレーションには numpy が必要です")
+        self.action_plan, self.k_objects = list(action_plan), k_objects
+        self.k_agents, self.k_containers, self.k_locations = space.k_agents, space.k_containers, space.k_locations
+        self.tabulated = space.structures is not None and self.k_locations <= PERMUTATION_TABLE_MAX_LOCATIONS
+        if not self.tabulated: return
+        # 順列の表は (相異なる分割の数, 順列数の最大, 場所数) で持ち、構造からは番号で引く。
+        # 構造 (エージェントの分割 x コンテナの分割) ごとに持つと、場所数や人数が増えたときに表が掛け算で大きくなる
+        self.la_index, self.la_table, self.n_la = self._perm_table([s["la_partition"] for s in space.structures])
+        self.lc_index, self.lc_table, self.n_lc = self._perm_table([s["lc_partition"] for s in space.structures])
+        self.structure_keys = [structure_key(s["la_partition"], s["lc_partition"]) for s in space.structures]
+
+    def _perm_table(self, partitions):
+        unique = {p: i for i, p in enumerate(dict.fromkeys(tuple(p) for p in partitions))}
+        perms = [get_unique_permutations(p) for p in unique]
+        table = np.zeros((len(perms), max(len(p) for p in perms), self.k_locations), dtype=np.int64)
+        for i, p in enumerate(perms): table[i, :len(p)] = p
+        return np.array([unique[tuple(p)] for p in partitions]), table, np.array([len(p) for p in perms])
+
+    def _sample_layouts(self, B, rng):
+        """B 件の構造と並びを引き、(構造の番号 [B], 構造のキーのリスト, la_perm [B,L], lc_perm [B,L]) を返す"""
+        if self.tabulated:
+            structure = rng.integers(0, len(self.structure_keys), B)
+            la, lc = self.la_index[structure], self.lc_index[structure]
+            la_perm = self.la_table[la, np.floor(rng.random(B) * self.n_la[la]).astype(np.int64)]
+            lc_perm = self.lc_table[lc, np.floor(rng.random(B) * self.n_lc[lc]).astype(np.int64)]
+            return structure, self.structure_keys, la_perm, lc_perm
+        la, lc = self._random_compositions(B, self.k_agents, rng), self._random_compositions(B, self.k_containers, rng)
+        invalid = ~((la > 0) & (lc > 1)).any(1)
+        while invalid.any():
+            # 無効な構造の行だけ引き直す (棄却サンプリングなので有効な構造について一様)
+            n = int(invalid.sum())
+            la[invalid], lc[invalid] = self._random_compositions(n, self.k_agents, rng), self._random_compositions(n, self.k_containers, rng)
+            invalid = ~((la > 0) & (lc > 1)).any(1)
+        row_keys = [structure_key(a, c) for a, c in zip(la.tolist(), lc.tolist())]
+        keys = {key: i for i, key in enumerate(dict.fromkeys(row_keys))}
+        return np.array([keys[key] for key in row_keys]), list(keys), rng.permuted(la, axis=1), rng.permuted(lc, axis=1)
+
+    def _random_compositions(self, B, n, rng):
+        """random_composition の配列版: n を k_locations 個に分ける並びを B 件、一様に引く"""
+        L = self.k_locations
+        bars = np.sort(rng.random((B, n + L - 1)).argsort(1)[:, :L - 1], 1)
+        return np.diff(np.hstack([np.full((B, 1), -1), bars, np.full((B, 1), n + L - 1)]), axis=1) - 1
+
+    @staticmethod
+    def _layout(perm, n):
+        """部屋ごとの数の並び [B,L] から、先頭から順に割り当てた各要素の部屋 [B,n] を求める"""
+        return (np.arange(n)[None, :, None] >= np.cumsum(perm, axis=1)[:, None, :]).sum(-1)
+
+    @staticmethod
+    def _choose(mask, rng):
+        """各行の True の中から一様に1つ選ぶ。選べない行は -1"""
+        flat = mask.reshape(len(mask), -1)
+        counts = flat.sum(1)
+        pick = np.floor(rng.random(len(mask)) * counts).astype(np.int64)
+        chosen = (np.cumsum(flat, axis=1) > pick[:, None]).argmax(1)
+        return np.where(counts > 0, chosen, -1)
+
+    def simulate(self, batch_size, rng, telemetry=None):
+        """batch_size 件をまとめてシミュレーションし、生き残った行の (構造のキー, (初期配置と行動列)) を返す
+
+        telemetry があれば、構造ごとの試行数と、脱落した行の理由 (GenerationTelemetry と同じ名前) を記録する。
+        """
+        B, A, O, C, L = batch_size, self.k_agents, self.k_objects, self.k_containers, self.k_locations
+        sequence_name = " -> ".join(self.action_plan)
+        telemetry = telemetry or NO_TELEMETRY
+        telemetry.begin(sequence_name, None, attempts=0)
+        rows = np.arange(B)
+        structure, structure_keys, la_perm, lc_perm = self._sample_layouts(B, rng)
+        agent_loc, cont_loc = self._layout(la_perm, A), self._layout(lc_perm, C)
+        placement = rng.integers(0, C, (B, O))
+        obj_cont, occupied = placement.copy(), (la_perm > 0) | (lc_perm > 0)
+        n_conts_at = (cont_loc[:, :, None] == np.arange(L)).sum(1)
+        obj_loc = np.take_along_axis(cont_loc, obj_cont, 1)
+        belief = np.where(obj_loc[:, None, :] == agent_loc[:, :, None], obj_cont[:, None, :], -1)
+        alive, actions = np.ones(B, dtype=bool), np.zeros((B, len(self.action_plan), 3), dtype=np.int64)
+        # 脱落理由 (REJECTION_REASONS の番号, 0 は生存) と脱落したステップ。誤信念が一度でも生じたか
+        reason, dead_step, had_false_belief = np.zeros(B, dtype=np.int64), np.zeros(B, dtype=np.int64), np.zeros(B, dtype=bool)
+
+        def drop(rows_to_drop, code, step):
+            nonlocal alive
+            rows_to_drop = rows_to_drop & alive
+            reason[rows_to_drop], dead_step[rows_to_drop] = code, step
+            alive = alive & ~rows_to_drop
+
+        telemetry.lap("setup")
+        for step, action_type in enumerate(self.action_plan):
+            obj_loc = np.take_along_axis(cont_loc, obj_cont, 1)
+            # 正しく信じていて、同じ部屋にあるオブジェクト [B,A,O]
+            knows = (belief == obj_cont[:, None, :]) & (obj_loc[:, None, :] == agent_loc[:, :, None])
+            if action_type == MOVE:
+                # move の後も動かした本人は同じ部屋で正しい信念を持つので、先読み条件は常に満たされる
+                same_room = cont_loc[:, None, :] == agent_loc[:, :, None]
+                mask = knows[..., None] & same_room[:, :, None, :] & (np.arange(C) != obj_cont[:, None, :, None])
+                chosen = self._choose(mask, rng)
+                drop(chosen < 0, 1, step + 1)
+                agent, obj, target = np.unravel_index(np.maximum(chosen, 0), (A, O, C))
+                witnesses = agent_loc == agent_loc[rows, agent][:, None]
+                belief[rows[:, None], np.arange(A), obj[:, None]] = np.where(witnesses, target[:, None], belief[rows[:, None], np.arange(A), obj[:, None]])
+                obj_cont[rows, obj] = target
+                actions[:, step] = np.stack([agent, obj, target], 1)
+                telemetry.lap("simulation")
+                had_false_belief |= ((belief >= 0) & (belief != obj_cont[:, None, :])).any((1, 2))
+                telemetry.lap("persistence")
+            else:
+                mask = occupied[:, None, :] & (np.arange(L) != agent_loc[:, :, None])
+                drop(~mask.any((1, 2)), 1, step + 1)
+                telemetry.lap("simulation")
+                if MOVE in self.action_plan[step+1:]:
+                    # exit/enter で変わるのは本人の位置だけ。他の誰かが move できるか、移動先で本人が move できれば安全
+                    can_move = knows & (np.take_along_axis(n_conts_at, agent_loc, 1) >= 2)[:, :, None]
+                    movable = can_move.any(2)
+                    others = (movable.sum(1)[:, None] - movable) > 0
+                    at_new = ((belief == obj_cont[:, None, :])[..., None] & (obj_loc[:, None, :, None] == np.arange(L))).any(2) & (n_conts_at >= 2)[:, None, :]
+                    mask &= others[:, :, None] | at_new
+                telemetry.lap("lookahead")
+                chosen = self._choose(mask, rng)
+                drop(chosen < 0, 2, step + 1)
+                agent, new_loc = np.unravel_index(np.maximum(chosen, 0), (A, L))
+                actions[:, step] = np.stack([agent, agent_loc[rows, agent], new_loc], 1)
+                agent_loc[rows, agent] = new_loc
+                telemetry.lap("simulation")
+
+        # 最後まで残る誤信念 = 最終状態での誤信念 (未観測でなく、現実と異なる信念)
+        unresolved = ((belief >= 0) & (belief != obj_cont[:, None, :])).any((1, 2))
+        drop(~unresolved & had_false_belief, 4, 0)
+        drop(~unresolved, 3, 0)
+        telemetry.lap("persistence")
+        keys = [(sequence_name, key) for key in structure_keys]
+        for s, n in zip(*np.unique(structure, return_counts=True)): telemetry.attempts[keys[s]] += int(n)
+        for (s, code, step), n in Counter(zip(structure[~alive].tolist(), reason[~alive].tolist(), dead_step[~alive].tolist())).items():
+            telemetry.reject(REJECTION_REASONS[code], step or None, count=n, key=keys[s])
+        survivors = np.flatnonzero(alive)
+        return [(keys[structure[b]], (tuple(la_perm[b].tolist()), tuple(lc_perm[b].tolist()), placement[b].tolist(), actions[b].tolist())) for b in survivors]
+
+    def replay(self, la_perm, lc_perm, placement, actions, rng=random):
+        """simulate() の結果に名前を割り当てて WorldState で再生し、create_story_with_fb_detection と同じ形式で返す"""
+        agents, objects = rng.sample(world["agents"], self.k_agents), rng.sample(world["objects"], self.k_objects)
+        containers, locations = rng.sample(world["containers"], self.k_containers), rng.sample(world["locations"], self.k_locations)
+        agent_locs, obj_locs, cont_locs = layout_initial_state(agents, objects, containers, locations, la_perm, lc_perm, [containers[c] for c in placement])
+        state = WorldState(agent_locs, obj_locs, cont_locs)
+        state.observe_initial_objects()
+        loc_index = {l: state.locations.index(loc) for l, loc in enumerate(locations) if loc in state.locations}
+        simulation_log, named, recorder = [], [], BeliefPersistenceRecorder(state)
+        for step, (action_type, (x, y, z)) in enumerate(zip(self.action_plan, actions)):
+            action = (MOVE, x, y, z) if action_type == MOVE else (EXIT_ENTER, x, loc_index[y], loc_index[z])
+            named.append(state.named_action(action))
+            simulation_log.append(apply_and_log(state, action, step + 1, recorder))
+        return finish_story(agent_locs, obj_locs, cont_locs, locations, simulation_log, recorder, named)
+
+# ---------------------------------------------------------------------------
+# 7. 並列生成のためのジョブ定義
+# ---------------------------------------------------------------------------
+TARGET_SEQUENCES = [['move', 'exit_enter', 'move', 'exit_enter'], ['move', 'exit_enter', 'exit_enter', 'move'], ['exit_enter', 'move', 'move', 'exit_enter'], ['exit_enter', 'move', 'exit_enter', 'move'], ['exit_enter', 'exit_enter', 'move', 'move']]
+SETTINGS_TO_GENERATE = [{"label": "A3_O3_C3", "k_a": 3, "k_o": 3, "k_c": 3}, {"label": "A4_O3_C3", "k_a": 4, "k_o": 3, "k_c": 3}, {"label": "A5_O3_C3", "k_a": 5, "k_o": 3, "k_c": 3}, {"label": "A3_O4_C3", "k_a": 3, "k_o": 4, "k_c": 3}, {"label": "A3_O5_C3", "k_a": 3, "k_o": 5, "k_c": 3}, {"label": "A3_O3_C4", "k_a": 3, "k_o": 3, "k_c": 4}, {"label": "A3_O3_C5", "k_a": 3, "k_o": 3, "k_c": 5}]
+POOL_SIZE_PER_SETTING, SAMPLES_PER_SETTING, MAX_ATTEMPTS_PER_SEQ = 10000, 1000, 200000
+BATCH_SIZE = 4096  # --sampler batch で1回にまとめてシミュレーションするストーリー数
+K_LOCATIONS = 3  # 設定で k_l を省略したときの場所数
+SETTING_LABEL_PATTERN = re.compile(r"A(\d+)_O(\d+)_C(\d+)(?:_L(\d+))?")
+ROOM_PATTERN = re.compile(r"(A*)(C*)(O*)")  # layout_pattern の1部屋分 ("ACCOO" など)
+
+def get_partitions(n, k):
+    if k == 0: return [[]] if n == 0 else [];
+    if k == 1: return [[n]]
+    res = []
+    for i in range(n + 1):
+        for sub in get_partitions(n - i, k - 1): res.append([i] + sub)
+    return res
+
+def is_valid_structure(la, lc):
+    # 誰かがいる場所に、コンテナが2つ以上なければ move できない
+    return any(c > 1 and a > 0 for a, c in zip(la, lc))
+
+def generate_valid_initial_states(k_agents, k_containers, k_locations=3):
+    valid_structures, la_partitions, lc_partitions = [], get_partitions(k_agents, k_locations), get_partitions(k_containers, k_locations)
+    for la in la_partitions:
+        for lc in lc_partitions:
+            if is_valid_structure(la, lc):
+                valid_structures.append({"la_partition": la, "lc_partition": lc})
+    return valid_structures
+
+def random_composition(n, k, rng=random):
+    """n を k 個の非負整数の並びに分ける方法 (get_partitions の要素) から一様に1つ選ぶ。k-1 本の仕切りの位置を引く"""
+    bars = sorted(rng.sample(range(n + k - 1), k - 1))
+    return [right - left - 1 for left, right in zip([-1] + bars, bars + [n + k - 1])]
+
+def count_structures(k_agents, k_containers, k_locations=3):
+    """エージェントとコンテナの分割の組の数 (有効かどうかを問わない)"""
+    return comb(k_agents + k_locations - 1, k_locations - 1) * comb(k_containers + k_locations - 1, k_locations - 1)
+
+class StructureSpace:
+    """設定の有効な構造の集合。数が STRUCTURE_ENUM_LIMIT 以下なら列挙し (structures)、超えるなら列挙せずに一様に引く
+
+    20 人・8 部屋のような設定では構造が 10 億を超えるので、分割の組を一様に引いて is_valid_structure で棄却する。
+    """
+
+    def __init__(self, k_agents, k_containers, k_locations=3):
+        self.k_agents, self.k_containers, self.k_locations = k_agents, k_containers, k_locations
+        enumerable = count_structures(k_agents, k_containers, k_locations) <= STRUCTURE_ENUM_LIMIT
+        self.structures = generate_valid_initial_states(k_agents, k_containers, k_locations) if enumerable else None
+
+    def __bool__(self):
+        if self.structures is not None: return bool(self.structures)
+        return self.k_agents > 0 and self.k_containers > 1
+
+    def has_category(self, category):
+        """エージェント分布のカテゴリ ("AA/A/" など) を、この設定のどれかの構造で作れるか"""
+        if self.structures is not None: return any(agent_category(st["la_partition"], self.k_locations) == category for st in self.structures)
+        # 列挙しない設定ではコンテナが2つ以上あるので、どの人数の分け方にも move できる構造がある
+        parts = category.split("/")
+        counts = [len(part) for part in parts]
+        return bool(self) and len(parts) == self.k_locations and all(set(part) <= {"A"} for part in parts) and sum(counts) == self.k_agents and counts == sorted(counts, reverse=True)
+
+    def sample(self, rng=random):
+        if self.structures is not None: return rng.choice(self.structures)
+        while True:
+            la, lc = random_composition(self.k_agents, self.k_locations, rng), random_composition(self.k_containers, self.k_locations, rng)
+            if is_valid_structure(la, lc): return {"la_partition": la, "lc_partition": lc}
+
+def derive_seed(master_seed, *keys):
+    """マスターシードとジョブのキーからシードを導出する (ワーカー数や実行順序に依存しない)"""
+    digest = hashlib.sha256(":".join(str(k) for k in (master_seed,) + keys).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big")
+
+def split_evenly(total, n_chunks):
+    return [total // n_chunks + (1 if i < total % n_chunks else 0) for i in range(n_chunks)]
+
+class StratumQuotas:
+    """(エージェント分布のカテゴリ, 部屋のパターン, イベント順序) の層ごとの割り当て数。
+
+    entries は {"index", "category", "pattern", "sequence", "count"} のリストで、省略した項目 (None) はどの値にも一致する。
+    ストーリーは一致する項目のうち、まだ埋まっていない最初のものに数える。
+    """
+
+    FIELDS = ("category", "pattern", "sequence")
+
+    def __init__(self, entries):
+        self.entries, self.filled = entries, [0] * len(entries)
+        self.rooms = [pattern_rooms(entry["pattern"]) if entry["pattern"] is not None else None for entry in entries]
+
+    def _matches(self, entry, values):
+        return all(value is None or entry[field] in (None, value) for field, value in zip(self.FIELDS, values))
+
+    def is_open(self, category=None, pattern=None, sequence=None):
+        """指定した層 (None の項目は問わない) に入るストーリーを、まだ受け入れられるか"""
+        values = (category, pattern, sequence)
+        return any(filled < entry["count"] and self._matches(entry, values) for entry, filled in zip(self.entries, self.filled))
+
+    def fits_structure(self, la_partition, lc_partition, sequence=None):
+        """構造 (部屋ごとの人数とコンテナ数の分け方) から、まだ埋まっていない層に入る初期配置を作れるか。
+        人数とコンテナ数の並びは部屋ごとに独立に並べ替えるので、パターンとは数の組を並べ替えて比べる"""
+        category, agents, containers = agent_category(la_partition, len(la_partition)), sorted(la_partition), sorted(lc_partition)
+        for entry, rooms, filled in zip(self.entries, self.rooms, self.filled):
+            if filled >= entry["count"] or not self._matches(entry, (category, None, sequence)): continue
+            if rooms is None or (sorted(a for a, _, _ in rooms) == agents and sorted(c for _, c, _ in rooms) == containers): return True
+        return False
+
+    def accept(self, category, pattern, sequence):
+        for i, entry in enumerate(self.entries):
+            if self.filled[i] < entry["count"] and self._matches(entry, (category, pattern, sequence)):
+                self.filled[i] += 1
+                return True
+        return False
+
+    def report(self):
+        return [{"index": entry["index"], "count": entry["count"], "filled": filled} for entry, filled in zip(self.entries, self.filled)]
+
+def load_quotas(path):
+    """割り当て数のファイルを読む。形式: {"A3_O3_C3": [{"category": "A/A/A", "pattern": "ACO/ACO/ACO", "sequence": "move -> exit_enter -> move -> exit_enter", "count": 50}, ...]}"""
+    with open(path, "r", encoding="utf-8") as f: quotas = json.load(f)
+    return {label: [dict({field: e.get(field) for field in StratumQuotas.FIELDS}, index=i, count=e["count"]) for i, e in enumerate(entries)] for label, entries in quotas.items()}
+
+def pattern_errors(pattern, setting):
+    """部屋のパターンが、設定の初期配置として作れない理由のリスト (作れるなら空)"""
+    rooms = pattern_rooms(pattern)
+    if rooms is None: return [f"パターン {pattern} の部屋は A, C, O をこの順に並べてください"]
+    errors = []
+    if len(rooms) != setting["k_l"]: errors.append(f"パターン {pattern} の部屋の数が {len(rooms)} です (この設定は {setting['k_l']} 部屋)")
+    canonical = "/".join(sorted(pattern.split("/")))
+    if pattern != canonical: errors.append(f"パターンは部屋を並べ替えた {canonical} の形で書いてください")
+    totals = [sum(room[i] for room in rooms) for i in range(3)]
+    if totals != [setting["k_a"], setting["k_c"], setting["k_o"]]:
+        errors.append(f"パターン {pattern} はエージェント {totals[0]} 人, コンテナ {totals[1]} 個, オブジェクト {totals[2]} 個です (この設定は {setting['k_a']} 人, {setting['k_c']} 個, {setting['k_o']} 個)")
+    if any(o and not c for _, c, o in rooms): errors.append(f"パターン {pattern} にコンテナのない部屋に置かれたオブジェクトがあります")
+    if not is_valid_structure([a for a, _, _ in rooms], [c for _, c, _ in rooms]): errors.append(f"パターン {pattern} には、誰かがいてコンテナが2つ以上ある部屋がないので move できません")
+    return errors
+
+def check_quotas(quotas, config):
+    """設定では作れない層 (カテゴリ, パターン, イベント順序) を指定した割り当てを、生成を始める前に見つけて止める"""
+    errors, sequence_names = [], {" -> ".join(seq) for seq in config["sequences"]}
+    for setting in config["settings"]:
+        space = StructureSpace(setting["k_a"], setting["k_c"], setting["k_l"])
+        for entry in quotas.get(setting["label"], []):
+            where = f"{setting['label']} の {entry['index']} 番目の割り当て"
+            if entry["category"] is not None and not space.has_category(entry["category"]):
+                errors.append(f"{where}: カテゴリ {entry['category']} はこの設定 (エージェント {setting['k_a']} 人, 場所 {setting['k_l']} 部屋) では作れません")
+            if entry["pattern"] is not None:
+                problems = pattern_errors(entry["pattern"], setting)
+                if not problems and entry["category"] is not None and agent_category([a for a, _, _ in pattern_rooms(entry["pattern"])], setting["k_l"]) != entry["category"]:
+                    problems.append(f"パターン {entry['pattern']} のカテゴリは {agent_category([a for a, _, _ in pattern_rooms(entry['pattern'])], setting['k_l'])} で、{entry['category']} と一致しません")
+                errors += [f"{where}: {problem}" for problem in problems]
+            if entry["sequence"] is not None and entry["sequence"] not in sequence_names:
+                errors.append(f"{where}: イベント順序 {entry['sequence']} は生成するイベント順序にありません")
+    if errors: raise SystemExit("割り当てのファイルに生成できない層があります:\n  " + "\n  ".join(errors))
+
+def parse_setting(setting):
+    """設定をラベル ("A10_O10_C4" や "A10_O10_C4_L5") または dict から {"label", "k_a", "k_o", "k_c", "k_l"} にする"""
+    if isinstance(setting, str):
+        match = SETTING_LABEL_PATTERN.fullmatch(setting)
+        if not match: raise ValueError(f"設定のラベルを解釈できません: {setting} (例: A3_O3_C3, A10_O10_C4_L5)")
+        k_a, k_o, k_c, k_l = match.groups()
+        setting = {"label": setting, "k_a": int(k_a), "k_o": int(k_o), "k_c": int(k_c), "k_l": int(k_l or K_LOCATIONS)}
+    setting = dict(setting, k_l=setting.get("k_l", K_LOCATIONS))
+    setting.setdefault("label", f"A{setting['k_a']}_O{setting['k_o']}_C{setting['k_c']}" + ("" if setting["k_l"] == K_LOCATIONS else f"_L{setting['k_l']}"))
+    return setting
+
+def parse_sequence(sequence):
+    """イベント順序をリストまたはカンマ区切りの文字列 ("move,exit_enter,...") から行動のリストにする"""
+    if isinstance(sequence, str): sequence = [s.strip() for s in sequence.split(",") if s.strip()]
+    unknown = [s for s in sequence if s not in (MOVE, EXIT_ENTER)]
+    if not sequence or unknown: raise ValueError(f"イベント順序には {MOVE} と {EXIT_ENTER} だけを並べてください: {sequence}")
+    return list(sequence)
+
+def load_config(path=None, settings=None, sequences=None):
+    """生成する設定の一覧・イベント順序・件数をまとめる。省略した項目は SETTINGS_TO_GENERATE などの既定値を使う
+
+    設定ファイルの形式: {"settings": ["A10_O10_C4_L5", {"label": ..., "k_a": 20, "k_o": 20, "k_c": 6, "k_l": 8}],
+    "sequences": [["move", "exit_enter", ...], "move,exit_enter,..."], "pool_size": 10000, "samples_per_setting": 1000, "max_attempts_per_seq": 200000}
+    settings/sequences (コマンドライン引数) を指定すると、ファイルの値より優先する。
+    """
+    config = {}
+    if path:
+        with open(path, "r", encoding="utf-8") as f: config = json.load(f)
+    config = {"settings": settings or config.get("settings", SETTINGS_TO_GENERATE), "sequences": sequences or config.get("sequences", TARGET_SEQUENCES),
+              "pool_size": config.get("pool_size", POOL_SIZE_PER_SETTING), "samples_per_setting": config.get("samples_per_setting", SAMPLES_PER_SETTING),
+              "max_attempts_per_seq": config.get("max_attempts_per_seq", MAX_ATTEMPTS_PER_SEQ)}
+    config["settings"], config["sequences"] = [parse_setting(s) for s in config["settings"]], [parse_sequence(s) for s in config["sequences"]]
+    labels = [s["label"] for s in config["settings"]]
+    if len(set(labels)) != len(labels): raise ValueError(f"設定のラベルが重複しています: {labels}")
+    return config
+
+def check_world_size(setting):
+    """world.json の語彙が設定に足りなければ、不足している種類を返す"""
+    needed = {"agents": setting["k_a"], "objects": setting["k_o"], "containers": setting["k_c"], "locations": setting["k_l"]}
+    return {kind: (n, len(world[kind])) for kind, n in needed.items() if len(world[kind]) < n}
+
+class StoryReservoir:
+    """ストーリーに一様乱数のキーを付け、キーが小さい k 件だけを保持するリザーバ。
+
+    どのストリームでもキーの小さい k 件は一様な非復元サンプルになり、複数のリザーバを merge() しても同じ性質が保たれる。
+    stratified のときは action_sequence ごとに別のリザーバを持つ。capacity は全層共通の件数か、層ごとの件数の辞書。
+    max_per_shape を指定すると、merge() したストーリーをすべて持っておき、sample() でキーの小さい順に
+    同じ形 (shape) を max_per_shape 件まで残しながら capacity 件を選ぶ (ジョブをまたいだ重複もここで除く)。
+    """
+
+    def __init__(self, capacity, rng, stratified=False, max_per_shape=None):
+        self.capacity, self.rng, self.stratified, self.max_per_shape = capacity, rng, stratified, max_per_shape
+        self.heaps, self.seen, self.counter = defaultdict(list), Counter(), 0
+
+    def _capacity(self, stratum):
+        return self.capacity[stratum] if isinstance(self.capacity, dict) else self.capacity
+
+    def _stratum(self, story):
+        return tuple(story["action_sequence"]) if self.stratified else ()
+
+    def _push(self, stratum, key, story):
+        heap = self.heaps[stratum]
+        capacity = float("inf") if self.max_per_shape else self._capacity(stratum)  # 重複を除くまでは件数で切らない
+        self.counter += 1
+        item = (-key, self.counter, story)  # 最大ヒープとして使い、キーが最も大きいものを先頭に置く
+        if len(heap) < capacity: heapq.heappush(heap, item)
+        elif -heap[0][0] > key: heapq.heapreplace(heap, item)
+
+    def add(self, story):
+        stratum = self._stratum(story)
+        self.seen[stratum] += 1
+        self._push(stratum, self.rng.random(), story)
+
+    def merge(self, other):
+        for stratum, heap in other.heaps.items():
+            for neg_key, _, story in heap: self._push(stratum, -neg_key, story)
+        self.seen.update(other.seen)
+
+    def total_seen(self):
+        return sum(self.seen.values())
+
+    def sample(self):
+        """保持しているストーリーをキーの昇順 (ランダムな順序) で返す"""
+        items = [(-neg_key, story) for heap in self.heaps.values() for neg_key, _, story in heap]
+        stories = [story for _, story in sorted(items, key=lambda item: item[0])]
+        if not self.max_per_shape: return stories
+        sampled, shapes, per_stratum = [], Counter(), Counter()
+        for story in stories:
+            stratum = self._stratum(story)
+            if shapes[story["shape"]] >= self.max_per_shape or per_stratum[stratum] >= self._capacity(stratum): continue
+            shapes[story["shape"]] += 1; per_stratum[stratum] += 1
+            sampled.append(story)
+        return sampled
+
+def build_jobs(master_seed, chunks_per_sequence=1, sampler="rejection", prune=True, batch_size=BATCH_SIZE, pool_size=None, stratify=False, quotas=None, config=None, max_per_shape=None):
+    """(設定, イベント順序, 試行チャンク) ごとのジョブを、出力順に並べて作成する
+
+    config (load_config の結果) の設定とイベント順序を使う。pool_size を省略すると config の値を使う。
+    max_per_shape を指定すると、各ジョブは同じ形 (story_shape) のストーリーをその件数までしかプールに入れない
+    (ジョブをまたいだ重複は、generate がリザーバをまとめるときに除く)。
+
+    quotas (load_quotas の結果) を指定すると、ファイルにある設定だけについて (設定, 試行チャンク) ごとのジョブを作る。
+    イベント順序を指定しない層はどの順序からでも埋められるよう、割り当てモードの1ジョブは全イベント順序を受け持つ。
+    """
+    config = config or load_config()
+    sequences, samples, max_attempts_per_seq = config["sequences"], config["samples_per_setting"], config["max_attempts_per_seq"]
+    jobs = []
+    stories_per_sequence = (pool_size or config["pool_size"]) // len(sequences)
+    # 各ジョブは最終サンプルに残りうる件数だけをリザーバに保持する (層別なら層ごとの割り当て数)
+    sample_sizes = split_evenly(samples, len(sequences)) if stratify else [samples] * len(sequences)
+    for setting in config["settings"]:
+        if quotas is not None:
+            if setting["label"] not in quotas: continue
+            max_attempts = split_evenly(max_attempts_per_seq * len(sequences), chunks_per_sequence)
+            for chunk in range(chunks_per_sequence):
+                # 割り当てモード: 生成したものはすべて出力に使うので、目標数とリザーバの大きさは割り当て数の合計
+                job_entries = [dict(entry, count=split_evenly(entry["count"], chunks_per_sequence)[chunk]) for entry in quotas[setting["label"]]]
+                target = sum(entry["count"] for entry in job_entries)
+                jobs.append({"setting": setting, "sequences": sequences, "sequence_name": "全イベント順序 (割り当てモード)", "chunk": chunk, "target": target, "max_attempts": max_attempts[chunk], "sampler": sampler, "prune": prune, "batch_size": batch_size, "reservoir_size": target, "stratify": False, "quotas": job_entries, "max_per_shape": max_per_shape, "seed": derive_seed(master_seed, setting["label"], "quotas", chunk)})
+            continue
+        for seq, sample_size in zip(sequences, sample_sizes):
             seq_name = " -> ".join(s.replace("_", "/") for s in seq)
+            targets, max_attempts = split_evenly(stories_per_sequence, chunks_per_sequence), split_evenly(max_attempts_per_seq, chunks_per_sequence)
+            for chunk in range(chunks_per_sequence):
+                jobs.append({"setting": setting, "sequences": [seq], "sequence_name": seq_name, "chunk": chunk, "target": targets[chunk], "max_attempts": max_attempts[chunk], "sampler": sampler, "prune": prune, "batch_size": batch_size, "reservoir_size": sample_size, "stratify": stratify, "quotas": None, "max_per_shape": max_per_shape, "seed": derive_seed(master_seed, setting["label"], seq_name, chunk)})
+    return jobs
+
+def run_generation_job(job):
+    """1ジョブ分のストーリーを生成する。ワーカープロセス内で実行され、ジョブ固有のシードだけに依存する
+
+    生成したストーリーはすべて保持せず、最終サンプルに残りうる分だけを StoryReservoir に入れて返す。
+    割り当てモードでは、まだ埋まっていない層があるイベント順序・構造・初期配置だけを試し、埋められる層がなくなったら止める。
+    プールに入れたストーリーの形は shapes に数え、max_per_shape に達した形は棄却する。
+    """
+    random.seed(job["seed"])
+    setting = job["setting"]
+    k_a, k_o, k_c, k_l = setting["k_a"], setting["k_o"], setting["k_c"], setting.get("k_l", K_LOCATIONS)
+    space = StructureSpace(k_a, k_c, k_l)
+    valid_structures = space.structures
+    # 語彙が足りない設定は試行しない (main で警告済み)
+    sequences = job["sequences"] if space and not check_world_size(dict(setting, k_l=k_l)) else []
+    reservoir = StoryReservoir(job["reservoir_size"], random.Random(derive_seed(job["seed"], "reservoir")), job["stratify"])
+    accepted, attempts, space_report, telemetry = 0, 0, {}, GenerationTelemetry()
+    trackers = {tuple(seq): PersistenceTracker(seq, prune_horizon(k_a, k_o, k_c)) for seq in sequences} if job["prune"] else {}
+    quotas = StratumQuotas(job["quotas"]) if job["quotas"] is not None else None
+    shapes, max_per_shape = Counter(), job.get("max_per_shape")
+    unfillable = set()  # 割り当ては残っているが、どの構造からも埋められないイベント順序
+    enumerators, strata, open_structures = {}, {}, {}
+
+    def reachable_strata(seq):
+        """イベント順序 seq で最後まで誤信念が残るストーリーを作れる (カテゴリ, パターン) の集合。
+        全列挙ならその結果を使い、厳密判定が重すぎる設定 (prune_horizon が計画より短い) では求めずに None を返す"""
+        if tuple(seq) not in strata:
+            if job["sampler"] == "enumerate": strata[tuple(seq)] = enumerators[tuple(seq)].strata
+            elif valid_structures is not None and prune_horizon(k_a, k_o, k_c) >= len(seq):
+                counter = trackers[tuple(seq)].counter if tuple(seq) in trackers else CompletionCounter(seq)
+                strata[tuple(seq)] = feasible_strata(valid_structures, k_o, counter)
+            else: strata[tuple(seq)] = None
+        return strata[tuple(seq)]
+
+    def can_fill(seq):
+        """イベント順序 seq で、まだ埋まっていない層のストーリーを作れるか。作れる層を求めない大きな設定では、
+        割り当てが残っていれば作れるとみなす (どの層にも作れる構造があることは check_quotas で確かめてある)"""
+        seq_name, reachable = " -> ".join(seq), reachable_strata(seq)
+        if reachable is None: return quotas.is_open(sequence=seq_name)
+        return any(quotas.is_open(category, pattern, seq_name) for category, pattern in reachable)
+
+    def update_unfillable():
+        """割り当てが変わったときに、もう埋められないイベント順序を unfillable に入れる (どの試行方法でも、候補がなくなれば止まる)"""
+        if quotas: unfillable.update(tuple(seq) for seq in sequences if tuple(seq) not in unfillable and not can_fill(seq))
+
+    def next_sequence(candidates):
+        """割り当てが残っているイベント順序から1つ選ぶ。候補が1つなら乱数を使わない"""
+        if quotas: candidates = [seq for seq in candidates if tuple(seq) not in unfillable and quotas.is_open(sequence=" -> ".join(seq))]
+        if len(candidates) <= 1: return candidates[0] if candidates else None
+        return random.choice(candidates)
+
+    def keep(story_data, key=None):
+        """同じ形が上限に達したストーリーを捨て、割り当てモードでは、まだ埋まっていない層に入るストーリーだけを残す。
+        形は max_per_shape を指定したときだけここで求める (指定しなければ main がサンプルしたストーリーについてだけ求める)"""
+        nonlocal accepted
+        describe_story(story_data)
+        if max_per_shape:
+            story_data["shape"] = record_shape(story_data["story_record"])
+            if shapes[story_data["shape"]] >= max_per_shape: return telemetry.reject("duplicate_shape", key=key)
+        if quotas and not quotas.accept(story_data["category"], story_data["pattern"], " -> ".join(story_data["action_sequence"])):
+            return telemetry.reject("quota_full", key=key)
+        reservoir.add(story_data); accepted += 1
+        if max_per_shape: shapes[story_data["shape"]] += 1
+        telemetry.accept(key)
+        update_unfillable()
+
+    if job["sampler"] == "enumerate":
+        # 全列挙モード: 有効なストーリーの総数を数え、棄却なしで一様にサンプリングする
+        for seq in sequences:
+            telemetry.begin(" -> ".join(seq), "enumerated", attempts=0)
+            enumerators[tuple(seq)] = StoryEnumerator(valid_structures, k_o, seq)
+            telemetry.lap("setup")
+        space_report = {" -> ".join(seq): enumerator.report() for seq, enumerator in enumerators.items()}
+        update_unfillable()
+        while accepted < job["target"] and attempts < job["max_attempts"]:
+            seq = next_sequence([seq for seq in sequences if enumerators[tuple(seq)].total])
+            if seq is None: break
+            attempts += 1
+            # 全列挙では構造ではなく並びを引くので、構造別の内訳は1つにまとめる
+            telemetry.begin(" -> ".join(seq), "enumerated")
+            story_data = enumerators[tuple(seq)].sample(random)
+            telemetry.lap("simulation")
+            keep(story_data)
+    elif job["sampler"] == "batch":
+        # バッチモード: 試行を batch_size 件ずつ NumPy でまとめてシミュレーションし、生き残りだけを文章化する
+        simulators, np_rng = {tuple(seq): BatchSimulator(space, k_o, seq) for seq in sequences}, np.random.default_rng(job["seed"])
+        update_unfillable()
+        while accepted < job["target"] and attempts < job["max_attempts"]:
+            seq = next_sequence(sequences)
+            if seq is None: break
+            batch_size = min(job["batch_size"], job["max_attempts"] - attempts)
+            attempts += batch_size
+            for key, survivor in simulators[tuple(seq)].simulate(batch_size, np_rng, telemetry):
+                if accepted >= job["target"]:
+                    telemetry.reject("target_reached", key=key); continue
+                story_data = simulators[tuple(seq)].replay(*survivor, rng=random)
+                telemetry.lap("simulation")
+                keep(story_data, key)
+    else:
+        structures, layout_filter = valid_structures, None
+        update_unfillable()
+        while accepted < job["target"] and attempts < job["max_attempts"]:
+            seq = next_sequence(sequences)
+            if seq is None: break
+            if quotas:
+                # 割り当てが埋まった層の構造は引かず、埋まった層の初期配置はシミュレーションしない (列挙しない設定では初期配置で判定する)
+                seq_name = " -> ".join(seq)
+                if valid_structures is not None:
+                    # 構造の絞り込みは、割り当てが埋まったとき (filled の合計が変わったとき) だけやり直す
+                    if open_structures.get(tuple(seq), (None,))[0] != sum(quotas.filled):
+                        open_structures[tuple(seq)] = (sum(quotas.filled), [st for st in valid_structures if quotas.fits_structure(st["la_partition"], st["lc_partition"], seq_name)])
+                    structures = open_structures[tuple(seq)][1]
+                    if not structures:
+                        # 残りの割り当てはこのイベント順序では埋められない (不足は main で層ごとに報告する)
+                        unfillable.add(tuple(seq))
+                        continue
+                reachable = reachable_strata(seq)
+                layout_filter = lambda category, pattern: quotas.is_open(category, pattern, seq_name) and (reachable is None or (category, pattern) in reachable)
+            attempts += 1
+            structure = random.choice(structures) if structures is not None else space.sample(random)
+            story_data = create_story_with_fb_detection(structure, k_a, k_o, k_c, k_l, target_action_plan=seq, tracker=trackers.get(tuple(seq)), layout_filter=layout_filter, telemetry=telemetry)
+            if not story_data: continue
+            unresolved = any(fb["end_step"] == "unresolved" for fb in story_data["false_belief_persistence"])
+            telemetry.lap("persistence")
+            if not story_data["has_false_belief"]: telemetry.reject("no_false_belief")
+            elif not unresolved: telemetry.reject("false_belief_resolved")
+            else: keep(story_data)
+    reservoir.rng = None  # 乱数状態はプロセス間で受け渡さない
+    pruned_by_step = Counter()
+    for tracker in trackers.values(): pruned_by_step.update(tracker.pruned_by_step)
+    return {"reservoir": reservoir, "space": space_report, "attempts": attempts, "pruned_by_step": dict(sorted(pruned_by_step.items())), "quotas": quotas.report() if quotas else None, "telemetry": telemetry, "shapes": shapes}
+
+# ---------------------------------------------------------------------------
+# 8. メイン実行部
+# ---------------------------------------------------------------------------
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description="誤信念が最後まで残るストーリーを生成する")
+    parser.add_argument("--workers", type=int, default=1, help="ジョブを分散するプロセス数 (1 なら単一プロセス)")
+    parser.add_argument("--seed", type=int, default=None, help="マスターシード (省略時はランダムに決めて表示する)")
+    parser.add_argument("--chunks-per-sequence", type=int, default=1, help="各イベント順序の試行を何ジョブに分割するか")
+    parser.add_argument("--no-prune", action="store_true", help="誤信念が最後まで残り得ない試行の途中打ち切りを無効にする")
+    parser.add_argument("--sampler", choices=["rejection", "enumerate", "batch"], default="rejection", help="rejection: 従来の棄却サンプリング / enumerate: 全列挙して一様サンプリング (総数を報告) / batch: NumPy で試行をまとめてシミュレーション")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="--sampler batch で1回にシミュレーションするストーリー数")
+    parser.add_argument("--pool-size", type=int, default=None, help=f"各設定で生成するストーリー数 (既定: 設定ファイルの pool_size または {POOL_SIZE_PER_SETTING}。メモリに保持するのはサンプル分だけ)")
+    parser.add_argument("--config", default=None, help="生成する設定・イベント順序・件数を書いた JSON (形式は load_config を参照)")
+    parser.add_argument("--settings", nargs="+", default=None, help="生成する設定のラベル (例: A3_O3_C3 A10_O10_C4_L5)。_L を省略すると場所数は 3")
+    parser.add_argument("--sequences", nargs="+", default=None, help="イベント順序をカンマ区切りで並べる (例: move,exit_enter,move,exit_enter,move,exit_enter,move,exit_enter)")
+    parser.add_argument("--stories-out", default=STORIES_JSON_PATH, help="ストーリーの出力先。.jsonl / .jsonl.gz などにすると1行1件の JSONL で書き出す")
+    parser.add_argument("--max-per-shape", type=int, default=None, help="名前の付け替えで一致するストーリー (同じ形) をプールと出力に入れる上限 (1 なら重複なし)。ジョブごとに数え、まとめるときにジョブをまたいでもう一度数える")
+    strata = parser.add_mutually_exclusive_group()
+    strata.add_argument("--stratify", action="store_true", help="イベント順序ごとに同数ずつサンプリングする")
+    strata.add_argument("--quotas", default=None, help="(カテゴリ, パターン, イベント順序) の層ごとの割り当て数を書いた JSON。指定すると各層をちょうど割り当て数だけ生成する。"
+                        "埋まっていない層の構造と初期配置だけを引くのは --sampler rejection のときで、enumerate / batch では生成したものを層で振り分けるだけ。"
+                        "どの方法でも、残りの層を埋められるイベント順序がなくなったら止まる")
+    return parser
+
+def parse_args():
+    return build_arg_parser().parse_args()
+
+def save_json(data, path, label):
+    print(f"✍️  {label}を {path} に保存しています...")
+    with open(path, "w", encoding='utf-8') as f: json.dump(data, f, ensure_ascii=False, indent=2)
+    print(f"✅ {label}の保存が完了しました。")
+
+def generate(args):
+    """ストーリーを生成し、ファイルには書かずに {"master_seed", "stories", "distribution", "telemetry", "story_space"} を返す"""
+    master_seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2**32)
+    print(f"Master seed: {master_seed} / workers: {args.workers} / chunks per sequence: {args.chunks_per_sequence}")
+    config = load_config(args.config, args.settings, args.sequences)
+    for setting in config["settings"]:
+        shortage = check_world_size(setting)
+        if shortage:
+            print(f"警告: {WORLD_PATH} の語彙が {setting['label']} に足りません ({', '.join(f'{kind}: {n} 必要 / {have} 件' for kind, (n, have) in shortage.items())})。この設定は生成されません。")
+    if args.sampler == "enumerate":
+        too_large = [s["label"] for s in config["settings"] if count_structures(s["k_a"], s["k_c"], s["k_l"]) > STRUCTURE_ENUM_LIMIT]
+        if too_large: raise SystemExit(f"全列挙 (--sampler enumerate) は構造の数が {STRUCTURE_ENUM_LIMIT} 以下の設定だけで使えます: {too_large}")
+    quotas = load_quotas(args.quotas) if args.quotas else None
+    if quotas: check_quotas(quotas, config)
+    jobs = build_jobs(master_seed, args.chunks_per_sequence, args.sampler, prune=not args.no_prune, batch_size=args.batch_size, pool_size=args.pool_size, stratify=args.stratify, quotas=quotas, config=config, max_per_shape=args.max_per_shape)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    # 結果は出力順に1ジョブずつ受け取り、設定ごとのリザーバにまとめてから捨てる
+    job_results = executor.map(run_generation_job, jobs) if executor else map(run_generation_job, jobs)
+
+    final_stories, per_setting_distribution, story_space, telemetry_output, instance_counter = [], defaultdict(Counter), {}, {}, 1
+    sampled_shapes = defaultdict(set)
+    sample_sizes = {tuple(job["sequences"][0]): job["reservoir_size"] for job in jobs} if args.stratify else config["samples_per_setting"]
+    for setting_label, job_group in groupby(zip(jobs, job_results), key=lambda pair: pair[0]["setting"]["label"]):
+        print(f"\n--- Processing setting: {setting_label} ---")
+        if quotas: sample_sizes = sum(entry["count"] for entry in quotas[setting_label])
+        # ジョブごとに上限まで入れた形が、ジョブをまたいで重なることがあるので、まとめたリザーバでもう一度上限をかける
+        reservoir = StoryReservoir(sample_sizes, None, args.stratify, args.max_per_shape)
+        attempts, pruned_by_step, filled, spaces, telemetry, shapes = Counter(), defaultdict(Counter), Counter(), {}, GenerationTelemetry(), Counter()
+        for job, result in job_group:
+            if job["chunk"] == 0 and result["space"]:
+                story_space.setdefault(setting_label, {}).update(result["space"])
+                spaces[job["sequence_name"]] = result["space"]
+            attempts[job["sequence_name"]] += result["attempts"]
+            pruned_by_step[job["sequence_name"]].update(result["pruned_by_step"])
+            reservoir.merge(result["reservoir"])
+            for entry in result["quotas"] or []: filled[entry["index"]] += entry["filled"]
+            telemetry.merge(result["telemetry"])
+            shapes.update(result["shapes"])
+        for seq_name in attempts:
             print(f"  Generating for sequence [{seq_name}]...")
-            attempts, successful_stories, MAX_ATTEMPTS_PER_SEQ = 0, 0, 200000
-            while successful_stories < stories_per_sequence and attempts < MAX_ATTEMPTS_PER_SEQ:
-                attempts += 1
-                story_data = create_story_with_fb_detection(random.choice(valid_structures), k_a, k_o, k_c, target_action_plan=seq)
-                if story_data and story_data["has_false_belief"]:
-                    belief_analysis = analyze_belief_persistence(story_data["simulation_log"])
-                    if any(fb["end_step"] == "unresolved" for fb in belief_analysis):
-                        story_data['false_belief_persistence'] = belief_analysis; story_pool.append(story_data); successful_stories += 1
-        print(f"プールに {len(story_pool)} 件の「最後まで誤信念が残る」ストーリーを生成しました。")
-        if len(story_pool) < 1000:
-            print(f"警告: プール内のストーリーが1000件未満のため、{setting_label} をスキップします。")
+            for seq_key, space in spaces.get(seq_name, {}).items():
+                print(f"    有効なストーリーの総数{'' if len(spaces[seq_name]) == 1 else f' [{seq_key}]'}: {space['num_stories']}")
+            if pruned_by_step[seq_name]:
+                by_step = ", ".join(f"step {step}: {count}" for step, count in sorted(pruned_by_step[seq_name].items()))
+                print(f"    試行 {attempts[seq_name]} 件中 {sum(pruned_by_step[seq_name].values())} 件を途中で打ち切りました ({by_step})")
+        telemetry_output[setting_label] = telemetry.report()
+        for seq_key, entry in telemetry_output[setting_label].items():
+            top_reasons = ", ".join(f"{reason} {r['total']}" for reason, r in sorted(entry["rejections"].items(), key=lambda item: -item[1]["total"])[:3])
+            print(f"  [{seq_key}] 試行 {entry['attempts']} 件 / 採用 {entry['accepted']} 件 (1件あたり {entry['attempts_per_accepted']} 試行) 主な棄却理由: {top_reasons or 'なし'}")
+        print(f"プールに {reservoir.total_seen()} 件の「最後まで誤信念が残る」ストーリーを生成しました" + (f" (名前を除いた形は {len(shapes)} 種類)。" if args.max_per_shape else "。"))
+        if quotas:
+            # 割り当てモード: 生成したものをすべて使う。埋まらなかった層は警告して統計に残し、そのまま出力する
+            for entry in quotas[setting_label]:
+                if filled[entry["index"]] < entry["count"]:
+                    stratum = ", ".join(f"{key}={entry[key]}" for key in ("category", "pattern", "sequence") if entry[key] is not None) or "全体"
+                    print(f"警告: 層 [{stratum}] は {entry['count']} 件中 {filled[entry['index']]} 件しか生成できませんでした。")
+                    telemetry_output[setting_label].setdefault("quota_shortfall", []).append({"index": entry["index"], "stratum": stratum, "count": entry["count"], "filled": filled[entry["index"]]})
+        elif reservoir.total_seen() < config["samples_per_setting"]:
+            print(f"警告: プール内のストーリーが{config['samples_per_setting']}件未満のため、{setting_label} をスキップします。")
             continue
-        print(f"プールから1000件をランダムサンプリングします...")
-        sampled_stories = random.sample(story_pool, 1000)
+        if args.stratify:
+            short = [" -> ".join(seq) for seq, quota in sample_sizes.items() if reservoir.seen[seq] < quota]
+            if short:
+                print(f"警告: 割り当て数に満たないイベント順序があるため、{setting_label} をスキップします: {short}")
+                continue
+        sampled_stories = reservoir.sample()
+        if args.max_per_shape and len(sampled_stories) < (sum(sample_sizes.values()) if isinstance(sample_sizes, dict) else sample_sizes):
+            print(f"警告: ジョブをまたいで同じ形が --max-per-shape を超えた分を除いたため、サンプルが {len(sampled_stories)} 件になりました。")
+        print(f"プールから{len(sampled_stories)}件をランダムサンプリングします...")
         for story_data in sampled_stories:
+            if "shape" not in story_data: story_data["shape"] = record_shape(story_data["story_record"])
             sequence_tuple = tuple(story_data['action_sequence'])
             per_setting_distribution[setting_label][sequence_tuple] += 1
-            final_stories.append({"instance_index": instance_counter, "setting": setting_label, "has_false_belief": story_data["has_false_belief"], "initial_state": story_data["initial_state_sentences"], "simulation_log": story_data["simulation_log"], "full_story": story_data["full_story"], "false_belief_persistence": story_data["false_belief_persistence"]})
+            sampled_shapes[setting_label].add(story_data["shape"])
+            final_stories.append({"instance_index": instance_counter, "setting": setting_label, "has_false_belief": story_data["has_false_belief"], "initial_state": story_data["initial_state_sentences"], "simulation_log": story_data["simulation_log"], "full_story": story_data["full_story"], "story_record": story_data["story_record"], "false_belief_persistence": story_data["false_belief_persistence"], "shape": story_data["shape"]})
             instance_counter += 1
-    print(f"\n✍️  {len(final_stories)} 件のサンプリング結果を {STORIES_JSON_PATH} に保存しています...")
-    with open(STORIES_JSON_PATH, "w", encoding='utf-8') as f: json.dump(final_stories, f, ensure_ascii=False, indent=2)
-    print("✅ ストーリーの保存が完了しました。")
-    print(f"✍️  イベント順序の分布を {DISTRIBUTION_JSON_PATH} に保存しています...")
+    if executor: executor.shutdown()
     analysis_output = {}
     for setting, counter in sorted(per_setting_distribution.items()):
         total_for_setting = sum(counter.values())
@@ -255,9 +1367,27 @@ def main():
         for sequence, count in sorted(counter.items(), key=lambda item: item[1], reverse=True):
             percentage = (count / total_for_setting) * 100
             sequences.append({"sequence": " -> ".join(sequence), "count": count, "percentage": f"{percentage:.1f}%"})
-        analysis_output[setting] = {"total_samples": total_for_setting, "distribution": sequences}
-    with open(DISTRIBUTION_JSON_PATH, "w", encoding='utf-8') as f: json.dump(analysis_output, f, ensure_ascii=False, indent=2)
-    print("✅ 分布データの保存が完了しました。")
+        analysis_output[setting] = {"total_samples": total_for_setting, "unique_shapes": len(sampled_shapes[setting]), "distribution": sequences}
+    return {"master_seed": master_seed, "stories": final_stories, "distribution": analysis_output, "telemetry": telemetry_output, "story_space": story_space}
+
+def save_stories(stories, path):
+    """ストーリーを1件ずつ書き出す (拡張子が .jsonl なら JSONL、それ以外は従来どおりインデント付きの JSON 配列)"""
+    print(f"✍️  {len(stories)} 件のサンプリング結果を {path} に保存しています...")
+    with RecordWriter(path) as writer:
+        for story in stories: writer.write(story)
+    print("✅ ストーリーの保存が完了しました。")
+
+def save_generation_stats(result):
+    save_json(result["distribution"], DISTRIBUTION_JSON_PATH, "イベント順序の分布")
+    save_json(result["telemetry"], TELEMETRY_JSON_PATH, "生成の統計 (棄却理由・試行数・所要時間)")
+    if result["story_space"]: save_json(result["story_space"], STORY_SPACE_JSON_PATH, "ストーリー空間の大きさ")
+
+def main():
+    args = parse_args()
+    result = generate(args)
+    print()
+    save_stories(result["stories"], args.stories_out)
+    save_generation_stats(result)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
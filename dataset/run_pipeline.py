@@ -0,0 +1,53 @@
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import analyze_patterns
+import create_test
+import generate_benchmark_story_detect as generator
+from story_parser import StoryParser
+
+# ---------------------------------------------------------------------------
+# ストーリー生成 → QA 作成 → パターン分類を1プロセスでつなぐ。
+# ストーリーはメモリのまま次の段へ渡し、stories.json などの成果物は指定したものだけ書き出す
+# ---------------------------------------------------------------------------
+PATTERN_OUT_PATH = "pattern.json"
+
+def parse_args():
+    parser = generator.build_arg_parser()
+    parser.description = "ストーリーの生成から QA の作成、パターンの分類までを、中間ファイルを読み書きせずに実行する"
+    # --stories-out は生成器のオプションをそのまま使い、既定では書き出さない
+    parser.set_defaults(stories_out=None)
+    sinks = parser.add_argument_group("書き出す成果物 (指定したものだけ書き出す。パスを省略すると各スクリプトと同じファイル名。.jsonl / .jsonl.gz などなら JSONL)")
+    sinks.add_argument("--qa-out", nargs="?", const=str(create_test.QA_OUT_PATH), default=None, help="QA セット (qa_sets.json と同じ形式)")
+    sinks.add_argument("--patterns-out", nargs="?", const=PATTERN_OUT_PATH, default=None, help="A3_O3_C3 の配置パターンの分類 (pattern.json と同じ形式)")
+    sinks.add_argument("--stats-out", action="store_true", help="イベント順序の分布・生成の統計・ストーリー空間の大きさを生成器と同じファイルに書き出す")
+    parser.add_argument("--qa-chunk-size", type=int, default=create_test.CHUNK_SIZE, help="QA 作成で1回にワーカーへ渡すストーリー数")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    result = generator.generate(args)
+    stories = result["stories"]
+    print()
+    if args.stories_out: generator.save_stories(stories, args.stories_out)
+    if args.stats_out: generator.save_generation_stats(result)
+
+    # QA は生成と同じマスターシードで作る (書き出した stories.json に create_test.py --seed を使ったときと同じ問題になる)
+    parser = StoryParser.load(create_test.WORLD_PATH)
+    executor = ProcessPoolExecutor(max_workers=args.workers) if args.workers > 1 else None
+    qa_sets = create_test.build_qa_sets(enumerate(create_test.chunked(stories, args.qa_chunk_size)), parser, result["master_seed"], executor, args.qa_chunk_size, args.workers)
+    n_stories, n_qa_sets, qa_counts = create_test.write_qa_sets(qa_sets, Path(args.qa_out) if args.qa_out else None)
+    if executor: executor.shutdown()
+    if args.qa_out: print(f"✅ {n_qa_sets}件のストーリーから課題を生成し、{args.qa_out} に保存しました。")
+    create_test.print_qa_summary(n_stories, qa_counts)
+
+    patterns = analyze_patterns.classify_patterns(stories, parser)
+    print("\n--- 配置パターンの分類 (A3_O3_C3) ---")
+    print(json.dumps(patterns["analysis_summary"], ensure_ascii=False))
+    for category, count in patterns["pattern_category_distribution"].items():
+        print(f"  - {category:<6}: {count}件")
+    if args.patterns_out: analyze_patterns.save_patterns(patterns, args.patterns_out)
+
+if __name__ == "__main__":
+    main()
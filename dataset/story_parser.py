@@ -0,0 +1,106 @@
+import json
+from pathlib import Path
+
+# ---------------------------------------------------------------------------
+# 1. 設定とグローバル変数
+# ---------------------------------------------------------------------------
+WORLD_PATH = Path("world.json")
+MOVE, EXIT_ENTER = "move", "exit_enter"  # story_record のイベントの種類
+WORLD_KINDS = {"agents": "agent", "objects": "object", "containers": "container", "locations": "location"}
+# 関係を表す語 ("was/were in the" の in など)。ここにない語 (The, was, and, No one など) は読み飛ばす
+RELATION_WORDS = {"in": "in", "moved": "moved", "to": "to", "exited": "exited", "entered": "entered"}
+# 主語を直前の組の対象から取る関係 ("A moved the X to the C" の to の主語は X)。それ以外で主語がなければ直前の組の主語を使う
+TARGET_SUBJECT_RELATIONS = {"to"}
+PARSE_CACHE_SIZE = 200000  # 解析結果を覚えておく文章の数 (同じ文章は多くのストーリーに繰り返し出てくる)。超えたら忘れて覚え直す
+
+# ---------------------------------------------------------------------------
+# 2. パーサー
+# ---------------------------------------------------------------------------
+class StoryParser:
+    """world.json の語彙を単語単位のトライに一度だけまとめ、ストーリーの文章を1回の走査で (実体, 関係, 対象) の組にする。
+    実体と対象は (種類, 名前) で、種類は agent / object / container / location"""
+    def __init__(self, vocabulary: dict):
+        self.trie = {}
+        for kind, names in vocabulary.items():
+            for name in names:
+                node = self.trie
+                for word in name.split(): node = node.setdefault(word, {})
+                node[None] = (kind, name)  # None のキーに語彙の終端を置く
+        # 名前がすべて1語なら、トライをたどらず1語ずつ辞書を引くだけでよい (語彙を関係の語より優先する)
+        self.multiword = any(len(name.split()) > 1 for names in vocabulary.values() for name in names)
+        self.lexicon = {**RELATION_WORDS, **{word: node[None] for word, node in self.trie.items() if None in node}}
+        self.cache, self.event_cache = {}, {}
+
+    def __getstate__(self):
+        return dict(self.__dict__, cache={}, event_cache={})  # ワーカーへ渡すときは解析結果の記憶を持たせない
+
+    @classmethod
+    def from_world(cls, world_data: dict):
+        return cls({kind: world_data.get(key, []) for key, kind in WORLD_KINDS.items()})
+
+    @classmethod
+    def load(cls, path: Path = WORLD_PATH):
+        return cls.from_world(json.loads(Path(path).read_text(encoding="utf-8")))
+
+    def tokens(self, sentence: str):
+        """文章を (種類, 名前) の実体と関係の語の列にする。語彙は最長一致で取る"""
+        words = sentence.replace(",", " ").rstrip(".").split()
+        if not self.multiword: return [self.lexicon[word] for word in words if word in self.lexicon]
+        tokens, i, n = [], 0, len(words)
+        while i < n:
+            node = self.trie.get(words[i])
+            if node is None:
+                relation = RELATION_WORDS.get(words[i])
+                if relation: tokens.append(relation)
+                i += 1
+                continue
+            # 複数語の名前に備えて、トライをたどれる限り先へ進み、最後に見つかった終端を取る
+            match, end, j = node.get(None), i + 1, i + 1
+            while j < n and words[j] in node:
+                node, j = node[words[j]], j + 1
+                if None in node: match, end = node[None], j
+            if match: tokens.append(match)
+            i = end
+        return tokens
+
+    def parse(self, sentence: str):
+        """文章を (実体, 関係, 対象) の組のタプルにする。"The X and Y were in the C." なら X と Y の2組になる"""
+        cached = self.cache.get(sentence)
+        if cached is not None: return cached
+        triples, subjects, relation = [], [], None
+        for token in self.tokens(sentence):
+            if token.__class__ is str:
+                if relation: break  # 対象のない関係は読まない
+                relation = token
+            elif relation is None: subjects.append(token)
+            else:
+                if not subjects and triples: subjects = [triples[-1][2] if relation in TARGET_SUBJECT_RELATIONS else triples[-1][0]]
+                triples.extend((subject, relation, token) for subject in subjects)
+                subjects, relation = [], None
+        if len(self.cache) >= PARSE_CACHE_SIZE: self.cache.clear()
+        self.cache[sentence] = triples = tuple(triples)
+        return triples
+
+    def parse_initial_state(self, sentences: list):
+        """初期状態の文章から {種類: {名前: いる場所 (部屋またはコンテナ)}} を作る"""
+        state = {kind: {} for kind in WORLD_KINDS.values()}
+        for sentence in sentences:
+            for (kind, name), relation, (_, place) in self.parse(sentence):
+                if relation == "in": state[kind][name] = place
+        return state
+
+    def story_initial_state(self, story: dict):
+        """ストーリーの初期状態を parse_initial_state と同じ形で返す。生成器が書いた story_record があれば文章を解析しない"""
+        record = story.get("story_record")
+        if record: return {"agent": dict(record["agents"]), "object": dict(record["objects"]), "container": dict(record["containers"]), "location": {}}
+        return self.parse_initial_state(story["initial_state"])
+
+    def parse_event(self, sentence: str):
+        """イベントの文章を story_record と同じ (行動の種類, エージェント, 対象, 行き先) にする。解析できなければ None"""
+        if sentence in self.event_cache: return self.event_cache[sentence]
+        relations, event = {relation: (subject[1], target[1]) for subject, relation, target in self.parse(sentence)}, None
+        if "moved" in relations and "to" in relations: event = (MOVE, relations["moved"][0], relations["moved"][1], relations["to"][1])
+        elif "exited" in relations and "entered" in relations: event = (EXIT_ENTER, relations["exited"][0], relations["exited"][1], relations["entered"][1])
+        if len(self.event_cache) >= PARSE_CACHE_SIZE: self.event_cache.clear()
+        self.event_cache[sentence] = event
+        return event
@@ -0,0 +1,5 @@
+# ---------------------------------------------------------------------------
+# モデルの評価。リポジトリのルートからモジュールとして実行する (成果物の読み書きは dataset.artifacts を使う)
+#   python -m evaluate_model.evaluate_gpt --qa-sets dataset/qa_sets.json
+#   python -m evaluate_model.evaluate_llama --qa-sets dataset/qa_sets.json
+# ---------------------------------------------------------------------------
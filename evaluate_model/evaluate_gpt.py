@@ -1,13 +1,22 @@
+import argparse
+import asyncio
 import json
+import random
 import re
 import string
 import os
-from collections import defaultdict
-from openai import OpenAI
+import time
+from collections import defaultdict, deque
+from openai import AsyncOpenAI, APIConnectionError, APIStatusError, InternalServerError, RateLimitError
 from tqdm import tqdm
 from pathlib import Path
 from dotenv import load_dotenv # ★ 1. .envファイルを読み込むライブラリをインポート
 
+from dataset.artifacts import RecordWriter, iter_records
+from .prompts import PACKED, PACKED_FALLBACK, SINGLE, build_packed_prompt, build_prompt, iter_prompt_groups, parse_packed_answers
+from .result_log import ResultLog, pending_tasks
+from .response_cache import add_cache_arguments, cache_key, open_cache
+
 # ---------------------------------------------------------------------------
 # 1. 設定とグローバル変数
 # ---------------------------------------------------------------------------
@@ -16,12 +25,22 @@ MODEL_NAME = "gpt-4.1-mini"
 QA_SETS_PATH = Path("qa_sets.json")
 RESULTS_PATH = Path(f"evaluation_results_{MODEL_NAME.replace('/', '_')}.json")
 SUMMARY_PATH = Path(f"evaluation_summary_{MODEL_NAME.replace('/', '_')}.json")
+LOG_PATH = Path(f"evaluation_log_{MODEL_NAME.replace('/', '_')}.jsonl")  # 1問ずつ追記する結果のログ (再開に使う)
+MAX_TOKENS = 50
+MAX_CONCURRENCY = 16  # 同時に投げるリクエスト数
+READ_AHEAD = 4  # 入力順に書き出すため、同時実行数の何倍まで先の設問を投げておくか
+REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE = 500, 200000  # アカウントの上限に合わせて --rpm / --tpm で変える
+CHARS_PER_TOKEN = 4  # 送るトークン数の見積もり (文字数 / 4 + 回答の上限)
+MAX_RETRIES = 6  # 429 / 5xx / 通信エラーをやり直す回数
+BACKOFF_BASE, BACKOFF_MAX = 1.0, 60.0  # やり直しの待ち時間 (秒) は BACKOFF_BASE * 2^回数 を上限 BACKOFF_MAX で切り、ゆらぎを加える
+SYSTEM_PROMPT = "You are an expert in reading comprehension. Answer the following question based ONLY on the text provided in the story. Provide only the answer, without any introductory phrases or explanations."
 
 # ---------------------------------------------------------------------------
 # 2. モデルの準備 (★修正箇所)
 # ---------------------------------------------------------------------------
-def setup_llm_client():
-    """環境変数または.envファイルからAPIキーを読み込み、OpenAIクライアントをセットアップする"""
+def setup_llm_client(base_url=None):
+    """環境変数または.envファイルからAPIキーを読み込み、OpenAIクライアントをセットアップする。
+    base_url を渡すと、chat completions API を話す別のサーバー (手元の代役サーバーなど) に問い合わせる"""
     print(f"Setting up client for model: {MODEL_NAME}...")
     try:
         # ▼▼▼ 修正: .envファイルを読み込む処理を追加 ▼▼▼
@@ -33,7 +52,8 @@ def setup_llm_client():
             print(".envファイルにキーを設定したか、または環境変数として設定されているか確認してください。")
             exit()
             
-        client = OpenAI(api_key=api_key)
+        # やり直しは ask_llm で待ち時間を管理するので、SDK 自身の再試行は切る
+        client = AsyncOpenAI(api_key=api_key, base_url=base_url or os.getenv("OPENAI_BASE_URL") or None, max_retries=0)
         return client
     except Exception as e:
         print(f"Error setting up OpenAI client: {e}")
@@ -42,25 +62,75 @@ def setup_llm_client():
 # ---------------------------------------------------------------------------
 # 3. LLMとの対話と評価
 # ---------------------------------------------------------------------------
-def ask_llm(prompt: str, client: OpenAI):
-    """プロンプトを整形し、OpenAIのモデルに問い合わせて回答を抽出する"""
+class RateLimiter:
+    """1分あたりの上限 (リクエスト数やトークン数) を、少しずつ補充されるバケツで守る"""
+    def __init__(self, per_minute: float):
+        self.capacity = self.available = float(per_minute)
+        self.rate, self.updated, self.lock = per_minute / 60.0, time.monotonic(), asyncio.Lock()
+
+    async def acquire(self, amount: float = 1):
+        amount = min(amount, self.capacity)  # 1回で上限を超える要求は、満タンになるまで待って通す
+        async with self.lock:  # 待っている順に通す
+            while True:
+                now = time.monotonic()
+                self.available, self.updated = min(self.capacity, self.available + (now - self.updated) * self.rate), now
+                if self.available >= amount:
+                    self.available -= amount
+                    return
+                await asyncio.sleep((amount - self.available) / self.rate)
+
+def backoff_delay(attempt: int, error: Exception) -> float:
+    """サーバーが Retry-After を返していればそれに従い、なければ指数的に延ばした時間にゆらぎを加える"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("retry-after") if response is not None else None
+    try:
+        if retry_after: return min(BACKOFF_MAX, float(retry_after))
+    except ValueError: pass
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+async def ask_llm(prompt: str, client: AsyncOpenAI, limiters, max_retries: int = MAX_RETRIES, cache=None, max_tokens: int = MAX_TOKENS):
+    """プロンプトを整形し、OpenAIのモデルに問い合わせて (回答, エラー) を返す。
+    キャッシュに同じ問い合わせの回答があればそれを返す (replay ならなくても問い合わせない)。
+    429 / 5xx / 通信エラーは待ってやり直し、やり直しても失敗したら回答を None、エラーに理由を入れて返す。
+    本文のない応答やそれ以外の例外もやり直さずにエラーとして返す (評価は止めず、再開したときにもう一度聞く)"""
+    params = {"max_tokens": max_tokens, "temperature": 0.0, "top_p": 1.0}
+    key = cache_key(MODEL_NAME, SYSTEM_PROMPT, prompt, params) if cache else None
+    if cache:
+        answer = cache.get(key)
+        if answer is not None: return answer, None
+        if cache.readonly: return None, "CacheMiss: replay モードでキャッシュに回答がありません"
     messages = [
-        {"role": "system", "content": "You are an expert in reading comprehension. Answer the following question based ONLY on the text provided in the story. Provide only the answer, without any introductory phrases or explanations."},
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": prompt},
     ]
-    try:
-        response = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=messages,
-            max_tokens=50,
-            temperature=0.0,
-            top_p=1.0,
-        )
-        answer = response.choices[0].message.content.strip()
-        return answer
-    except Exception as e:
-        print(f"An error occurred during API call: {e}")
-        return "ERROR: API call failed"
+    request_limiter, token_limiter = limiters
+    estimated_tokens = (len(SYSTEM_PROMPT) + len(prompt)) // CHARS_PER_TOKEN + max_tokens
+    for attempt in range(max_retries + 1):
+        await request_limiter.acquire(1)
+        await token_limiter.acquire(estimated_tokens)
+        try:
+            response = await client.chat.completions.create(
+                model=MODEL_NAME,
+                messages=messages,
+                **params,
+            )
+            content = response.choices[0].message.content
+            if content is None:  # コンテンツフィルタなどで本文が返らなかったもの。キャッシュには入れない
+                return None, f"EmptyResponse: finish_reason={response.choices[0].finish_reason}"
+            answer = content.strip()
+            if cache: cache.put(key, answer)
+            return answer, None
+        except (RateLimitError, InternalServerError, APIConnectionError) as e:
+            error = e
+            if attempt < max_retries: await asyncio.sleep(backoff_delay(attempt, e))
+        except APIStatusError as e:  # 400 など、やり直しても結果が変わらないもの
+            error = e
+            break
+        except Exception as e:  # 想定外の失敗も評価全体は止めず、この設問の失敗として記録する
+            error = e
+            break
+    print(f"An error occurred during API call: {error}")
+    return None, f"{type(error).__name__}: {error}"
 
 def are_answers_equivalent(llm_answer: str, ground_truth: str) -> bool:
     """LLMの回答と正解を比較し、正誤を判定する"""
@@ -83,59 +153,126 @@ def are_answers_equivalent(llm_answer: str, ground_truth: str) -> bool:
 # ---------------------------------------------------------------------------
 # 4. メイン処理
 # ---------------------------------------------------------------------------
-def main():
-    llm_client = setup_llm_client()
-
-    print(f"Loading data from {QA_SETS_PATH}...")
-    try:
-        qa_sets = json.loads(QA_SETS_PATH.read_text(encoding="utf-8"))
-    except FileNotFoundError:
-        print(f"エラー: 入力ファイル {QA_SETS_PATH} が見つかりません。")
-        return
-
-    tasks_to_evaluate = []
+def iter_tasks(qa_sets):
+    """QA セットを1件ずつ受け取り、評価する設問を1問ずつ返す"""
     for qa_set in qa_sets:
         story_text = "\n".join(qa_set['full_story'])
         for qa_category, qa_list in qa_set.items():
             if not qa_category.endswith("_QA") or not qa_list:
                 continue
             for qa_pair in qa_list:
-                tasks_to_evaluate.append({
+                yield {
                     "instance_index": qa_set["instance_index"],
                     "qa_category": qa_category,
                     "full_story_text": story_text,
                     "question": qa_pair['question'],
                     "ground_truth_answer": qa_pair['answer'],
                     "setting": qa_set.get("setting", "unknown"),
-                })
+                }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=f"{MODEL_NAME} で QA セットを評価する")
+    parser.add_argument("--qa-sets", type=Path, default=QA_SETS_PATH, help="入力の QA セット (JSON 配列または JSONL。.gz / .bz2 / .xz の圧縮も可)")
+    parser.add_argument("--results-out", type=Path, default=RESULTS_PATH, help="設問ごとの結果の出力先 (.jsonl / .jsonl.gz なら1行1問の JSONL)")
+    parser.add_argument("--summary-out", type=Path, default=SUMMARY_PATH, help="カテゴリごとの正答率などの集計の出力先 (JSON)")
+    parser.add_argument("--concurrency", type=int, default=MAX_CONCURRENCY, help="同時に投げるリクエスト数")
+    parser.add_argument("--rpm", type=float, default=REQUESTS_PER_MINUTE, help="1分あたりのリクエスト数の上限")
+    parser.add_argument("--tpm", type=float, default=TOKENS_PER_MINUTE, help="1分あたりのトークン数 (見積もり) の上限")
+    parser.add_argument("--max-retries", type=int, default=MAX_RETRIES, help="429 / 5xx / 通信エラーをやり直す回数")
+    parser.add_argument("--base-url", default=None, help="chat completions API の URL (既定は環境変数 OPENAI_BASE_URL、なければ OpenAI)")
+    parser.add_argument("--log", type=Path, default=LOG_PATH, help="1問ずつ追記する結果のログ (JSONL)。あれば答え終わった設問を飛ばして再開する")
+    parser.add_argument("--fresh", action="store_true", help="ログを消して最初から評価する")
+    parser.add_argument("--packed", action="store_true", help="1つのストーリーの設問をまとめて1回で聞く (結果の prompt_mode で single と比べられる)")
+    add_cache_arguments(parser)
+    return parser.parse_args()
+
+def grade(task: dict, answer, error, prompt_mode: str):
+    task['llm_answer'], task['prompt_mode'] = answer, prompt_mode
+    if error is None: task['is_correct'] = are_answers_equivalent(answer, task['ground_truth_answer'])
+    else: task['is_correct'], task['error'] = None, error  # 問い合わせの失敗は不正解にしない
+    return task
+
+async def evaluate_in_order(tasks, client, args, cache=None):
+    """設問を同時に最大 args.concurrency 件ずつ問い合わせ、結果は入力と同じ順に1件ずつ返す。
+    args.packed なら同じストーリーの設問を1回で聞き、読み取れなかった設問だけを1問ずつ聞き直す。
+    先に投げておくのは同時実行数の READ_AHEAD 倍までなので、遅い1問があっても読み込みは際限なく進まない"""
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limiters = (RateLimiter(args.rpm), RateLimiter(args.tpm))
 
-    evaluation_details = []
-    print(f"Starting evaluation of {len(tasks_to_evaluate)} questions with {MODEL_NAME}...")
+    async def ask(prompt, max_tokens=MAX_TOKENS):
+        async with semaphore:
+            return await ask_llm(prompt, client, limiters, args.max_retries, cache, max_tokens)
+
+    async def evaluate(group):
+        if len(group) == 1:
+            return [grade(group[0], *await ask(build_prompt(group[0])), SINGLE)]
+        reply, error = await ask(build_packed_prompt(group), MAX_TOKENS * len(group))
+        answers = parse_packed_answers(reply, len(group)) if error is None else [None] * len(group)
+        retries = [task for task, answer in zip(group, answers) if answer is None]
+        for task, answer in zip(group, answers):
+            if answer is not None: grade(task, answer, None, PACKED)
+        for task, (answer, error) in zip(retries, await asyncio.gather(*(ask(build_prompt(task)) for task in retries))):
+            grade(task, answer, error, PACKED_FALLBACK)
+        return group
+
+    pending = deque()
+    for group in iter_prompt_groups(tasks, args.packed):
+        pending.append(asyncio.ensure_future(evaluate(group)))
+        if len(pending) >= args.concurrency * READ_AHEAD: yield await pending.popleft()
+    while pending: yield await pending.popleft()
+
+async def run_evaluation(tasks, llm_client, cache, log, args):
+    with tqdm(desc="Evaluating Questions") as progress:
+        async for group in evaluate_in_order(tasks, llm_client, args, cache):
+            for task in group: log.append(task)
+            progress.update(len(group))
+
+def main():
+    args = parse_args()
+    # replay はキャッシュだけで評価するので、API キーもクライアントもいらない
+    llm_client = setup_llm_client(args.base_url) if args.cache_mode != "replay" else None
+
+    print(f"Loading data from {args.qa_sets}...")
+    if not args.qa_sets.exists():
+        print(f"エラー: 入力ファイル {args.qa_sets} が見つかりません。")
+        return
+    if args.log.resolve() == args.results_out.resolve():
+        print("エラー: --log と --results-out には別のファイルを指定してください。")
+        return
+
+    # QA セットは1件ずつ読み、結果は1問ずつログに追記する。集計と結果ファイルは最後にログから作る
+    log = ResultLog(args.log, fresh=args.fresh)
+    if log.completed: print(f"Resuming from {args.log}: {len(log.completed)} questions already answered")
+    all_keys = {}  # 評価するすべての設問のキー (入力の順)。結果ファイルはこの順に書く
+    tasks = pending_tasks(iter_tasks(iter_records(args.qa_sets)), log, all_keys)
+    print(f"Starting evaluation with {MODEL_NAME}...")
     
-    for task in tqdm(tasks_to_evaluate, desc="Evaluating Questions"):
-        prompt = (
-            "Please read the following story and answer the subsequent question.\n\n"
-            "--- STORY ---\n"
-            f"{task['full_story_text']}\n"
-            "--- END OF STORY ---\n\n"
-            f"Question: {task['question']}"
-        )
-        llm_answer = ask_llm(prompt, llm_client)
-        is_correct = are_answers_equivalent(llm_answer, task['ground_truth_answer'])
-        
-        task['llm_answer'] = llm_answer
-        task['is_correct'] = is_correct
-        evaluation_details.append(task)
+    cache = open_cache(args.cache, args.cache_mode, args.cache_max_entries)
+    try:
+        with log:
+            asyncio.run(run_evaluation(tasks, llm_client, cache, log, args))
+            # 問い合わせに失敗した設問は正答率から除き、カテゴリごとに件数だけ数える
+            category_stats = defaultdict(lambda: {"correct": 0, "total": 0})
+            failed_stats = defaultdict(int)
+            mode_stats = defaultdict(lambda: {"correct": 0, "total": 0})  # packed と single の正答率を比べる
+            with RecordWriter(args.results_out) as writer:
+                for task in log.iter_results(all_keys):
+                    writer.write(task)
+                    if task['is_correct'] is None:
+                        failed_stats[task["qa_category"]] += 1
+                        continue
+                    category_stats[task["qa_category"]]["total"] += 1
+                    mode_stats[task.get("prompt_mode", SINGLE)]["total"] += 1
+                    if task['is_correct']:
+                        category_stats[task["qa_category"]]["correct"] += 1
+                        mode_stats[task.get("prompt_mode", SINGLE)]["correct"] += 1
+    finally:
+        if cache:
+            print(f"Response cache ({args.cache_mode}): {cache.stats()}")
+            cache.close()
 
     print("\n--- Evaluation Summary ---")
     summary_data = {"overall_accuracy": {}, "accuracy_by_category": {}}
-    category_stats = defaultdict(lambda: {"correct": 0, "total": 0})
-    
-    for detail in evaluation_details:
-        cat = detail["qa_category"]
-        category_stats[cat]["total"] += 1
-        if detail["is_correct"]:
-            category_stats[cat]["correct"] += 1
             
     overall_correct = sum(d['correct'] for d in category_stats.values())
     overall_total = sum(d['total'] for d in category_stats.values())
@@ -158,13 +295,20 @@ def main():
             }
             print(f"  - {category:<20}: {accuracy:.2%} ({data['correct']}/{data['total']})")
 
-    with open(RESULTS_PATH, 'w', encoding='utf-8') as f:
-        json.dump(evaluation_details, f, ensure_ascii=False, indent=2)
-    print(f"\nFull raw results saved to {RESULTS_PATH}")
+    if set(mode_stats) != {SINGLE}:
+        for mode, data in sorted(mode_stats.items()):
+            summary_data.setdefault("accuracy_by_prompt_mode", {})[mode] = {"accuracy": data['correct'] / data['total'], "correct": data['correct'], "total": data['total']}
+            print(f"  - prompt_mode {mode:<15}: {data['correct'] / data['total']:.2%} ({data['correct']}/{data['total']})")
+
+    if failed_stats:
+        summary_data["failed_requests"] = {"total": sum(failed_stats.values()), "by_category": dict(sorted(failed_stats.items()))}
+        print(f"Failed requests (excluded from accuracy): {summary_data['failed_requests']['total']}")
+
+    print(f"\nFull raw results saved to {args.results_out}")
     
-    with open(SUMMARY_PATH, 'w', encoding='utf-8') as f:
+    with open(args.summary_out, 'w', encoding='utf-8') as f:
         json.dump(summary_data, f, ensure_ascii=False, indent=2)
-    print(f"Summary saved to {SUMMARY_PATH}")
+    print(f"Summary saved to {args.summary_out}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
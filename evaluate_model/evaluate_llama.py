@@ -1,13 +1,20 @@
+import argparse
 import json
-import random
 import re
 import string
+import time
 from collections import defaultdict
+from itertools import groupby, islice
 import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
 from tqdm import tqdm
 from pathlib import Path
 
+from dataset.artifacts import RecordWriter, iter_records
+from .prompts import PACKED, PACKED_FALLBACK, SINGLE, build_packed_prompt, build_prompt, iter_prompt_groups, parse_packed_answers
+from .result_log import ResultLog, pending_tasks
+from .response_cache import add_cache_arguments, cache_key, open_cache
+
 # ---------------------------------------------------------------------------
 # 1. 設定とグローバル変数
 # ---------------------------------------------------------------------------
@@ -16,17 +23,22 @@ MODEL_NAME = "meta-llama/Meta-Llama-3-8B-Instruct"
 QA_SETS_PATH = Path("qa_sets.json")
 RESULTS_PATH = Path("evaluation_results.json")
 SUMMARY_PATH = Path("evaluation_summary.json")
+LOG_PATH = Path("evaluation_log.jsonl")  # 1問ずつ追記する結果のログ (再開に使う)
+SYSTEM_PROMPT = "You are an expert in reading comprehension. Answer the following question based ONLY on the text provided in the story. Provide only the answer, without any introductory phrases or explanations."
+GENERATION_PARAMS = {"max_new_tokens": 50, "do_sample": False, "temperature": 0.0}
+DTYPES = ("bfloat16", "float16", "float32", "auto")  # --dtype で選べる重みの型 (auto ならモデルの設定に従う)
+BUCKET_WINDOW = 16  # --batch-size のとき、何バッチ分の設問を読んでから長さ順に並べ替えてバッチに分けるか
 
 # ---------------------------------------------------------------------------
 # 2. モデルの準備
 # ---------------------------------------------------------------------------
-def load_model():
-    """LLMモデルとトークナイザをロードする"""
-    print(f"Loading model and tokenizer: {MODEL_NAME}...")
+def load_model(model_name: str = MODEL_NAME, dtype: str = "bfloat16", device_map: str = "auto"):
+    """LLMモデルとトークナイザをロードする。dtype は DTYPES のどれか、device_map は "auto" / "cpu" / "cuda:0" など"""
+    print(f"Loading model and tokenizer: {model_name} ({dtype}, device_map={device_map})...")
     try:
         model = AutoModelForCausalLM.from_pretrained(
-            MODEL_NAME, device_map="auto", torch_dtype=torch.bfloat16)
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+            model_name, device_map=device_map, torch_dtype=dtype if dtype == "auto" else getattr(torch, dtype))
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
         llm_pipeline = pipeline("text-generation", model=model, tokenizer=tokenizer,
                                 eos_token_id=tokenizer.eos_token_id)
         print("Model and tokenizer loaded successfully.")
@@ -40,20 +52,111 @@ def load_model():
 # 3. LLMとの対話と評価
 # ---------------------------------------------------------------------------
 
-def ask_llm(prompt: str, llm_pipeline, tokenizer):
-    """プロンプトを整形し、LLMに問い合わせて回答を抽出する"""
+def format_prompt(prompt: str, tokenizer) -> str:
     messages = [
-        {"role": "system", "content": "You are an expert in reading comprehension. Answer the following question based ONLY on the text provided in the story. Provide only the answer, without any introductory phrases or explanations."},
+        {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "user", "content": prompt},
     ]
-    formatted_prompt = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    return tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+
+def is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error).lower()
+
+def ask_llm(prompt: str, llm_pipeline, tokenizer, cache=None, max_new_tokens: int = GENERATION_PARAMS["max_new_tokens"], model_name: str = MODEL_NAME):
+    """プロンプトを整形し、LLMに問い合わせて (回答, エラー) を返す。
+    キャッシュに同じ問い合わせの回答があればそれを返す (replay ならなくても生成しない)。
+    生成に失敗したら回答を None、エラーに理由を入れて返す (採点せず、再開したときにもう一度聞く)"""
+    params = dict(GENERATION_PARAMS, max_new_tokens=max_new_tokens)
+    key = cache_key(model_name, SYSTEM_PROMPT, prompt, params) if cache else None
+    if cache:
+        answer = cache.get(key)
+        if answer is not None: return answer, None
+        if cache.readonly: return None, "CacheMiss: replay モードでキャッシュに回答がありません"
+    formatted_prompt = format_prompt(prompt, tokenizer)
     try:
-        response = llm_pipeline(formatted_prompt, max_new_tokens=50, do_sample=False, temperature=0.0)
+        response = llm_pipeline(formatted_prompt, **params)
         answer = response[0]['generated_text'][len(formatted_prompt):].strip()
-        return answer
+        if cache: cache.put(key, answer)
+        return answer, None
     except Exception as e:
         print(f"An error occurred during pipeline execution: {e}")
-        return "ERROR: Pipeline failed"
+        if is_out_of_memory(e) and torch.cuda.is_available(): torch.cuda.empty_cache()
+        return None, f"{type(e).__name__}: {e}"
+
+class BatchedGenerator:
+    """プロンプトをトークン数の近いものどうしでバッチにまとめ、左詰めにパディングして model.generate に通す。
+    ask_llm と同じキャッシュと同じキーを使い、生成したトークン数と時間を数えて tokens/sec を出す。
+    メモリが足りなければバッチを半分ずつに分けて生成し直し、以降のバッチもその件数にする。
+    パディングは自分で行い、pipeline と共有しているトークナイザの設定 (padding_side など) は変えない"""
+    def __init__(self, llm_pipeline, tokenizer, batch_size: int, cache=None, model_name: str = MODEL_NAME):
+        self.model, self.tokenizer, self.batch_size, self.cache, self.model_name = llm_pipeline.model, tokenizer, batch_size, cache, model_name
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.prompt_tokens = self.generated_tokens = 0
+        self.seconds = 0.0
+
+    def answer_all(self, requests: list) -> list:
+        """(プロンプト, max_new_tokens) のリストに、同じ順で (回答, エラー) を返す。
+        replay でキャッシュにないものと生成に失敗したものは、回答が None でエラーに理由が入る"""
+        answers, keys, todo = [(None, None)] * len(requests), [None] * len(requests), []
+        for i, (prompt, max_new_tokens) in enumerate(requests):
+            if self.cache:
+                keys[i] = cache_key(self.model_name, SYSTEM_PROMPT, prompt, dict(GENERATION_PARAMS, max_new_tokens=max_new_tokens))
+                answer = self.cache.get(keys[i])
+                if answer is not None: answers[i] = (answer, None)
+                elif self.cache.readonly: answers[i] = (None, "CacheMiss: replay モードでキャッシュに回答がありません")
+                if answer is not None or self.cache.readonly: continue
+            todo.append(i)
+        # 生成の長さの上限ごとに、プロンプトのトークン数の順に並べてから batch_size ずつに分ける
+        input_ids = {i: self.tokenizer(format_prompt(requests[i][0], self.tokenizer), add_special_tokens=False)["input_ids"] for i in todo}
+        todo.sort(key=lambda i: (requests[i][1], len(input_ids[i])))
+        for max_new_tokens, bucket in groupby(todo, key=lambda i: requests[i][1]):
+            bucket, start = list(bucket), 0
+            while start < len(bucket):
+                batch = bucket[start:start + self.batch_size]
+                start += len(batch)
+                for i, (answer, error) in zip(batch, self.generate_or_split([input_ids[i] for i in batch], max_new_tokens)):
+                    answers[i] = (answer, error)
+                    if self.cache and error is None: self.cache.put(keys[i], answer)
+        return answers
+
+    def generate_or_split(self, batch_ids: list, max_new_tokens: int) -> list:
+        """バッチを生成して (回答, エラー) のリストを返す。メモリ不足なら半分ずつに分けてやり直し、
+        1件でも生成できないものや、それ以外の理由で失敗したバッチはエラーとして返す"""
+        try:
+            return [(answer, None) for answer in self.generate(batch_ids, max_new_tokens)]
+        except Exception as e:
+            error = e
+        if is_out_of_memory(error) and torch.cuda.is_available(): torch.cuda.empty_cache()
+        if is_out_of_memory(error) and len(batch_ids) > 1:
+            half = len(batch_ids) // 2
+            self.batch_size = min(self.batch_size, half)
+            print(f"Out of memory with a batch of {len(batch_ids)}; retrying in batches of {half}")
+            return self.generate_or_split(batch_ids[:half], max_new_tokens) + self.generate_or_split(batch_ids[half:], max_new_tokens)
+        print(f"An error occurred during batched generation: {error}")
+        return [(None, f"{type(error).__name__}: {error}")] * len(batch_ids)
+
+    def generate(self, batch_ids: list, max_new_tokens: int) -> list:
+        # 生成はプロンプトの右端から続けるので、パディングは左に置く
+        width = max(len(ids) for ids in batch_ids)
+        inputs = {"input_ids": torch.tensor([[self.pad_token_id] * (width - len(ids)) + ids for ids in batch_ids]),
+                  "attention_mask": torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in batch_ids])}
+        inputs = {name: tensor.to(self.model.device) for name, tensor in inputs.items()}
+        start = time.perf_counter()
+        with torch.no_grad():
+            output = self.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False,
+                                         pad_token_id=self.pad_token_id, eos_token_id=self.tokenizer.eos_token_id)
+        self.seconds += time.perf_counter() - start
+        generated = output[:, inputs["input_ids"].shape[1]:]
+        self.prompt_tokens += sum(len(ids) for ids in batch_ids)
+        self.generated_tokens += int((generated != self.pad_token_id).sum())
+        # pipeline (ask_llm) と同じ設定で文字列に戻す。トークナイザの既定に任せると、句読点の前の空白などが1問ずつの回答と変わる
+        return [answer.strip() for answer in self.tokenizer.batch_decode(generated, skip_special_tokens=True, clean_up_tokenization_spaces=True)]
+
+    def report(self):
+        if self.seconds:
+            print(f"Batched generation: {self.generated_tokens / self.seconds:.1f} generated tokens/sec, "
+                  f"{(self.prompt_tokens + self.generated_tokens) / self.seconds:.1f} total tokens/sec "
+                  f"({self.generated_tokens} generated + {self.prompt_tokens} prompt tokens in {self.seconds:.1f}s, batch size {self.batch_size})")
 
 # ▼▼▼ 修正点: 回答の一致判定ロジックをより柔軟に変更 ▼▼▼
 def are_answers_equivalent(llm_answer: str, ground_truth: str) -> bool:
@@ -82,59 +185,132 @@ def are_answers_equivalent(llm_answer: str, ground_truth: str) -> bool:
 # ---------------------------------------------------------------------------
 # 4. メイン処理
 # ---------------------------------------------------------------------------
-def main():
-    llm_pipeline, tokenizer = load_model()
-
-    print(f"Loading data from {QA_SETS_PATH}...")
-    try:
-        qa_sets = json.loads(QA_SETS_PATH.read_text(encoding="utf-8"))
-    except FileNotFoundError:
-        print(f"エラー: 入力ファイル {QA_SETS_PATH} が見つかりません。")
-        return
-
-    tasks_to_evaluate = []
+def iter_tasks(qa_sets):
+    """QA セットを1件ずつ受け取り、評価する設問を1問ずつ返す"""
     for qa_set in qa_sets:
         story_text = "\n".join(qa_set['full_story'])
         for qa_category, qa_list in qa_set.items():
             if not qa_category.endswith("_QA") or not qa_list:
                 continue
             for qa_pair in qa_list:
-                tasks_to_evaluate.append({
+                yield {
                     "instance_index": qa_set["instance_index"],
                     "qa_category": qa_category,
                     "full_story_text": story_text,
                     "question": qa_pair['question'],
                     "ground_truth_answer": qa_pair['answer'],
                     "setting": qa_set.get("setting", "unknown"),
-                })
+                }
+
+def grade(task: dict, llm_answer, error, prompt_mode: str):
+    task['llm_answer'], task['prompt_mode'] = llm_answer, prompt_mode
+    if error is None: task['is_correct'] = are_answers_equivalent(llm_answer, task['ground_truth_answer'])
+    else: task['is_correct'], task['error'] = None, error  # 生成の失敗は不正解にしない
+    return task
 
-    evaluation_details = []
-    print(f"Starting evaluation of {len(tasks_to_evaluate)} questions with {MODEL_NAME}...")
+def evaluate_group(group: list, llm_pipeline, tokenizer, cache=None, model_name: str = MODEL_NAME):
+    """1回の問い合わせで聞く設問のまとまりを評価する。複数の設問 (packed) なら1つのプロンプトで聞き、
+    回答を読み取れなかった設問だけを1問ずつ聞き直す"""
+    if len(group) == 1: return [grade(group[0], *ask_llm(build_prompt(group[0]), llm_pipeline, tokenizer, cache, model_name=model_name), SINGLE)]
+    reply, error = ask_llm(build_packed_prompt(group), llm_pipeline, tokenizer, cache, GENERATION_PARAMS["max_new_tokens"] * len(group), model_name)
+    answers = parse_packed_answers(reply, len(group)) if error is None else [None] * len(group)
+    for task, answer in zip(group, answers):
+        if answer is not None: grade(task, answer, None, PACKED)
+        else: grade(task, *ask_llm(build_prompt(task), llm_pipeline, tokenizer, cache, model_name=model_name), PACKED_FALLBACK)
+    return group
+
+def evaluate_groups_batched(groups: list, generator: BatchedGenerator):
+    """evaluate_group と同じことを、まとまりのリストについてバッチ生成で行う。結果は groups の順に並べて返す"""
+    max_new_tokens = GENERATION_PARAMS["max_new_tokens"]
+    requests = [(build_prompt(group[0]), max_new_tokens) if len(group) == 1 else (build_packed_prompt(group), max_new_tokens * len(group)) for group in groups]
+    retries = []
+    for group, (reply, error) in zip(groups, generator.answer_all(requests)):
+        if len(group) == 1:
+            grade(group[0], reply, error, SINGLE)
+            continue
+        answers = parse_packed_answers(reply, len(group)) if error is None else [None] * len(group)
+        for task, answer in zip(group, answers):
+            if answer is not None: grade(task, answer, None, PACKED)
+            else: retries.append(task)
+    # packed で読み取れなかった設問は、まとめてもう1度バッチで1問ずつ聞く
+    for task, (answer, error) in zip(retries, generator.answer_all([(build_prompt(task), max_new_tokens) for task in retries])):
+        grade(task, answer, error, PACKED_FALLBACK)
+    return [task for group in groups for task in group]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=f"{MODEL_NAME} で QA セットを評価する")
+    parser.add_argument("--qa-sets", type=Path, default=QA_SETS_PATH, help="入力の QA セット (JSON 配列または JSONL。.gz / .bz2 / .xz の圧縮も可)")
+    parser.add_argument("--results-out", type=Path, default=RESULTS_PATH, help="設問ごとの結果の出力先 (.jsonl / .jsonl.gz なら1行1問の JSONL)")
+    parser.add_argument("--summary-out", type=Path, default=SUMMARY_PATH, help="カテゴリごとの正答率などの集計の出力先 (JSON)")
+    parser.add_argument("--log", type=Path, default=LOG_PATH, help="1問ずつ追記する結果のログ (JSONL)。あれば答え終わった設問を飛ばして再開する")
+    parser.add_argument("--fresh", action="store_true", help="ログを消して最初から評価する")
+    parser.add_argument("--packed", action="store_true", help="1つのストーリーの設問をまとめて1回で聞く (結果の prompt_mode で single と比べられる)")
+    parser.add_argument("--model", default=MODEL_NAME, help="評価するモデル (Hugging Face の名前またはローカルのディレクトリ)")
+    parser.add_argument("--dtype", choices=DTYPES, default="bfloat16", help="モデルの重みの型 (bfloat16 に対応しない GPU では float16、CPU では float32 など)")
+    parser.add_argument("--device-map", default="auto", help="モデルを置くデバイス (auto / cpu / cuda:0 など。from_pretrained の device_map に渡す)")
+    parser.add_argument("--batch-size", type=int, default=None, help="指定すると、トークン数の近いプロンプトをこの件数ずつまとめて model.generate で生成する (未指定なら1問ずつ pipeline に通す)")
+    add_cache_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    # replay はキャッシュだけで評価するので、モデルを読み込まない
+    llm_pipeline, tokenizer = load_model(args.model, args.dtype, args.device_map) if args.cache_mode != "replay" else (None, None)
+
+    print(f"Loading data from {args.qa_sets}...")
+    if not args.qa_sets.exists():
+        print(f"エラー: 入力ファイル {args.qa_sets} が見つかりません。")
+        return
+    if args.log.resolve() == args.results_out.resolve():
+        print("エラー: --log と --results-out には別のファイルを指定してください。")
+        return
+
+    # QA セットは1件ずつ読み、結果は1問ずつログに追記する。集計と結果ファイルは最後にログから作る
+    log = ResultLog(args.log, fresh=args.fresh)
+    if log.completed: print(f"Resuming from {args.log}: {len(log.completed)} questions already answered")
+    all_keys = {}  # 評価するすべての設問のキー (入力の順)。結果ファイルはこの順に書く
+    tasks = pending_tasks(iter_tasks(iter_records(args.qa_sets)), log, all_keys)
+    print(f"Starting evaluation with {args.model}...")
     
-    for task in tqdm(tasks_to_evaluate, desc="Evaluating Questions"):
-        prompt = (
-            "Please read the following story and answer the subsequent question.\n\n"
-            "--- STORY ---\n"
-            f"{task['full_story_text']}\n"
-            "--- END OF STORY ---\n\n"
-            f"Question: {task['question']}"
-        )
-        llm_answer = ask_llm(prompt, llm_pipeline, tokenizer)
-        is_correct = are_answers_equivalent(llm_answer, task['ground_truth_answer'])
-        
-        task['llm_answer'] = llm_answer
-        task['is_correct'] = is_correct
-        evaluation_details.append(task)
+    cache = open_cache(args.cache, args.cache_mode, args.cache_max_entries)
+    try:
+        with log:
+            with tqdm(desc="Evaluating Questions") as progress:
+                groups = iter_prompt_groups(tasks, args.packed)
+                if args.batch_size and llm_pipeline is not None:
+                    # BUCKET_WINDOW バッチ分ずつ読み、その中で長さ順に並べ替えて生成し、入力の順に戻してログに書く
+                    generator = BatchedGenerator(llm_pipeline, tokenizer, args.batch_size, cache, args.model)
+                    while window := list(islice(groups, args.batch_size * BUCKET_WINDOW)):
+                        for task in evaluate_groups_batched(window, generator): log.append(task)
+                        progress.update(sum(len(group) for group in window))
+                    generator.report()
+                else:
+                    for group in groups:
+                        for task in evaluate_group(group, llm_pipeline, tokenizer, cache, args.model): log.append(task)
+                        progress.update(len(group))
+
+            # 生成に失敗した設問と replay でキャッシュになかった設問は正答率から除き、カテゴリごとに件数だけ数える
+            category_stats = defaultdict(lambda: {"correct": 0, "total": 0})
+            failed_stats = defaultdict(int)
+            mode_stats = defaultdict(lambda: {"correct": 0, "total": 0})  # packed と single の正答率を比べる
+            with RecordWriter(args.results_out) as writer:
+                for task in log.iter_results(all_keys):
+                    writer.write(task)
+                    if task['is_correct'] is None:
+                        failed_stats[task["qa_category"]] += 1
+                        continue
+                    category_stats[task["qa_category"]]["total"] += 1
+                    mode_stats[task.get("prompt_mode", SINGLE)]["total"] += 1
+                    if task['is_correct']:
+                        category_stats[task["qa_category"]]["correct"] += 1
+                        mode_stats[task.get("prompt_mode", SINGLE)]["correct"] += 1
+    finally:
+        if cache:
+            print(f"Response cache ({args.cache_mode}): {cache.stats()}")
+            cache.close()
 
     print("\n--- Evaluation Summary ---")
     summary_data = {"overall_accuracy": {}, "accuracy_by_category": {}}
-    category_stats = defaultdict(lambda: {"correct": 0, "total": 0})
-    
-    for detail in evaluation_details:
-        cat = detail["qa_category"]
-        category_stats[cat]["total"] += 1
-        if detail["is_correct"]:
-            category_stats[cat]["correct"] += 1
             
     overall_correct = sum(d['correct'] for d in category_stats.values())
     overall_total = sum(d['total'] for d in category_stats.values())
@@ -157,13 +333,20 @@ def main():
             }
             print(f"  - {category:<20}: {accuracy:.2%} ({data['correct']}/{data['total']})")
 
-    with open(RESULTS_PATH, 'w', encoding='utf-8') as f:
-        json.dump(evaluation_details, f, ensure_ascii=False, indent=2)
-    print(f"\nFull raw results saved to {RESULTS_PATH}")
+    if set(mode_stats) != {SINGLE}:
+        for mode, data in sorted(mode_stats.items()):
+            summary_data.setdefault("accuracy_by_prompt_mode", {})[mode] = {"accuracy": data['correct'] / data['total'], "correct": data['correct'], "total": data['total']}
+            print(f"  - prompt_mode {mode:<15}: {data['correct'] / data['total']:.2%} ({data['correct']}/{data['total']})")
+
+    if failed_stats:
+        summary_data["failed_requests"] = {"total": sum(failed_stats.values()), "by_category": dict(sorted(failed_stats.items()))}
+        print(f"Failed requests (excluded from accuracy): {summary_data['failed_requests']['total']}")
+
+    print(f"\nFull raw results saved to {args.results_out}")
     
-    with open(SUMMARY_PATH, 'w', encoding='utf-8') as f:
+    with open(args.summary_out, 'w', encoding='utf-8') as f:
         json.dump(summary_data, f, ensure_ascii=False, indent=2)
-    print(f"Summary saved to {SUMMARY_PATH}")
+    print(f"Summary saved to {args.summary_out}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,53 @@
+import re
+
+# ---------------------------------------------------------------------------
+# 評価で送るプロンプト。1問ずつ聞く single と、1つのストーリーの設問をまとめて聞く packed がある。
+# packed ではストーリーを1回だけ送り、番号つきの回答を1行ずつ返してもらう
+# ---------------------------------------------------------------------------
+SINGLE, PACKED, PACKED_FALLBACK = "single", "packed", "packed_fallback"  # 結果の prompt_mode に入れる値
+# packed の回答の1行 ("1. kitchen", "2) the box", "Answer 3: No one" など)
+PACKED_ANSWER_PATTERN = re.compile(r"^\s*(?:answer\s*)?(\d+)\s*[.):\-]\s*(.*\S)\s*$", re.IGNORECASE)
+
+def build_prompt(task: dict) -> str:
+    return (
+        "Please read the following story and answer the subsequent question.\n\n"
+        "--- STORY ---\n"
+        f"{task['full_story_text']}\n"
+        "--- END OF STORY ---\n\n"
+        f"Question: {task['question']}"
+    )
+
+def build_packed_prompt(tasks: list) -> str:
+    """同じストーリーの設問をまとめて1つのプロンプトにする"""
+    questions = "\n".join(f"{i}. {task['question']}" for i, task in enumerate(tasks, 1))
+    return (
+        "Please read the following story and answer each of the subsequent questions.\n"
+        'Answer every question on its own line in the form "<number>. <answer>", in the same order as the questions.\n\n'
+        "--- STORY ---\n"
+        f"{tasks[0]['full_story_text']}\n"
+        "--- END OF STORY ---\n\n"
+        "Questions:\n"
+        f"{questions}"
+    )
+
+def parse_packed_answers(reply: str, n: int) -> list:
+    """packed の回答を設問ごとの回答のリストにする。番号がない・重複する・空の設問は None (1問ずつ聞き直す)"""
+    answers, seen = [None] * n, set()
+    for line in reply.splitlines():
+        match = PACKED_ANSWER_PATTERN.match(line)
+        if not match: continue
+        i = int(match.group(1)) - 1
+        if not 0 <= i < n: continue
+        answers[i] = None if i in seen else match.group(2)
+        seen.add(i)
+    return answers
+
+def iter_prompt_groups(tasks, packed: bool):
+    """設問を、1回の問い合わせで聞くまとまりごとに返す。packed なら同じストーリーの連続する設問を1つにまとめる"""
+    group = []
+    for task in tasks:
+        if group and (not packed or task["instance_index"] != group[0]["instance_index"]):
+            yield group
+            group = []
+        group.append(task)
+    if group: yield group
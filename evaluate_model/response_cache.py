@@ -0,0 +1,81 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+
+# ---------------------------------------------------------------------------
+# LLM の回答をディスク (SQLite) に覚えておき、同じ問い合わせを二度送らない。
+# キーは (モデル名, システムプロンプト, プロンプト, デコードの設定) のハッシュなので、
+# 採点や分析だけを変えて評価をやり直すときや、中断した評価をやり直すときは、答えた設問を問い合わせずに済む
+# ---------------------------------------------------------------------------
+CACHE_PATH = Path("llm_response_cache.sqlite")
+CACHE_MAX_ENTRIES = 1000000  # 覚えておく回答の数。超えたら最後に使ったのが古いものから消す
+CACHE_MODES = ("readwrite", "replay", "off")  # replay: キャッシュを読むだけで、ないものはモデルに問い合わせない
+
+def cache_key(model: str, system_prompt: str, prompt: str, params: dict) -> str:
+    """問い合わせの内容から決まるキー。params には max_tokens や temperature などデコードの設定を渡す"""
+    payload = json.dumps([model, system_prompt, prompt, params], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """回答を SQLite に保存するキャッシュ。readonly なら読むだけで、ファイルも最終使用時刻も変えない"""
+    def __init__(self, path=CACHE_PATH, max_entries: int = CACHE_MAX_ENTRIES, readonly: bool = False):
+        self.path, self.max_entries, self.readonly = Path(path), max_entries, readonly
+        self.hits = self.misses = self.evictions = 0
+        if readonly:
+            if not self.path.exists(): raise FileNotFoundError(f"キャッシュ {self.path} が見つかりません")
+            self.db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        else:
+            self.db = sqlite3.connect(self.path)
+            self.db.execute("PRAGMA journal_mode=WAL")  # 1件ずつ確定しても遅くならないように
+            self.db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, answer TEXT NOT NULL, last_used REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self.db.commit()
+        self.size = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key: str):
+        """覚えている回答を返す。なければ None"""
+        row = self.db.execute("SELECT answer FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if not self.readonly:
+            self.db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.db.commit()
+        return row[0]
+
+    def put(self, key: str, answer: str):
+        """回答を覚える。すぐに確定するので、評価が途中で止まってもそこまでの回答は残る"""
+        if self.readonly: return
+        new = self.db.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is None
+        self.db.execute("INSERT OR REPLACE INTO responses (key, answer, last_used) VALUES (?, ?, ?)", (key, answer, time.time()))
+        self.size += new
+        if self.size > self.max_entries:
+            excess = self.size - self.max_entries
+            self.db.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)", (excess,))
+            self.size, self.evictions = self.max_entries, self.evictions + excess
+        self.db.commit()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions, "entries": self.size}
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_cache(path, mode: str, max_entries: int = CACHE_MAX_ENTRIES):
+    """--cache-mode に合わせてキャッシュを開く。off なら None"""
+    if mode == "off": return None
+    return ResponseCache(path, max_entries, readonly=(mode == "replay"))
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", type=Path, default=CACHE_PATH, help="回答のキャッシュ (SQLite) のパス")
+    parser.add_argument("--cache-mode", choices=CACHE_MODES, default="readwrite", help="readwrite: 読んで書く / replay: 読むだけで、ないものは問い合わせずに失敗として記録する / off: 使わない")
+    parser.add_argument("--cache-max-entries", type=int, default=CACHE_MAX_ENTRIES, help="覚えておく回答の数の上限")
@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+
+# ---------------------------------------------------------------------------
+# 評価結果を1問ずつ追記するログ (1行1問の JSONL)。
+# 1問書くたびにディスクへ書き切るので、評価が途中で止まっても、やり直したときは答え終わった設問を飛ばせる。
+# 集計と RESULTS_PATH への書き出しは、評価の最後にこのログから行う
+# ---------------------------------------------------------------------------
+
+def task_fingerprint(task: dict) -> str:
+    """ストーリーの本文と正解から決まる短いハッシュ。QA ファイルを作り直して中身が変わった設問を見分ける"""
+    payload = json.dumps([task["full_story_text"], task["ground_truth_answer"]], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def task_key(task: dict):
+    """設問を見分けるキー。1つのカテゴリに複数の設問があってもよいように、設問の文も含める。
+    QA ファイルを作り直して同じ番号のストーリーや正解が変わっていれば、別の設問として最初から聞き直す"""
+    return (task["instance_index"], task["qa_category"], task["question"], task_fingerprint(task))
+
+class ResultLog:
+    """評価結果の追記ログ。開いたときに既存のログを読み、答え終わった設問のキーを completed に集める。
+    問い合わせに失敗した設問 ("error" のあるもの) は completed に入れず、次に再開したときにやり直す"""
+    def __init__(self, path, fresh: bool = False):
+        self.path, self.completed = Path(path), set()
+        if fresh and self.path.exists(): self.path.unlink()
+        if self.path.exists():
+            with open(self.path, "rb+") as f:
+                end = 0
+                for line in f:
+                    if not line.endswith(b"\n"): break  # 書きかけで止まった最後の行は捨てる
+                    end += len(line)
+                    record = json.loads(line)
+                    if not record.get("error"): self.completed.add(task_key(record))
+                f.truncate(end)
+        self.f = open(self.path, "a", encoding="utf-8")
+
+    def append(self, record: dict):
+        self.f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        if not record.get("error"): self.completed.add(task_key(record))
+
+    def iter_results(self, keys):
+        """keys の順に、ログにある結果を1件ずつ返す。同じ設問が何度も書かれていれば最後のもの (やり直して答えたもの) を返す。
+        中断や失敗のやり直しがあっても、結果は入力の設問の順に並ぶ。ログにない設問は飛ばす"""
+        self.f.flush()
+        offsets = {}
+        with open(self.path, "rb") as f:
+            offset = 0
+            for line in f:
+                offsets[task_key(json.loads(line))] = offset
+                offset += len(line)
+            for key in keys:
+                if key not in offsets: continue
+                f.seek(offsets[key])
+                yield json.loads(f.readline())
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def pending_tasks(tasks, log: ResultLog, all_keys: dict):
+    """設問のうち、ログに答えが残っていないものだけを返す。評価するすべての設問のキーは入力の順に all_keys に集める"""
+    for task in tasks:
+        key = task_key(task)
+        all_keys[key] = None
+        if key not in log.completed: yield task
@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------------------------------------------------------
+# OpenAI の chat completions API の代役サーバー (テスト用)。手元で別スレッドに立て、evaluate_gpt を --base-url でつなぐ。
+# 回答は設問の文から決まり、決まったやり方で 429 / 5xx / 400 を返すので、やり直し・失敗の記録・再開を確かめられる
+# ---------------------------------------------------------------------------
+RETRY_AFTER = "0.01"  # 429 / 5xx で返す Retry-After (秒)。テストが待たずに済むように短くする
+
+def prompt_hash(prompt: str) -> int:
+    return int(hashlib.md5(prompt.encode("utf-8")).hexdigest(), 16)
+
+class StandInServer:
+    """chat completions API の代役。answers (設問の文 -> 回答) から回答し、ないものは default_answer を返す。
+
+    inject_errors なら、プロンプトごとに最初の1回はハッシュで決めた 429 か 500 を返す (1/3 ずつ、残りはそのまま答える)。
+    always_fail の文字列を含むプロンプトには、何度送られても 400 を返す (やり直さずに失敗として記録されるもの)。
+    応答はハッシュで決めた分だけ遅らせるので、同時に送った設問の返る順は送った順と変わる。
+    """
+
+    def __init__(self, answers=None, default_answer="box", inject_errors=True, always_fail=(), delay=0.01):
+        self.answers, self.default_answer, self.inject_errors, self.delay = answers or {}, default_answer, inject_errors, delay
+        self.always_fail = set(always_fail)
+        self.attempts, self.statuses = Counter(), Counter()  # プロンプトごとの受け取った回数、返したステータスごとの回数
+        self.active = self.max_active = 0
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    @property
+    def requests(self) -> int:
+        return sum(self.statuses.values())
+
+    def reply(self, prompt: str) -> str:
+        """1問ずつのプロンプトには回答を、packed のプロンプトには "1. 回答" の行を返す"""
+        if "Questions:\n" in prompt:
+            lines = prompt.split("Questions:\n", 1)[1].splitlines()
+            return "\n".join(f"{number}. {self.answers.get(question, self.default_answer)}" for number, question in (line.split(". ", 1) for line in lines))
+        return self.answers.get(prompt.split("Question: ", 1)[1], self.default_answer)
+
+    def respond(self, prompt: str):
+        """(ステータス, 本文の dict) を返す"""
+        with self.lock:
+            self.attempts[prompt] += 1
+            first = self.attempts[prompt] == 1
+        if any(marker in prompt for marker in self.always_fail):
+            return 400, {"error": {"message": "stand-in: rejected", "type": "invalid_request_error", "code": None}}
+        if self.inject_errors and first and prompt_hash(prompt) % 3 < 2:
+            status = 429 if prompt_hash(prompt) % 3 == 0 else 500
+            return status, {"error": {"message": f"stand-in: injected {status}", "type": "server_error", "code": None}}
+        message = {"role": "assistant", "content": self.reply(prompt)}
+        return 200, {"id": "stand-in", "object": "chat.completion", "created": 0, "model": "stand-in",
+                     "choices": [{"index": 0, "finish_reason": "stop", "message": message}]}
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args): pass
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers["content-length"])))
+                prompt = body["messages"][-1]["content"]
+                with server.lock:
+                    server.active += 1
+                    server.max_active = max(server.max_active, server.active)
+                status = 500
+                try:
+                    time.sleep(server.delay * (prompt_hash(prompt) % 4))
+                    status, payload = server.respond(prompt)
+                    data = json.dumps(payload).encode("utf-8")
+                    self.send_response(status)
+                    self.send_header("content-type", "application/json")
+                    self.send_header("content-length", str(len(data)))
+                    if status != 200: self.send_header("retry-after", RETRY_AFTER)
+                    self.end_headers()
+                    self.wfile.write(data)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+                        server.statuses[status] += 1
+
+        return Handler
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,110 @@
+import asyncio
+import json
+import sys
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from evaluate_model import evaluate_gpt
+from tests.stand_in_server import StandInServer
+
+# ---------------------------------------------------------------------------
+# evaluate_gpt を代役サーバー (tests/stand_in_server.py) につないで、最後まで動かすテスト。
+# 429 / 5xx のやり直し、結果の順序、失敗の記録、中断と失敗からの再開を確かめる
+# ---------------------------------------------------------------------------
+N_STORIES = 6
+
+def write_qa_sets(path, n_stories=N_STORIES):
+    """1ストーリーに3問ずつの QA セットを書く。代役サーバーは既定で "box" と答えるので、reality_QA だけが正解になる"""
+    qa_sets = [{"instance_index": i, "setting": "A3_O3_C3", "full_story": [f"Story {i} begins.", f"Story {i} ends."],
+                "reality_QA": [{"question": f"Where is the apple {i}?", "answer": "box"}],
+                "memory_QA": [{"question": f"Where was the apple {i} at the beginning?", "answer": "basket"}],
+                "first_order_QA": [{"question": f"Where will agent {i} look for the apple?", "answer": "basket"}]}
+               for i in range(n_stories)]
+    path.write_text(json.dumps(qa_sets), encoding="utf-8")
+    return [(qa["instance_index"], qa[category][0]["question"]) for qa in qa_sets for category in ("reality_QA", "memory_QA", "first_order_QA")]
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    """evaluate_gpt.main() を代役サーバーに向けて実行し、(結果, 集計) を返す関数"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("OPENAI_API_KEY", "stand-in")
+    expected = write_qa_sets(tmp_path / "qa_sets.json")
+
+    def run(server, *args):
+        monkeypatch.setattr(sys, "argv", ["evaluate_gpt", "--qa-sets", "qa_sets.json", "--log", "log.jsonl", "--results-out", "results.json",
+                                          "--summary-out", "summary.json", "--base-url", server.base_url, "--cache-mode", "off", *args])
+        evaluate_gpt.main()
+        return json.loads((tmp_path / "results.json").read_text(encoding="utf-8")), json.loads((tmp_path / "summary.json").read_text(encoding="utf-8"))
+
+    run.expected, run.log = expected, tmp_path / "log.jsonl"
+    return run
+
+def keys(results):
+    return [(r["instance_index"], r["question"]) for r in results]
+
+def test_results_follow_input_order_despite_retries(run):
+    with StandInServer() as server:
+        results, summary = run(server, "--concurrency", "4")
+    assert keys(results) == run.expected
+    assert server.statuses[429] and server.statuses[500]  # やり直しが実際に起きている
+    assert server.max_active <= 4
+    assert all(r.get("error") is None and r["llm_answer"] == "box" for r in results)
+    assert [r["is_correct"] for r in results] == [r["ground_truth_answer"] == "box" for r in results]
+    assert summary["overall_accuracy"]["total"] == len(run.expected) and "failed_requests" not in summary
+
+def test_failed_questions_are_recorded_and_retried_on_resume(run):
+    with StandInServer(always_fail={"apple 2"}) as server:
+        results, summary = run(server)
+        failed = [r for r in results if r.get("error")]
+        assert keys(results) == run.expected
+        assert [r["instance_index"] for r in failed] == [2, 2]
+        assert all(r["error"].startswith("BadRequestError") and r["is_correct"] is None and r["llm_answer"] is None for r in failed)
+        assert summary["failed_requests"]["total"] == 2
+        assert summary["overall_accuracy"]["total"] == len(run.expected) - 2
+
+        # 失敗した2問だけを聞き直す (答え終わった設問は送らない)
+        server.always_fail.clear()
+        before = server.requests
+        results, summary = run(server)
+    assert server.requests - before == 2
+    assert keys(results) == run.expected
+    assert all(r.get("error") is None for r in results)
+    assert "failed_requests" not in summary
+
+def test_resume_after_interruption_skips_answered_questions(run):
+    with StandInServer() as server:
+        first, _ = run(server)
+        # 5問を書き終えたところで、6問目を書きかけて止まったログにする
+        lines = run.log.read_bytes().splitlines(keepends=True)
+        run.log.write_bytes(b"".join(lines[:5]) + lines[5][:20])
+        before = server.requests
+        resumed, _ = run(server)
+    assert server.requests - before == len(run.expected) - 5
+    assert keys(resumed) == run.expected
+    assert [(r["llm_answer"], r["is_correct"]) for r in resumed] == [(r["llm_answer"], r["is_correct"]) for r in first]
+
+def test_packed_mode_keeps_input_order(run):
+    with StandInServer() as server:
+        results, summary = run(server, "--packed")
+    assert keys(results) == run.expected
+    assert {r["prompt_mode"] for r in results} == {"packed"}
+    assert all(r.get("error") is None and r["llm_answer"] == "box" for r in results)
+    assert set(summary["accuracy_by_prompt_mode"]) == {"packed"}
+
+def test_rate_limiter_waits_for_refill():
+    async def acquire():
+        limiter = evaluate_gpt.RateLimiter(600)  # 1秒に10ずつ補充される
+        await limiter.acquire(600)
+        start = time.monotonic()
+        await limiter.acquire(3)
+        return time.monotonic() - start
+
+    assert 0.25 <= asyncio.run(acquire()) < 1.0
+
+def test_backoff_delay_honours_retry_after():
+    error = SimpleNamespace(response=SimpleNamespace(headers={"retry-after": "2"}))
+    assert evaluate_gpt.backoff_delay(0, error) == 2.0
+    delay = evaluate_gpt.backoff_delay(2, ValueError())
+    assert evaluate_gpt.BACKOFF_BASE * 2 <= delay <= evaluate_gpt.BACKOFF_BASE * 4
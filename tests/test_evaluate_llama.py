@@ -0,0 +1,102 @@
+import re
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+tokenizers = pytest.importorskip("tokenizers")
+
+from evaluate_model import evaluate_llama
+from evaluate_model.prompts import build_prompt
+
+# ---------------------------------------------------------------------------
+# evaluate_llama のバッチ生成 (BatchedGenerator) を、CPU で小さなランダムの GPT-2 に通すテスト。
+# 左詰めのパディング、長さ順に並べ替えたあと入力の順に戻すこと、メモリ不足でのバッチの分割を、1問ずつの生成と比べて確かめる
+# ---------------------------------------------------------------------------
+MAX_NEW_TOKENS = 8
+
+def make_tasks():
+    """ストーリーの長さが違う設問。長さ順に並べ替えると入力の順と変わる"""
+    return [{"instance_index": i, "qa_category": "reality_QA", "question": f"Where is the apple {i}?", "ground_truth_answer": "box",
+             "full_story_text": " ".join(f"Agent {j} moved the apple {i} to the box." for j in range((i * 5) % 7 + 1))}
+            for i in range(9)]
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """プロンプトの単語だけを語彙に持つ、小さなランダムの GPT-2 とトークナイザを作って保存する (ネットワークを使わない)"""
+    path = tmp_path_factory.mktemp("tiny-gpt2")
+    text = evaluate_llama.SYSTEM_PROMPT + " " + " ".join(build_prompt(task) for task in make_tasks())
+    specials = ["<|endoftext|>", "<unk>", "<|system|>", "<|user|>", "<|assistant|>"]
+    vocab = {token: i for i, token in enumerate(specials + sorted(set(re.findall(r"\w+|[^\w\s]", text))))}
+    tokenizer = tokenizers.Tokenizer(tokenizers.models.WordLevel(vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = tokenizers.pre_tokenizers.Sequence([tokenizers.pre_tokenizers.WhitespaceSplit(), tokenizers.pre_tokenizers.Punctuation()])
+    tokenizer = transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<|endoftext|>", unk_token="<unk>")  # pad_token はない
+    tokenizer.chat_template = ("{% for m in messages %}<|{{ m['role'] }}|> {{ m['content'] }} {% endfor %}"
+                               "{% if add_generation_prompt %}<|assistant|>{% endif %}")
+    tokenizer.save_pretrained(path)
+    torch.manual_seed(0)
+    config = transformers.GPT2Config(vocab_size=len(vocab), n_positions=1024, n_embd=32, n_layer=2, n_head=2, bos_token_id=0, eos_token_id=0,
+                                     initializer_range=0.5)  # 重みを大きくして、生成が特殊トークンばかりにならないようにする
+    transformers.GPT2LMHeadModel(config).save_pretrained(path)
+    return path
+
+@pytest.fixture(scope="module")
+def model(model_dir):
+    return evaluate_llama.load_model(str(model_dir), "float32", "cpu")
+
+@pytest.fixture(scope="module")
+def unbatched(model):
+    """1問ずつ pipeline に通した回答 (比べる基準)"""
+    llm_pipeline, tokenizer = model
+    return [evaluate_llama.ask_llm(build_prompt(task), llm_pipeline, tokenizer, max_new_tokens=MAX_NEW_TOKENS)[0] for task in make_tasks()]
+
+class OutOfMemoryAbove:
+    """limit 件より大きいバッチではメモリ不足を起こすモデル。ほかはそのまま model に渡す"""
+    def __init__(self, model, limit):
+        self.model, self.limit, self.batch_sizes = model, limit, []
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def generate(self, **kwargs):
+        self.batch_sizes.append(len(kwargs["input_ids"]))
+        if len(kwargs["input_ids"]) > self.limit: raise torch.cuda.OutOfMemoryError("CUDA out of memory (stand-in)")
+        return self.model.generate(**kwargs)
+
+def test_batched_answers_match_unbatched_in_input_order(model, unbatched):
+    llm_pipeline, tokenizer = model
+    padding_side = tokenizer.padding_side
+    generator = evaluate_llama.BatchedGenerator(llm_pipeline, tokenizer, batch_size=4)
+    answers = generator.answer_all([(build_prompt(task), MAX_NEW_TOKENS) for task in make_tasks()])
+    assert len(set(unbatched)) > 1  # 回答がどれも同じでは、順序の入れ替わりを見分けられない
+    assert [answer for answer, _ in answers] == unbatched
+    assert all(error is None for _, error in answers)
+    assert generator.generated_tokens > 0
+    # pipeline と共有しているトークナイザは変えない
+    assert tokenizer.padding_side == padding_side and tokenizer.pad_token is None
+
+def test_mixed_generation_lengths_keep_input_order(model, unbatched):
+    llm_pipeline, tokenizer = model
+    tasks = make_tasks()
+    requests = [(build_prompt(task), MAX_NEW_TOKENS if i % 2 else MAX_NEW_TOKENS + 4) for i, task in enumerate(tasks)]
+    expected = [unbatched[i] if i % 2 else evaluate_llama.ask_llm(prompt, llm_pipeline, tokenizer, max_new_tokens=n)[0] for i, (prompt, n) in enumerate(requests)]
+    answers = evaluate_llama.BatchedGenerator(llm_pipeline, tokenizer, batch_size=3).answer_all(requests)
+    assert [answer for answer, _ in answers] == expected
+
+def test_out_of_memory_splits_batches(model, unbatched):
+    llm_pipeline, tokenizer = model
+    generator = evaluate_llama.BatchedGenerator(llm_pipeline, tokenizer, batch_size=8)
+    generator.model = OutOfMemoryAbove(generator.model, limit=2)
+    answers = generator.answer_all([(build_prompt(task), MAX_NEW_TOKENS) for task in make_tasks()])
+    assert [answer for answer, _ in answers] == unbatched
+    assert generator.batch_size == 2
+    assert generator.model.batch_sizes[:3] == [8, 4, 2]
+
+def test_failed_generation_is_graded_as_error(model):
+    llm_pipeline, tokenizer = model
+    generator = evaluate_llama.BatchedGenerator(llm_pipeline, tokenizer, batch_size=4)
+    generator.model = OutOfMemoryAbove(generator.model, limit=0)  # 1件でも生成できない
+    tasks = evaluate_llama.evaluate_groups_batched([[task] for task in make_tasks()], generator)
+    assert [task["instance_index"] for task in tasks] == list(range(9))
+    assert all(task["is_correct"] is None and task["llm_answer"] is None and task["error"].startswith("OutOfMemoryError") for task in tasks)